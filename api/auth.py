@@ -5,14 +5,16 @@ import flask
 from api.errors import AuthError
 from config import AppConfig
 from utils.logger import logger
+from utils.metrics import span
 
 
 def requires_auth(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        slack_verify_token = flask.request.form.get('token', '')
-        if not slack_verify_token == AppConfig.slack_verify_token:
-            raise AuthError("authorization malformed!")
+        with span("auth"):
+            slack_verify_token = flask.request.form.get('token', '')
+            if not slack_verify_token == AppConfig.slack_verify_token:
+                raise AuthError("authorization malformed!")
 
         return f(*args, **kwargs)
 
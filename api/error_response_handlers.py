@@ -4,8 +4,10 @@ from api.errors import (
     AuthError,
     BadRequest,
     Forbidden,
+    GatewayTimeout,
     InternalServerError,
-    NotFound
+    NotFound,
+    ServiceUnavailable
 )
 from utils.logger import logger
 
@@ -44,3 +46,13 @@ def configure_errorhandlers(app):
     def custom_internal_server_error(error):
         logger.error(f"internal_server_error: {error}")
         return make_response(jsonify(error.to_dict()), 500)
+
+    @app.errorhandler(ServiceUnavailable)
+    def custom_service_unavailable(error):
+        logger.error(f"service_unavailable: {error}")
+        return make_response(jsonify(error.to_dict()), 503)
+
+    @app.errorhandler(GatewayTimeout)
+    def custom_gateway_timeout(error):
+        logger.error(f"gateway_timeout: {error}")
+        return make_response(jsonify(error.to_dict()), 504)
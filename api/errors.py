@@ -45,3 +45,11 @@ class NotFound(HTTPError):
 
 class InternalServerError(HTTPError):
     phrase = 'internal_server_error'
+
+
+class ServiceUnavailable(HTTPError):
+    phrase = 'service_unavailable'
+
+
+class GatewayTimeout(HTTPError):
+    phrase = 'gateway_timeout'
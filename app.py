@@ -1,24 +1,86 @@
+# 起動時の import 時間を計測するため、他のモジュールより先に計測を開始する
+from utils.import_timer import import_timer  # isort:skip
+import_timer.start()
+
+import asyncio
+import functools
 import os
+import signal
 import sys
+import threading
+import time
+from distutils.util import strtobool
 
 import flask
 from flask_cors import CORS
-from langchain.agents import AgentType, Tool, initialize_agent
-from langchain.chains import RetrievalQA
-from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.llms import OpenAI
-from langchain.utilities import SerpAPIWrapper
 from slack_bolt import App
 from slack_bolt.adapter.flask import SlackRequestHandler
+from slack_sdk.web.async_client import AsyncWebClient
 
 from api.auth import requires_auth
 from api.error_response_handlers import configure_errorhandlers
-from api.errors import BadRequest, InternalServerError, NotFound
+from api.errors import (
+    BadRequest,
+    GatewayTimeout,
+    InternalServerError,
+    NotFound,
+    ServiceUnavailable
+)
 from config import AppConfig, LLMConfig, PromptConfig
-from db.feature import update_db_from_csv
-from prompt.prompt_template_loader import PromptTemplateLoader
+from db.embedding_cache import CachedEmbeddings
+from db.embeddings import get_emb_model, is_local_emb_model
+from db.feature import (
+    copy_feature_db,
+    get_feature_db_hash,
+    update_db_from_csv,
+    update_db_from_documents
+)
+from db.holder import FeatureDBHolder
+from db.ingestion import EmbeddingScheduler
+from db.lexical_index import build_lexical_index
+from db.snapshot import (
+    SnapshotWatcher,
+    get_dataset_hash,
+    load_snapshot,
+    publish_snapshot,
+    save_snapshot,
+    update_snapshot_lease
+)
+from db.vectorstore import get_feature_db_type
+from prompt.prompt_template_registry import PromptTemplateRegistry
+from qa.cache import AnswerCache
+from qa.context_builder import ContextBuilder
+from qa.pipeline import AnswerPipeline
+from qa.single_flight import SingleFlight
+from qa.streaming import (
+    ThrottledUpdater,
+    TokenCountCallbackHandler,
+    to_batch_results,
+    to_json_lines,
+    to_server_sent_events
+)
+from spreadsheet.change_detector import (
+    SpreadsheetChangeDetector,
+    get_csv_row_hashes
+)
 from spreadsheet.client import SpreadsheetClient
-from utils.logger import log_decorator, logger
+from spreadsheet.loader import SpreadsheetLoader
+from utils.async_runner import AsyncRunner, AsyncRunnerOverloaded
+from utils.cache import TTLCache
+from utils.circuit_breaker import CircuitBreaker
+from utils.deadline import CallExecutor, DeadlineClient, DeadlineExceeded
+from utils.job_queue import JobQueue
+from utils.logger import Payload, log_decorator, logger
+from utils.metrics import (
+    finish_trace,
+    iter_with_trace,
+    metrics,
+    record_stage,
+    span,
+    start_trace,
+    traced
+)
 
 # slack-bolt
 bolt_app = App(
@@ -26,6 +88,28 @@ bolt_app = App(
     signing_secret=AppConfig.slack_signing_token
 )
 handler = SlackRequestHandler(bolt_app)
+bolt_app.client.timeout = AppConfig.slack_timeout
+
+# Slack コマンドの回答を生成するワーカー
+slack_job_queue = JobQueue(
+    num_workers=AppConfig.slack_num_workers,
+    maxsize=AppConfig.slack_queue_size,
+    name="slack-job-queue",
+)
+slack_received_commands = TTLCache(maxsize=10000, ttl=600)
+
+# LLM・埋め込み・Slack API の呼び出しを非同期に行うイベントループ（ASYNC_IO=True の場合）
+async_runner = AsyncRunner(
+    max_concurrency=AppConfig.async_max_concurrency,
+    max_connections=AppConfig.async_max_connections,
+    name="async-runner",
+)
+async_slack_client = None
+
+# 終了処理中（処理中の回答を生成し終えるまで待っている間）は、/ready で 503 を返す
+is_draining = threading.Event()
+drain_thread = None
+drain_lock = threading.Lock()
 
 # flask
 flask_app = flask.Flask(__name__)
@@ -34,34 +118,174 @@ flask_app.config['JSON_AS_ASCII'] = False
 flask_app.config["JSON_SORT_KEYS"] = False
 configure_errorhandlers(flask_app)
 
+
+@flask_app.before_request
+def start_request_trace():
+    # リクエストごとに各ステージの処理時間を集計する（ストリーミングの場合はレスポンスを返し終えるまで）
+    rule = flask.request.url_rule.rule if flask.request.url_rule is not None else "unknown"
+    flask.g.trace = start_trace(f"{flask.request.method} {rule}")
+
+    # 複数のワーカープロセスで起動している場合は、他のワーカーが更新した特徴量データベースに切り替える
+    if AppConfig.num_workers > 1:
+        sync_feature_db()
+
+
+@flask_app.teardown_request
+def finish_request_trace(exception=None):
+    finish_trace(flask.g.pop('trace', None))
+    feature_db_holder.release(flask.g.pop('feature_db_version', None))
+
+
+def acquire_feature_db():
+    # リクエスト中は、リクエスト開始時点の特徴量データベースを使用し、リクエストの終了時に解放する
+    # （リクエスト中に 2 回以上切り替えられても、処理中のリクエストが参照しているバージョンは解放されない）
+    current_db = feature_db_holder.acquire()
+    flask.g.feature_db_version = current_db
+    return current_db
+
+
+def iter_with_feature_db(feature_db_version, iterable):
+    # ストリーミングのレスポンスは、生成し終えた時点で特徴量データベースを解放する
+    try:
+        yield from iterable
+    finally:
+        feature_db_holder.release(feature_db_version)
+
+
 # define LLM model
 llm = OpenAI(
     model_name=LLMConfig.model_name,
     temperature=LLMConfig.temperature,
+    streaming=True,
+    callbacks=[TokenCountCallbackHandler(LLMConfig.model_name)],
 )
+# Agent からの LLM の呼び出しも、リクエスト自体のタイムアウトを処理中のリクエストの期限までの残り時間にする
+llm.client = DeadlineClient(llm.client, "llm")
 logger.debug(f'llm={llm}')
 
 # define embeddings model
-emb_model = OpenAIEmbeddings(
-    model=LLMConfig.emb_model_name,
+# EMB_MODEL_NAME=local-ngram の場合は、外部 API を使用せずに CPU で埋め込む
+if is_local_emb_model(LLMConfig.emb_model_name):
+    base_emb_model = get_emb_model(
+        LLMConfig.emb_model_name,
+        dim=LLMConfig.emb_local_dim,
+        num_workers=LLMConfig.emb_local_num_workers,
+    )
+    emb_scheduler = None
+else:
+    base_emb_model = get_emb_model(LLMConfig.emb_model_name)
+    # 入力文の埋め込みも、リクエスト自体のタイムアウトを処理中のリクエストの期限までの残り時間にする（期限がない用語集の埋め込みはそのまま）
+    base_emb_model.client = DeadlineClient(base_emb_model.client, "query_embedding")
+    # 用語集の埋め込みは、API のレート制限内でバッチ単位に並列に行う
+    # 再試行はスケジューラー（ジッター付きのバックオフ・レート制限のトークン数の計上）のみで行うように、クライアント内部では再試行しない
+    emb_scheduler = EmbeddingScheduler(
+        get_emb_model(LLMConfig.emb_model_name, max_retries=0),
+        model_name=LLMConfig.emb_model_name,
+        max_workers=LLMConfig.emb_max_workers,
+        requests_per_minute=LLMConfig.emb_requests_per_minute,
+        tokens_per_minute=LLMConfig.emb_tokens_per_minute,
+        max_batch_tokens=LLMConfig.emb_batch_tokens,
+        max_batch_size=LLMConfig.emb_batch_size,
+        max_retries=LLMConfig.emb_max_retries,
+    )
+
+# 用語集の更新時に変更のない文章を再度埋め込まないように、埋め込みベクトルをキャッシュする
+# ローカルの埋め込みモデルは次元数などの設定もモデル名に含めて、設定を変更した場合は別の埋め込みベクトルとして扱う
+emb_model = CachedEmbeddings(
+    base_emb_model,
+    model_name=getattr(base_emb_model, "model_name", LLMConfig.emb_model_name),
+    cache_path=AppConfig.emb_cache_path,
+    query_cache_size=LLMConfig.query_emb_cache_size,
+    scheduler=emb_scheduler,
 )
 logger.debug(f'emb_model={emb_model}')
 
+
+def update_feature_db_lease(feature_db_versions):
+    # 保持しているバージョン（処理中のリクエストが参照している古いバージョンを含む）のスナップショットを、他のワーカーが削除しないようにする
+    update_snapshot_lease(AppConfig.snapshot_dir, [version.info['dataset_hash'] for version in feature_db_versions if 'dataset_hash' in version.info])
+
+
 # init feature DB
-feature_db = None
+# 特徴量データベースはバックグラウンドで作成し、作成完了時に参照を切り替える
+# 用語列の完全一致・n-gram 索引も、特徴量データベースと同時に作成して切り替える
+feature_db_holder = FeatureDBHolder(
+    lexical_index_builder=functools.partial(
+        build_lexical_index,
+        term_column=AppConfig.dataset_term_column,
+        min_coverage=LLMConfig.retriever_lexical_min_coverage,
+        exact_match_min_length=LLMConfig.retriever_exact_match_min_length,
+    ),
+    on_change=update_feature_db_lease,
+)
+
+# 前回取り込んだスプレッドシートのリビジョンと各行のハッシュ値
+spreadsheet_change_detector = SpreadsheetChangeDetector(state_path=AppConfig.spreadsheet_state_path)
+
+# 他のワーカープロセスが作成＆公開した特徴量データベースのスナップショット
+snapshot_watcher = SnapshotWatcher(AppConfig.snapshot_dir, interval=AppConfig.feature_db_sync_interval)
 
 # define prompt template
+# ディレクトリ内の全てのテンプレートを読み込み、リクエスト（Slack のチャンネル）ごとに使用するテンプレートを選択する
 try:
-    prompt_template = PromptTemplateLoader(
-        file_path=PromptConfig.prompt_file_path
+    prompt_registry = PromptTemplateRegistry(
+        prompt_dir=PromptConfig.prompt_dir,
+        default_name=os.path.splitext(os.path.basename(PromptConfig.prompt_file_path))[0],
+        reload_interval=PromptConfig.prompt_reload_interval,
+        channel_templates=PromptConfig.prompt_channel_templates,
     )
 except Exception as e:
     logger.error(f"failed to load prompt file! | {e}")
     exit(1)
 
 
-@log_decorator(logger=logger)
+def create_circuit_breaker(name):
+    # 直近の呼び出しのエラー率・遅延率が閾値を超えた場合は、一定時間呼び出しを止める
+    return CircuitBreaker(
+        name,
+        window_size=LLMConfig.circuit_breaker_window_size,
+        min_calls=LLMConfig.circuit_breaker_min_calls,
+        failure_rate_threshold=LLMConfig.circuit_breaker_failure_rate,
+        slow_call_duration=LLMConfig.circuit_breaker_slow_call_duration,
+        slow_call_rate_threshold=LLMConfig.circuit_breaker_slow_call_rate,
+        open_duration=LLMConfig.circuit_breaker_open_duration,
+    )
+
+
+# define QA pipeline
+# 回答の生成はリクエストごとの期限内に打ち切り、Agent が遅い・失敗した場合は RAG の回答を使用する
+answer_pipeline = AnswerPipeline(
+    llm=llm,
+    emb_model=emb_model,
+    prompt_registry=prompt_registry,
+    model_name=LLMConfig.model_name,
+    retriever_top_k=LLMConfig.retriever_top_k,
+    retriever_score_threshold=LLMConfig.retriever_score_threshold,
+    use_function_calling=LLMConfig.use_function_calling,
+    route_confidence_threshold=LLMConfig.route_confidence_threshold if LLMConfig.use_confidence_routing else None,
+    request_timeout=LLMConfig.request_timeout,
+    hedge_delay=LLMConfig.hedge_delay if LLMConfig.hedge_delay >= 0 else None,
+    agent_breaker=create_circuit_breaker("agent") if LLMConfig.use_circuit_breaker else None,
+    search_breaker=create_circuit_breaker("google-search") if LLMConfig.use_circuit_breaker else None,
+    # 期限までのみ待つ同期の呼び出しは、呼び出しごとにスレッドを作成せずに上限のあるスレッドプールで実行する
+    call_executor=CallExecutor(max_workers=LLMConfig.call_max_workers, name="deadline-call"),
+    hedge_executor=CallExecutor(max_workers=LLMConfig.hedge_max_workers, name="hedge"),
+    answer_cache=AnswerCache(
+        maxsize=LLMConfig.answer_cache_size,
+        ttl=LLMConfig.answer_cache_ttl,
+        similarity_threshold=LLMConfig.answer_cache_similarity_threshold,
+    ),
+    single_flight=SingleFlight(name="answer-single-flight") if LLMConfig.use_single_flight else None,
+    context_builder=ContextBuilder(model_name=LLMConfig.model_name, max_tokens=LLMConfig.context_max_tokens),
+)
+
+# 起動時の import 時間（モジュールごと）を出力する
+import_timer.stop()
+logger.info(f"import time report | {import_timer.report()}")
+
+
 @flask_app.route('/health', methods=['GET'])
+@log_decorator(logger=logger)
 def health():
     resp = flask.jsonify(
         {
@@ -71,110 +295,259 @@ def health():
     return resp, 200
 
 
+@flask_app.route('/ready', methods=['GET'])
 @log_decorator(logger=logger)
+def ready():
+    # /health は生存確認のみを行い、/ready は特徴量データベースの作成後かつ終了処理中でない場合のみ 200 を返す
+    if is_draining.is_set():
+        raise ServiceUnavailable("server is shutting down!")
+    current_db = feature_db_holder.get()
+    if current_db is None:
+        raise ServiceUnavailable("feature db is not ready!")
+
+    resp = flask.jsonify(
+        {
+            'message': 'ready',
+            'version': current_db.version,
+        }
+    )
+    return resp, 200
+
+
+def drain(timeout=AppConfig.graceful_timeout):
+    # 新しい Slack コマンドを受け付けないようにして、処理中・待機中の Slack コマンドの回答を生成し終えるまで待つ
+    logger.info(f"draining slack jobs | timeout={timeout}")
+    is_draining.set()
+    start_time = time.monotonic()
+    is_drained = slack_job_queue.shutdown(timeout=timeout)
+    return async_runner.shutdown(timeout=max(0.0, timeout - (time.monotonic() - start_time))) and is_drained
+
+
+def start_drain(timeout=AppConfig.graceful_timeout):
+    # SIGTERM を受けた時点で /ready を 503 にし、処理中・待機中の Slack コマンドの回答を生成し終えるまでバックグラウンドで待つ
+    global drain_thread
+    with drain_lock:
+        if drain_thread is None:
+            is_draining.set()
+            drain_thread = threading.Thread(target=drain, kwargs={'timeout': timeout}, name="drain", daemon=True)
+            drain_thread.start()
+        return drain_thread
+
+
+def load_published_feature_db(current_feature_db, published):
+    # 他のワーカーが公開したスナップショットを読み込む（FAISS・numpy の場合はメモリマップで読み込むので、ワーカー間でページを共有する）
+    current_db = feature_db_holder.get()
+    if current_db is not None and current_db.version == published['version']:
+        return None
+
+    feature_db = load_snapshot(AppConfig.snapshot_dir, published['dataset_hash'], emb_model, feature_db_type=LLMConfig.feature_db_type)
+    if feature_db is None:
+        raise FileNotFoundError(f"published feature db snapshot not found! | dataset_hash={published['dataset_hash']}")
+    spreadsheet_change_detector.load()
+    return feature_db, published['version'], {**published['info'], 'dataset_hash': published['dataset_hash']}
+
+
+def sync_feature_db():
+    published = snapshot_watcher.poll()
+    if published is None:
+        return False
+    current_db = feature_db_holder.get()
+    if current_db is not None and current_db.version == published['version']:
+        return False
+    logger.info(f"found published feature db | version={published['version']}")
+    return feature_db_holder.submit(functools.partial(load_published_feature_db, published=published))
+
+
+def build_feature_db(current_feature_db, spreadsheet, worksheet, revision):
+    # update feature db from spreadsheet
+    # スプレッドシートを行範囲ごとに読み込みながら、読み込んだ文章から逐次分割＆埋め込みを行う（csv ファイルは副次的に書き出す）
+    # 検索中の特徴量データベースは更新せずに、複製した特徴量データベースに用語集の差分のみを反映する
+    # 複数のワーカープロセスで起動している場合は、他のワーカーが保存した埋め込みベクトルのキャッシュと取り込み状態を読み込み直す
+    if AppConfig.num_workers > 1:
+        emb_model.load()
+        spreadsheet_change_detector.load()
+
+    document_loader = SpreadsheetLoader(
+        spreadsheet,
+        worksheet,
+        text_columns=AppConfig.dataset_text_columns,
+        meta_columns=AppConfig.dataset_meta_columns,
+        page_size=AppConfig.dataset_page_size,
+        file_path=AppConfig.dataset_path,
+    )
+    copied_feature_db = copy_feature_db(current_feature_db, emb_model) if current_feature_db is not None else None
+    feature_db = update_db_from_documents(
+        document_loader.lazy_load(),
+        emb_model=emb_model,
+        chunk_size=AppConfig.chunk_size,
+        feature_db_type=LLMConfig.feature_db_type,
+        feature_db=copied_feature_db,
+    )
+
+    # シートに行がない場合は切り替えずに、現在の特徴量データベースを使用し続ける（取り込み状態も更新せずに、次回の呼び出しで再度取り込む）
+    if feature_db is None:
+        logger.warning(f"spreadsheet has no rows! keep serving current feature db | revision={revision}")
+        if copied_feature_db is not None and get_feature_db_type(copied_feature_db) == "chroma":
+            copied_feature_db.delete_collection()
+        return None
+
+    # 前回取り込んだ内容から変更された行
+    row_diff = spreadsheet_change_detector.diff(document_loader.row_hashes)
+    logger.info(f"spreadsheet changed | n_changed_rows={len(row_diff['changed_rows'])} n_deleted_rows={len(row_diff['deleted_rows'])}")
+    try:
+        spreadsheet_change_detector.update(revision, document_loader.row_hashes)
+    except Exception as e:
+        logger.warning(f"failed to save spreadsheet state! | {e}")
+
+    # スナップショットを保存＆公開し、他のワーカープロセスも同じ特徴量データベースに切り替える
+    version = get_dataset_hash(AppConfig.dataset_path)
+    info = {'revision': revision, **row_diff}
+    try:
+        dataset_hash = get_feature_db_hash(AppConfig.dataset_path, emb_model, AppConfig.chunk_size, feature_db_type=LLMConfig.feature_db_type)
+        save_snapshot(feature_db, AppConfig.snapshot_dir, dataset_hash)
+        publish_snapshot(AppConfig.snapshot_dir, dataset_hash, version, {'revision': revision})
+        info['dataset_hash'] = dataset_hash
+    except Exception as e:
+        logger.warning(f"failed to save feature db snapshot! | {e}")
+
+    return feature_db, version, info
+
+
+@flask_app.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Prometheus 形式で、各ステージの処理時間のヒストグラムとキャッシュヒット数・トークン数などを返す
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @flask_app.route('/update_db', methods=['PUT'])
+@log_decorator(logger=logger)
 def update_db():
-    # create csv file from spreadsheet
+    # force=true の場合は、スプレッドシートに変更がなくても特徴量データベースを更新する
+    try:
+        force = strtobool(flask.request.args.get('force', 'false'))
+    except Exception as e:
+        raise BadRequest(f"invalid force parameter! | {e}")
+
+    # スプレッドシートに変更がない場合は、シートの値の取得や埋め込みを行わずにすぐに返す
+    # リビジョンはシートの値を取得する前に取得し、取得中に編集された場合は次回の呼び出しで再度取り込むようにする
     spreadsheet = SpreadsheetClient(gcp_sa_key=AppConfig.gcp_sa_key)
     try:
-        worksheet = spreadsheet.get_worksheet(AppConfig.spreadsheet_key, AppConfig.spreadsheet_name)
-        logger.debug(f'worksheet={worksheet}')
+        revision = spreadsheet.get_revision(AppConfig.spreadsheet_key)
+        logger.debug(f'revision={revision}')
     except Exception as e:
-        raise NotFound(f"failed to open spreadsheet! | {e}")
+        raise NotFound(f"failed to get spreadsheet revision! | {e}")
+
+    if not force and feature_db_holder.get() is not None and spreadsheet_change_detector.is_unchanged(revision):
+        logger.info(f"spreadsheet is unchanged | revision={revision}")
+        resp = flask.jsonify(
+            {
+                'message': 'feature db is unchanged',
+                'revision': revision,
+            }
+        )
+        return resp, 200
 
+    # open spreadsheet
     try:
-        spreadsheet.write_worksheet_csv(worksheet, AppConfig.dataset_path)
+        worksheet = spreadsheet.get_worksheet(AppConfig.spreadsheet_key, AppConfig.spreadsheet_name)
+        logger.debug(f'worksheet={worksheet}')
     except Exception as e:
-        raise InternalServerError(f"failed to write csv file from spreadsheet! | {e}")
+        raise NotFound(f"failed to open spreadsheet! | {e}")
 
-    # update feature db from csv
-    feature_db = update_db_from_csv(
-        file_path=AppConfig.dataset_path,
-        emb_model=emb_model,
-        chunk_size=AppConfig.chunk_size,
-        feature_db_type=LLMConfig.feature_db_type
-    )
+    # 特徴量データベースはバックグラウンドで作成し、作成完了後に切り替える（作成結果は /feature_db で確認する）
+    build_func = functools.partial(build_feature_db, spreadsheet=spreadsheet, worksheet=worksheet, revision=revision)
+    if feature_db_holder.submit(build_func):
+        message = 'started to update feature db'
+    else:
+        message = 'feature db update is in progress. feature db will be updated again after current update'
 
     # set response message json
     resp = flask.jsonify(
         {
-            'message': 'succeeded to update feature db'
+            'message': message,
+            'revision': revision,
         }
     )
-    return resp, 200
+    return resp, 202
 
 
+@flask_app.route('/feature_db', methods=['GET'])
 @log_decorator(logger=logger)
+def get_feature_db_status():
+    # 現在使用中の特徴量データベースのバージョン・作成時刻と、作成中の状態を返す
+    resp = flask.jsonify(feature_db_holder.status())
+    return resp, 200
+
+
 @flask_app.route('/chat', methods=['POST'])
+@log_decorator(logger=logger)
 @requires_auth
 def chat():
     # get input text
     try:
         question = flask.request.form['text']
-        logger.debug(f'question={question}')
+        logger.debug('question=%s', Payload(question))
     except Exception as e:
         raise BadRequest(f"failed to get input text! | {e}")
 
-    # 特徴量データベース（VectorDB）から retriever（ユーザーからの入力文に対して、外部テキストデータの分割した各文章から類似度の高い文章を検索＆取得をするための機能）作成
-    retriever = feature_db.as_retriever(
-        search_type="similarity_score_threshold",
-        search_kwargs={
-            "k": LLMConfig.retriever_top_k,                            # 上位 k 個の分割文章を検索＆取得
-            "score_threshold": LLMConfig.retriever_score_threshold,    # スレッショルド値
-        },
-    )
-
-    # retriever で、ユーザーからの入力文に対して、外部テキストデータの分割した各文章から類似度の高い情報を検索＆取得
-    context = retriever.get_relevant_documents(query=question)
-    logger.debug(f"context={context}")
-
-    # create prompt from prompt template
-    prompt = prompt_template.format(question=question, context=context)
-    logger.debug(f"prompt={prompt}")
-
-    # LangChain Data connection の Retrievers を使用して、RetrievalQA Chain（質問応答 QA の取得に使用する Chain）を生成
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever
-    )
-    logger.debug(f'qa_chain={qa_chain}')
-
-    # define Agent
-    if LLMConfig.use_function_calling:
-        tools = [
-            Tool(
-                name="RAGBot",
-                func=qa_chain.run,
-                description="RAG を使用して LLM が学習に使用していない特定ドメインの質問応答を行うbot"
-            ),
-            Tool(
-                name="GoogleSearch",
-                func=SerpAPIWrapper().run,
-                description="useful for when you need to answer questions about current events. You should ask targeted questions"
-            ),
-        ]
-        agent = initialize_agent(
-            tools,
-            llm,
-            agent=AgentType.OPENAI_FUNCTIONS,
-            verbose=True,
+    # stream=true の場合は、LLM が生成したトークンを Server-Sent-Events 形式で逐次返す
+    try:
+        stream = strtobool(flask.request.form.get('stream', 'false'))
+    except Exception as e:
+        raise BadRequest(f"invalid stream parameter! | {e}")
+
+    # prompt にテンプレート名（prompt/prompt_files 内のファイル名）を指定した場合は、そのテンプレートを使用する
+    prompt_name = flask.request.form.get('prompt')
+
+    # リクエスト中は、リクエスト開始時点の特徴量データベースを使用する
+    current_db = acquire_feature_db()
+    if current_db is None:
+        raise ServiceUnavailable("feature db is not ready!")
+
+    # ストリーミングの場合もレスポンスを返し始める前に、同時に処理中の質問数が上限に達していれば 503 を返す
+    if AppConfig.use_async_io and async_runner.is_full():
+        raise ServiceUnavailable("too many requests!")
+
+    if stream:
+        if AppConfig.use_async_io:
+            # 回答の生成はイベントループで行い、リクエストスレッドはトークンを受け取って返すのみ
+            tokens = async_runner.iterate(answer_pipeline.astream_answer(
+                current_db.feature_db, question, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+                prompt_name=prompt_name,
+            ))
+        else:
+            tokens = answer_pipeline.stream_answer(
+                current_db.feature_db, question, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+                prompt_name=prompt_name,
+            )
+        return flask.Response(
+            flask.stream_with_context(iter_with_trace(
+                flask.g.pop('trace', None), iter_with_feature_db(flask.g.pop('feature_db_version', None), to_server_sent_events(tokens, question))
+            )),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
         )
 
     # run LLLM prediction for QA task
     try:
-        if LLMConfig.use_function_calling:
-            answer = agent.run(prompt)
+        if AppConfig.use_async_io:
+            answer = async_runner.run(answer_pipeline.aanswer(
+                current_db.feature_db, question, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+                prompt_name=prompt_name,
+            ))
         else:
-            answer = qa_chain.run(prompt)
+            answer = answer_pipeline.answer(
+                current_db.feature_db, question, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+                prompt_name=prompt_name,
+            )
+    except DeadlineExceeded as e:
+        raise GatewayTimeout(f"failed to generate answer in time! | {e}")
+    except AsyncRunnerOverloaded as e:
+        raise ServiceUnavailable(f"too many requests! | {e}")
     except Exception as e:
-        try:
-            # 用語集に該当情報がみつからない かつ Google 検索でも該当情報がみつからない場合
-            answer = qa_chain.run(prompt)
-        except Exception as e:
-            raise InternalServerError(f"failed to generate answer! | {e}")
+        raise InternalServerError(f"failed to generate answer! | {e}")
 
-    logger.info(f'answer={answer}')
+    logger.info('answer=%s', Payload(answer))
 
     # set response message json
     resp = flask.jsonify(
@@ -186,22 +559,90 @@ def chat():
     return resp, 200
 
 
+@flask_app.route('/chat/batch', methods=['POST'])
+@log_decorator(logger=logger)
+@requires_auth
+def chat_batch():
+    # 複数の質問文（text を複数指定）にまとめて回答する
+    questions = flask.request.form.getlist('text')
+    logger.debug('questions=%s', Payload(questions))
+    if len(questions) == 0:
+        raise BadRequest("failed to get input text!")
+    if len(questions) > AppConfig.batch_max_questions:
+        raise BadRequest(f"too many input texts! | n_questions={len(questions)} batch_max_questions={AppConfig.batch_max_questions}")
+
+    # stream=true の場合は、回答が完了した質問文から順に JSON Lines 形式で返す
+    try:
+        stream = strtobool(flask.request.form.get('stream', 'false'))
+    except Exception as e:
+        raise BadRequest(f"invalid stream parameter! | {e}")
+    prompt_name = flask.request.form.get('prompt')
+
+    current_db = acquire_feature_db()
+    if current_db is None:
+        raise ServiceUnavailable("feature db is not ready!")
+
+    if AppConfig.use_async_io:
+        if async_runner.is_full():
+            raise ServiceUnavailable("too many requests!")
+        results = async_runner.iterate(answer_pipeline.aiter_answer_batch(
+            current_db.feature_db, questions, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+            prompt_name=prompt_name, max_concurrency=LLMConfig.batch_max_concurrency,
+        ))
+    else:
+        results = answer_pipeline.iter_answer_batch(
+            current_db.feature_db, questions, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+            prompt_name=prompt_name, max_concurrency=LLMConfig.batch_max_concurrency,
+        )
+    if stream:
+        return flask.Response(
+            flask.stream_with_context(iter_with_trace(
+                flask.g.pop('trace', None), iter_with_feature_db(flask.g.pop('feature_db_version', None), to_json_lines(results, questions))
+            )),
+            mimetype='application/x-ndjson',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        )
+
+    # 個々の質問文の回答の生成に失敗した場合は、その質問文のみエラーを返す
+    try:
+        batch_results = sorted(to_batch_results(results, questions), key=lambda result: result['index'])
+    except DeadlineExceeded as e:
+        raise GatewayTimeout(f"failed to generate answer in time! | {e}")
+    except AsyncRunnerOverloaded as e:
+        raise ServiceUnavailable(f"too many requests! | {e}")
+    except Exception as e:
+        raise InternalServerError(f"failed to generate answer! | {e}")
+
+    # set response message json
+    resp = flask.jsonify({'results': batch_results})
+    return resp, 200
+
+
 @flask_app.route("/slack/events", methods=["POST"])
 def slack_events():
     return handler.handle(flask.request)
 
 
-@log_decorator(logger=logger)
 @bolt_app.command("/glossary-chat-bot")
-def chat_by_slack(ack, respond, command):
-    logger.debug(f'command={command}')
+@log_decorator(logger=logger)
+def chat_by_slack(ack, respond, command, request):
+    logger.debug('command=%s', Payload(command))
 
     # return ACK as soon as possible
     ack()
 
+    # Slack からの再送リクエストの場合は、受付済みのコマンドであれば処理しない
+    trigger_id = command.get('trigger_id')
+    slack_retry_num = request.headers.get('x-slack-retry-num')
+    if trigger_id is not None:
+        if slack_retry_num is not None and slack_received_commands.get(trigger_id) is not None:
+            logger.info(f"skip slack retry request | trigger_id={trigger_id} retry_num={slack_retry_num}")
+            return
+
     # verify token
-    slack_verify_token = command['token']
-    if not slack_verify_token == AppConfig.slack_verify_token:
+    with span("auth"):
+        is_authorized = command['token'] == AppConfig.slack_verify_token
+    if not is_authorized:
         logger.error(f"error: unauthorized, error_description: authorization malformed!")
         respond(f"error: unauthorized, error_description: authorization malformed!")
         return
@@ -209,7 +650,7 @@ def chat_by_slack(ack, respond, command):
     # get input text
     try:
         question = command['text']
-        logger.debug(f'question={question}')
+        logger.debug('question=%s', Payload(question))
     except Exception as e:
         logger.error(f"error: bad request, error_description: failed to get input text! | {e}")
         respond(f"error: bad request, error_description: failed to get input text! | {e}")
@@ -219,110 +660,262 @@ def chat_by_slack(ack, respond, command):
         respond(f"`{command['command']}` の後に質問文を入力してください")
         return
 
-    # 特徴量データベース（VectorDB）から retriever（ユーザーからの入力文に対して、外部テキストデータの分割した各文章から類似度の高い文章を検索＆取得をするための機能）作成
-    retriever = feature_db.as_retriever(
-        search_type="similarity_score_threshold",
-        search_kwargs={
-            "k": LLMConfig.retriever_top_k,                           # 上位 k 個の分割文章を検索＆取得
-            "score_threshold": LLMConfig.retriever_score_threshold,   # スレッショルド値
-        },
-    )
+    # 回答の生成と Slack への投稿はイベントループ（またはワーカースレッド）で行い、リクエストスレッドはすぐに返す
+    if AppConfig.use_async_io:
+        is_submitted = async_runner.submit(answer_by_slack_async(respond, command, question, submitted_at=time.perf_counter())) is not None
+    else:
+        is_submitted = slack_job_queue.submit(answer_by_slack, respond, command, question, submitted_at=time.perf_counter())
+    if not is_submitted:
+        logger.error(f"error: service_unavailable, error_description: slack job queue is full!")
+        respond(f"現在混み合っています。しばらくしてから再度質問してください")
+        return
 
-    # retriever で、ユーザーからの入力文に対して、外部テキストデータの分割した各文章から類似度の高い情報を検索＆取得
-    context = retriever.get_relevant_documents(query=question)
-    logger.debug(f"context={context}")
+    # 受付できたコマンドのみ受付済みとする（混み合っていて受付できなかったコマンドは、Slack からの再送リクエストで処理する）
+    if trigger_id is not None:
+        slack_received_commands.set(trigger_id, True)
+    return
 
-    # create prompt from prompt template
-    prompt = prompt_template.format(question=question, context=context)
-    logger.debug(f"prompt={prompt}")
 
-    # LangChain Data connection の Retrievers を使用して、RetrievalQA Chain（質問応答 QA の取得に使用する Chain）を生成
-    qa_chain = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever
-    )
-    logger.debug(f'qa_chain={qa_chain}')
-
-    # define Agent
-    if LLMConfig.use_function_calling:
-        tools = [
-            Tool(
-                name="RAGBot",
-                func=qa_chain.run,
-                description="RAG を使用して LLM が学習に使用していない特定ドメインの質問応答を行うbot"
-            ),
-            Tool(
-                name="GoogleSearch",
-                func=SerpAPIWrapper().run,
-                description="useful for when you need to answer questions about current events. You should ask targeted questions"
+def get_slack_answer_message(user_name, question, answer):
+    slack_msg = f"{user_name}さんからの質問です:\n{question}\n"
+    slack_msg += f"回答:\n"
+    slack_msg += f"```\n"
+    slack_msg += f"{answer}\n"
+    slack_msg += f"```\n"
+    return slack_msg
+
+
+def post_slack_message(**kwargs):
+    with span("slack_post"):
+        return bolt_app.client.chat_postMessage(**kwargs)
+
+
+def update_slack_message(**kwargs):
+    with span("slack_post"):
+        return bolt_app.client.chat_update(**kwargs)
+
+
+def get_async_slack_client():
+    # AsyncRunner の共有 HTTP セッションを使用する（fork 後はセッションが作り直されるので、クライアントも作り直す）
+    global async_slack_client
+    if async_slack_client is None or async_slack_client.session is not async_runner.session:
+        async_slack_client = AsyncWebClient(token=AppConfig.slack_bot_token, session=async_runner.session, timeout=AppConfig.slack_timeout)
+    return async_slack_client
+
+
+async def apost_slack_message(**kwargs):
+    with span("slack_post"):
+        return await get_async_slack_client().chat_postMessage(**kwargs)
+
+
+async def aupdate_slack_message(**kwargs):
+    with span("slack_post"):
+        return await get_async_slack_client().chat_update(**kwargs)
+
+
+@traced("slack_command")
+@log_decorator(logger=logger)
+def answer_by_slack(respond, command, question, submitted_at=None):
+    user_name = command["user_name"]
+    prompt_name = prompt_registry.get_channel_template_name(command.get("channel_id"))
+    if submitted_at is not None:
+        record_stage("slack_queue_wait", time.perf_counter() - submitted_at)
+
+    # 回答を生成し終えるまで、開始時点の特徴量データベースを解放しない
+    current_db = feature_db_holder.acquire()
+    if current_db is None:
+        logger.error(f"error: service_unavailable, error_description: feature db is not ready!")
+        respond(f"error: service_unavailable, error_description: feature db is not ready!")
+        return
+
+    # まず回答生成中のメッセージを投稿し、LLM が生成したトークンで一定間隔ごとにメッセージを更新する
+    if AppConfig.slack_streaming:
+        try:
+            slack_resp_1 = post_slack_message(
+                channel=command["channel_id"],
+                text=get_slack_answer_message(user_name, question, "回答を生成中です..."),
+                icon_emoji=':robot_face:',
+                username='glossary-llm-chat-bot'
+            )
+        except Exception as e:
+            logger.error(f"error: internal_server_error, error_description: failed to notify slack! | {e}")
+            respond(f"error: internal_server_error, error_description: failed to notify slack! | {e}")
+            feature_db_holder.release(current_db)
+            return
+
+        slack_updater = ThrottledUpdater(
+            lambda text: update_slack_message(
+                channel=slack_resp_1["channel"],
+                ts=slack_resp_1["ts"],
+                text=text,
             ),
-        ]
-        agent = initialize_agent(
-            tools,
-            llm,
-            agent=AgentType.OPENAI_FUNCTIONS,
-            verbose=True,
+            interval=AppConfig.slack_update_interval,
         )
 
     # run LLLM prediction for QA task
-    ack()
     try:
-        if LLMConfig.use_function_calling:
-            answer = agent.run(prompt)
+        if AppConfig.slack_streaming:
+            answer = ""
+            for token in answer_pipeline.stream_answer(
+                current_db.feature_db, question, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+                prompt_name=prompt_name,
+            ):
+                answer += token
+                slack_updater.update(get_slack_answer_message(user_name, question, answer))
         else:
-            answer = qa_chain.run(prompt)
+            answer = answer_pipeline.answer(
+                current_db.feature_db, question, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+                prompt_name=prompt_name,
+            )
+    except DeadlineExceeded as e:
+        logger.error(f"error: gateway_timeout, error_description: failed to generate answer in time! | {e}")
+        respond(f"回答の生成がタイムアウトしました。しばらくしてから再度質問してください")
+        return
     except Exception as e:
-        try:
-            # 用語集に該当情報がみつからない かつ Google 検索でも該当情報がみつからない場合
-            answer = qa_chain.run(prompt)
-        except Exception as e:
-            logger.error(f"error: internal_server_error, error_description: failed to generate answer! | {e}")
-            respond(f"error: internal_server_error, error_description: failed to generate answer! | {e}")
-            return
+        logger.error(f"error: internal_server_error, error_description: failed to generate answer! | {e}")
+        respond(f"error: internal_server_error, error_description: failed to generate answer! | {e}")
+        return
+    finally:
+        feature_db_holder.release(current_db)
 
-    ack()
-    logger.info(f'answer={answer}')
+    logger.info('answer=%s', Payload(answer))
 
     # set response message
     try:
-        user_name = command["user_name"]
-        slack_msg_1 = f"{user_name}さんからの質問です:\n{question}\n"
-        slack_msg_1 += f"回答:\n"
-        slack_msg_1 += f"```\n"
-        slack_msg_1 += f"{answer}\n"
-        slack_msg_1 += f"```\n"
-        slack_resp_1 = bolt_app.client.chat_postMessage(
+        if AppConfig.slack_streaming:
+            slack_updater.update(get_slack_answer_message(user_name, question, answer), force=True)
+        else:
+            slack_resp_1 = post_slack_message(
+                channel=command["channel_id"],
+                text=get_slack_answer_message(user_name, question, answer),
+                icon_emoji=':robot_face:',
+                username='glossary-llm-chat-bot'
+            )
+
+        slack_msg_2 = f"解決しましたか？\n"
+        slack_msg_2 += f"用語を追加＆修正したい場合は、以下のスプレッドシートから入力してください。\n"
+        slack_msg_2 += f"https://docs.google.com/spreadsheets/d/{AppConfig.spreadsheet_key}\n"
+        post_slack_message(
             channel=command["channel_id"],
-            text=slack_msg_1,
+            text=slack_msg_2,
             icon_emoji=':robot_face:',
-            username='glossary-llm-chat-bot'
+            thread_ts=slack_resp_1['ts']
+        )
+    except Exception as e:
+        logger.error(f"error: internal_server_error, error_description: failed to notify slack! | {e}")
+        respond(f"error: internal_server_error, error_description: failed to notify slack! | {e}")
+        return
+
+    return
+
+
+@traced("slack_command")
+@log_decorator(logger=logger)
+async def answer_by_slack_async(respond, command, question, submitted_at=None):
+    # answer_by_slack の非同期版（respond は同期 API なので、スレッドで呼び出す）
+    user_name = command["user_name"]
+    prompt_name = prompt_registry.get_channel_template_name(command.get("channel_id"))
+    if submitted_at is not None:
+        record_stage("slack_queue_wait", time.perf_counter() - submitted_at)
+
+    # 回答を生成し終えるまで、開始時点の特徴量データベースを解放しない
+    current_db = feature_db_holder.acquire()
+    if current_db is None:
+        logger.error(f"error: service_unavailable, error_description: feature db is not ready!")
+        await asyncio.to_thread(respond, f"error: service_unavailable, error_description: feature db is not ready!")
+        return
+
+    # まず回答生成中のメッセージを投稿し、LLM が生成したトークンで一定間隔ごとにメッセージを更新する
+    if AppConfig.slack_streaming:
+        try:
+            slack_resp_1 = await apost_slack_message(
+                channel=command["channel_id"],
+                text=get_slack_answer_message(user_name, question, "回答を生成中です..."),
+                icon_emoji=':robot_face:',
+                username='glossary-llm-chat-bot'
+            )
+        except Exception as e:
+            logger.error(f"error: internal_server_error, error_description: failed to notify slack! | {e}")
+            await asyncio.to_thread(respond, f"error: internal_server_error, error_description: failed to notify slack! | {e}")
+            feature_db_holder.release(current_db)
+            return
+
+        slack_updater = ThrottledUpdater(
+            lambda text: aupdate_slack_message(
+                channel=slack_resp_1["channel"],
+                ts=slack_resp_1["ts"],
+                text=text,
+            ),
+            interval=AppConfig.slack_update_interval,
         )
 
+    # run LLLM prediction for QA task
+    try:
+        if AppConfig.slack_streaming:
+            answer = ""
+            async for token in answer_pipeline.astream_answer(
+                current_db.feature_db, question, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+                prompt_name=prompt_name,
+            ):
+                answer += token
+                await slack_updater.aupdate(get_slack_answer_message(user_name, question, answer))
+        else:
+            answer = await answer_pipeline.aanswer(
+                current_db.feature_db, question, feature_db_version=current_db.version, lexical_index=current_db.lexical_index,
+                prompt_name=prompt_name,
+            )
+    except DeadlineExceeded as e:
+        logger.error(f"error: gateway_timeout, error_description: failed to generate answer in time! | {e}")
+        await asyncio.to_thread(respond, f"回答の生成がタイムアウトしました。しばらくしてから再度質問してください")
+        return
+    except Exception as e:
+        logger.error(f"error: internal_server_error, error_description: failed to generate answer! | {e}")
+        await asyncio.to_thread(respond, f"error: internal_server_error, error_description: failed to generate answer! | {e}")
+        return
+    finally:
+        feature_db_holder.release(current_db)
+
+    logger.info('answer=%s', Payload(answer))
+
+    # set response message
+    try:
+        if AppConfig.slack_streaming:
+            await slack_updater.aupdate(get_slack_answer_message(user_name, question, answer), force=True)
+        else:
+            slack_resp_1 = await apost_slack_message(
+                channel=command["channel_id"],
+                text=get_slack_answer_message(user_name, question, answer),
+                icon_emoji=':robot_face:',
+                username='glossary-llm-chat-bot'
+            )
+
         slack_msg_2 = f"解決しましたか？\n"
         slack_msg_2 += f"用語を追加＆修正したい場合は、以下のスプレッドシートから入力してください。\n"
         slack_msg_2 += f"https://docs.google.com/spreadsheets/d/{AppConfig.spreadsheet_key}\n"
-        bolt_app.client.chat_postMessage(
+        await apost_slack_message(
             channel=command["channel_id"],
             text=slack_msg_2,
             icon_emoji=':robot_face:',
-            thread_ts=slack_resp_1['message']['ts']
+            thread_ts=slack_resp_1['ts']
         )
     except Exception as e:
         logger.error(f"error: internal_server_error, error_description: failed to notify slack! | {e}")
-        respond(f"error: internal_server_error, error_description: failed to notify slack! | {e}")
+        await asyncio.to_thread(respond, f"error: internal_server_error, error_description: failed to notify slack! | {e}")
         return
 
     return
 
 
-if __name__ == "__main__":
+def init_feature_db():
+    # 起動時に用語集から特徴量データベースを作成する
+    # gunicorn から起動する場合は、ワーカープロセスを fork する前にマスタープロセスで一度だけ作成する（wsgi.py）
     logger.debug(f'AppConfig={vars(AppConfig)}')
     logger.debug(f'LLMConfig={vars(LLMConfig)}')
 
     # create csv file from spreadsheet
     spreadsheet = SpreadsheetClient(gcp_sa_key=AppConfig.gcp_sa_key)
     try:
+        revision = spreadsheet.get_revision(AppConfig.spreadsheet_key)
         worksheet = spreadsheet.get_worksheet(AppConfig.spreadsheet_key, AppConfig.spreadsheet_name)
         logger.debug(f'worksheet={worksheet}')
     except Exception as e:
@@ -337,12 +930,48 @@ if __name__ == "__main__":
         exit(1)
 
     # update feature db from csv
-    feature_db = update_db_from_csv(
-        file_path=AppConfig.dataset_path,
-        emb_model=emb_model,
-        chunk_size=AppConfig.chunk_size,
-        feature_db_type=LLMConfig.feature_db_type,
-    )
+    # 用語集に変更がない場合は、保存済みのスナップショットを読み込む
+    def build_feature_db_from_csv(current_feature_db):
+        feature_db = update_db_from_csv(
+            file_path=AppConfig.dataset_path,
+            emb_model=emb_model,
+            chunk_size=AppConfig.chunk_size,
+            feature_db_type=LLMConfig.feature_db_type,
+            snapshot_dir=AppConfig.snapshot_dir,
+        )
+        if feature_db is None:
+            logger.error(f"csv file has no rows! | path={AppConfig.dataset_path}")
+            return None
+        try:
+            spreadsheet_change_detector.update(revision, get_csv_row_hashes(AppConfig.dataset_path))
+        except Exception as e:
+            logger.warning(f"failed to save spreadsheet state! | {e}")
+
+        version = get_dataset_hash(AppConfig.dataset_path)
+        info = {'revision': revision}
+        try:
+            dataset_hash = get_feature_db_hash(AppConfig.dataset_path, emb_model, AppConfig.chunk_size, feature_db_type=LLMConfig.feature_db_type)
+            publish_snapshot(AppConfig.snapshot_dir, dataset_hash, version, {'revision': revision})
+            info['dataset_hash'] = dataset_hash
+        except Exception as e:
+            logger.warning(f"failed to publish feature db snapshot! | {e}")
+        return feature_db, version, info
+
+    if feature_db_holder.build(build_feature_db_from_csv) is None:
+        logger.error(f"failed to create feature db from csv file!")
+        exit(1)
+    return
+
+
+if __name__ == "__main__":
+    init_feature_db()
+
+    # 開発用サーバーでも、終了時に処理中の Slack コマンドの回答を生成し終えるまで待つ
+    def handle_sigterm(signum, frame):
+        drain()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
 
     # run flask-api
     flask_app.run(host=AppConfig.host, port=AppConfig.port)
@@ -0,0 +1,337 @@
+import asyncio
+import hashlib
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+import numpy as np
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun
+)
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+from langchain.schema.output import GenerationChunk
+
+from spreadsheet.client import SpreadsheetClient
+
+# 外部 API（OpenAI・SerpAPI・Slack・Google スプレッドシート）を使用せずにベンチマークを行うためのローカルのフェイク
+# 各フェイクは、固定の処理時間（＋ジッター）と失敗率を設定でき、同じ入力に対して常に同じ結果を返す
+
+
+class FakeAPIError(Exception):
+    pass
+
+
+class RateLimitError(FakeAPIError):
+    # db.ingestion.is_rate_limit_error でレート制限とみなされるように、OpenAI の例外と同じクラス名にする
+    http_status = 429
+
+
+class FaultInjector:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, failure_rate: float = 0.0, error_class=FakeAPIError, seed: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.error_class = error_class
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.n_calls = 0
+        self.n_failures = 0
+        return
+
+    def draw(self, latency: Optional[float] = None):
+        with self.lock:
+            self.n_calls += 1
+            jitter = self.random.uniform(-self.jitter, self.jitter) if self.jitter > 0 else 0.0
+            is_failed = self.failure_rate > 0 and self.random.random() < self.failure_rate
+            if is_failed:
+                self.n_failures += 1
+        return max(0.0, (self.latency if latency is None else latency) + jitter), is_failed
+
+    def __call__(self, latency: Optional[float] = None, timeout: Optional[float] = None):
+        # 処理時間だけ待機した後、失敗率に応じて例外を送出する
+        # timeout を指定した場合は、API クライアントのリクエストのタイムアウトと同じく timeout 秒で打ち切る
+        delay, is_failed = self.draw(latency)
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise self.error_class(f"injected timeout | timeout={timeout}")
+        time.sleep(delay)
+        if is_failed:
+            raise self.error_class(f"injected failure | failure_rate={self.failure_rate}")
+        return
+
+    async def acall(self, latency: Optional[float] = None):
+        # __call__ の非同期版（イベントループを止めずに待機する）
+        delay, is_failed = self.draw(latency)
+        await asyncio.sleep(delay)
+        if is_failed:
+            raise self.error_class(f"injected failure | failure_rate={self.failure_rate}")
+        return
+
+    def stats(self):
+        with self.lock:
+            return {"n_calls": self.n_calls, "n_failures": self.n_failures}
+
+
+def get_seed(text: str) -> int:
+    # hash() はプロセスごとに値が変わるので、sha256 から乱数のシードを作成する
+    return int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+
+
+class FakeLLM(LLM):
+    # langchain.llms.OpenAI の代わりに使用する LLM（プロンプトに応じた固定の回答を、トークンごとに遅延を入れて返す）
+    model_name: str = "fake"
+    temperature: float = 0.0
+    streaming: bool = False
+    latency: float = 0.2                # 最初のトークンを返すまでの時間 [sec]
+    token_latency: float = 0.005        # 2 トークン目以降の 1 トークンあたりの生成時間 [sec]
+    n_tokens: int = 32
+    failure_rate: float = 0.0
+    seed: int = 0
+    injector: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def get_injector(self):
+        if self.injector is None:
+            self.injector = FaultInjector(self.latency, failure_rate=self.failure_rate, seed=self.seed)
+        return self.injector
+
+    def get_tokens(self, prompt: str) -> List[str]:
+        rng = random.Random(get_seed(prompt))
+        return [f"回答{rng.randrange(1000)} " for _ in range(self.n_tokens)]
+
+    def _stream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[GenerationChunk]:
+        self.get_injector()(timeout=kwargs.get("request_timeout"))
+        for i, token in enumerate(self.get_tokens(prompt)):
+            if i > 0:
+                time.sleep(self.token_latency)
+            if run_manager is not None:
+                run_manager.on_llm_new_token(token)
+            yield GenerationChunk(text=token)
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return "".join(chunk.text for chunk in self._stream(prompt, stop, run_manager, **kwargs))
+
+    async def _astream(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[GenerationChunk]:
+        await self.get_injector().acall()
+        for i, token in enumerate(self.get_tokens(prompt)):
+            if i > 0:
+                await asyncio.sleep(self.token_latency)
+            if run_manager is not None:
+                await run_manager.on_llm_new_token(token)
+            yield GenerationChunk(text=token)
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> str:
+        return "".join([chunk.text async for chunk in self._astream(prompt, stop, run_manager, **kwargs)])
+
+
+class FakeEmbeddings(Embeddings):
+    # langchain.embeddings.openai.OpenAIEmbeddings の代わりに使用する埋め込みモデル（テキストのハッシュ値から単位ベクトルを作成する）
+    def __init__(
+        self,
+        model: str = "fake",
+        dim: int = 256,
+        latency: float = 0.05,
+        text_latency: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: int = 0,
+        **kwargs,
+    ):
+        self.model = model
+        self.dim = dim
+        self.text_latency = text_latency
+        # 失敗はレート制限（429）として返し、EmbeddingScheduler の再試行の処理時間も計測に含める
+        self.injector = FaultInjector(latency, failure_rate=failure_rate, error_class=RateLimitError, seed=seed)
+        return
+
+    def get_vector(self, text: str) -> List[float]:
+        vector = np.random.default_rng(get_seed(text)).standard_normal(self.dim, dtype=np.float32)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.injector(self.injector.latency + self.text_latency * len(texts))
+        return [self.get_vector(text) for text in texts]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        await self.injector.acall(self.injector.latency + self.text_latency * len(texts))
+        return [self.get_vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self.injector()
+        return self.get_vector(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        await self.injector.acall()
+        return self.get_vector(text)
+
+
+class FakeSerpAPIWrapper:
+    # langchain.utilities.SerpAPIWrapper の代わりに使用する Google 検索
+    def __init__(self, latency: float = 0.5, failure_rate: float = 0.0, seed: int = 0, **kwargs):
+        self.injector = FaultInjector(latency, failure_rate=failure_rate, seed=seed)
+        self.aiosession = None
+        return
+
+    def run(self, query: str, **kwargs) -> str:
+        self.injector()
+        return f"{query} の検索結果{get_seed(query) % 1000}"
+
+    async def arun(self, query: str, **kwargs) -> str:
+        await self.injector.acall()
+        return f"{query} の検索結果{get_seed(query) % 1000}"
+
+
+class FakeSlackClient:
+    # slack_sdk.WebClient の代わりに使用する Slack クライアント（投稿・更新したメッセージ数のみを数える）
+    def __init__(self, latency: float = 0.05, failure_rate: float = 0.0, seed: int = 0):
+        self.injector = FaultInjector(latency, failure_rate=failure_rate, seed=seed)
+        self.lock = threading.Lock()
+        self.n_posted = 0
+        self.n_updated = 0
+        return
+
+    def chat_postMessage(self, channel, text=None, **kwargs):
+        self.injector()
+        return self.count_posted(channel)
+
+    def chat_update(self, channel, ts, text=None, **kwargs):
+        self.injector()
+        return self.count_updated(channel, ts)
+
+    def count_posted(self, channel):
+        with self.lock:
+            self.n_posted += 1
+            ts = f"{time.time():.6f}.{self.n_posted}"
+        return {"ok": True, "channel": channel, "ts": ts}
+
+    def count_updated(self, channel, ts):
+        with self.lock:
+            self.n_updated += 1
+        return {"ok": True, "channel": channel, "ts": ts}
+
+    def stats(self):
+        with self.lock:
+            return {"n_posted": self.n_posted, "n_updated": self.n_updated, **self.injector.stats()}
+
+
+class FakeAsyncSlackClient:
+    # slack_sdk.web.async_client.AsyncWebClient の代わりに使用する（投稿・更新したメッセージ数は同期版のクライアントで数える）
+    def __init__(self, client: FakeSlackClient, **kwargs):
+        self.client = client
+        self.session = kwargs.get("session")
+        return
+
+    async def chat_postMessage(self, channel, text=None, **kwargs):
+        await self.client.injector.acall()
+        return self.client.count_posted(channel)
+
+    async def chat_update(self, channel, ts, text=None, **kwargs):
+        await self.client.injector.acall()
+        return self.client.count_updated(channel, ts)
+
+
+class FakeBoltApp:
+    # slack_bolt.App の代わりに使用する（App は初期化時に Slack API で認証を行うため）
+    def __init__(self, client: Optional[FakeSlackClient] = None, **kwargs):
+        self.client = client if client is not None else FakeSlackClient()
+        self.commands = {}
+        return
+
+    def command(self, name):
+        def decorator(func):
+            self.commands[name] = func
+            return func
+        return decorator
+
+
+class FakeWorksheet:
+    def __init__(self, rows: List[List[str]], injector: FaultInjector):
+        self.rows = rows
+        self.row_count = len(rows)
+        self.injector = injector
+        return
+
+    def get_values(self, range_name: str):
+        # "1:1000" 形式の行範囲のみに対応する
+        self.injector()
+        start, end = (int(row) for row in range_name.split(":"))
+        return [list(row) for row in self.rows[start - 1:end]]
+
+    def get_all_values(self):
+        self.injector()
+        return [list(row) for row in self.rows]
+
+
+class FakeSpreadsheetClient(SpreadsheetClient):
+    # spreadsheet.client.SpreadsheetClient の代わりに使用する（行範囲の取得・先読みの処理は本物の実装をそのまま使用する）
+    def __init__(self, rows: Optional[List[List[str]]] = None, latency: float = 0.1, failure_rate: float = 0.0, seed: int = 0, **kwargs):
+        self.rows = rows if rows is not None else []
+        self.version = 1
+        self.injector = FaultInjector(latency, failure_rate=failure_rate, seed=seed)
+        return
+
+    def set_rows(self, rows: List[List[str]]):
+        self.rows = rows
+        self.version += 1
+        return
+
+    def get_workbook(self, spreadsheet_key):
+        return self
+
+    def worksheet(self, spreadsheet_name):
+        return FakeWorksheet(self.rows, self.injector)
+
+    def get_revision(self, spreadsheet_key):
+        self.injector()
+        return {"modified_time": None, "version": str(self.version)}
+
+
+class FakeEncoding:
+    # tiktoken の BPE ファイルを取得できない（オフライン）環境で使用する、文字数からトークン数を近似するエンコーディング
+    def encode(self, text: str, **kwargs) -> List[int]:
+        # UTF-8 で 3 バイト以下の文字列を 1 トークンとする（トークン ID はバイト列の整数値なので decode で元に戻せる）
+        tokens, group = [], b""
+        for char in text:
+            data = char.encode("utf-8")
+            if len(group) + len(data) > 3:
+                tokens.append(int.from_bytes(group, "big"))
+                group = b""
+            group += data
+        if len(group) > 0:
+            tokens.append(int.from_bytes(group, "big"))
+        return tokens
+
+    def decode(self, tokens: List[int], **kwargs) -> str:
+        return b"".join(token.to_bytes((token.bit_length() + 7) // 8, "big") for token in tokens).decode("utf-8", errors="replace")
+
+    def encode_batch(self, texts: List[str], **kwargs) -> List[List[int]]:
+        return [self.encode(text) for text in texts]
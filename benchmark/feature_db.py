@@ -0,0 +1,189 @@
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+# 特徴量データベース（faiss・chroma・numpy）の作成時間・メモリ使用量・import 時間・検索レイテンシを比較する
+# python -m benchmark.feature_db --n_rows 10000 --dim 1536
+
+# アプリケーションが各バックエンドを使用する時に import するモジュール
+IMPORT_MODULES = {
+    "faiss": ["faiss", "langchain.vectorstores.faiss"],
+    "chroma": ["chromadb", "langchain.vectorstores.chroma"],
+    "numpy": ["db.numpy_store"],
+}
+
+
+class RandomEmbeddings(Embeddings):
+    def __init__(self, dim):
+        self.dim = dim
+
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        vector = np.random.default_rng(abs(hash(text)) % (1 << 32)).standard_normal(self.dim)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+
+def get_rss():
+    # 現在の RSS [byte]（Linux のみ）
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return 0
+
+
+def get_import_time(module_names):
+    # 他のモジュールの import の影響を受けないように、別プロセスで計測する
+    code = f"import time; t = time.perf_counter(); import {', '.join(module_names)}; print(time.perf_counter() - t)"
+    try:
+        return float(subprocess.run([sys.executable, "-c", code], capture_output=True, check=True, text=True).stdout)
+    except Exception:
+        return None
+
+
+def create_feature_db(feature_db_type, text_embeddings, emb_model):
+    texts = [text for text, _ in text_embeddings]
+    ids = [str(i) for i in range(len(texts))]
+    if feature_db_type == "faiss":
+        from langchain.vectorstores import FAISS
+
+        return FAISS.from_embeddings(text_embeddings, emb_model, ids=ids)
+    elif feature_db_type == "chroma":
+        from db.feature import create_chroma
+
+        feature_db = create_chroma(emb_model)
+        for start in range(0, len(texts), 5000):
+            feature_db._collection.upsert(
+                ids=ids[start:start + 5000],
+                embeddings=[embedding for _, embedding in text_embeddings[start:start + 5000]],
+                documents=texts[start:start + 5000],
+            )
+        return feature_db
+    else:
+        from db.numpy_store import NumpyVectorStore
+
+        return NumpyVectorStore.from_embeddings(text_embeddings, emb_model, ids=ids, dtype=feature_db_type.split("-")[1])
+
+
+def get_index_bytes(feature_db):
+    # 埋め込みベクトルの保持に使用しているバイト数（RSS の差分は他のオブジェクトの確保・解放の影響を受けるため、合わせて出力する）
+    from db.vectorstore import get_feature_db_type
+
+    feature_db_type = get_feature_db_type(feature_db)
+    if feature_db_type == "faiss":
+        import faiss
+
+        return int(faiss.serialize_index(feature_db.index).nbytes)
+    elif feature_db_type == "numpy":
+        return int(feature_db.vectors[:feature_db.n].nbytes + feature_db.scales[:feature_db.n].nbytes)
+    return None
+
+
+def search(feature_db, queries, k):
+    from db.numpy_store import NumpyVectorStore
+
+    if isinstance(feature_db, NumpyVectorStore):
+        return [[doc.page_content for doc, _ in docs] for docs in feature_db.similarity_search_with_score_by_vectors(queries.tolist(), k=k)]
+    return [[doc.page_content for doc in feature_db.similarity_search_by_vector(query.tolist(), k=k)] for query in queries]
+
+
+def run_benchmark(args, feature_db_type):
+    # バックエンドのモジュールは計測前に import し、メモリ使用量には特徴量データベースのみを含める
+    for module_name in IMPORT_MODULES[feature_db_type.split("-")[0]]:
+        __import__(module_name)
+
+    rng = np.random.default_rng(args.seed)
+    vectors = rng.standard_normal((args.n_rows, args.dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    texts = [f"用語: term{i}\n意味: meaning{i}" for i in range(args.n_rows)]
+    text_embeddings = list(zip(texts, vectors.tolist()))
+    # 用語集のいずれかの文章に近い質問文の埋め込みベクトル
+    noise = rng.standard_normal((args.n_queries, args.dim), dtype=np.float32) / np.sqrt(args.dim)
+    queries = vectors[rng.integers(0, args.n_rows, args.n_queries)] + 0.5 * noise
+    emb_model = RandomEmbeddings(args.dim)
+
+    # 正解（float32 の全件探索）の上位 k 件
+    scores = queries @ vectors.T
+    ground_truth = [set(texts[i] for i in np.argsort(-row)[:args.k]) for row in scores]
+    del scores
+
+    gc.collect()
+    rss = get_rss()
+    start_time = time.perf_counter()
+    feature_db = create_feature_db(feature_db_type, text_embeddings, emb_model)
+    build_time = time.perf_counter() - start_time
+    gc.collect()
+    memory = get_rss() - rss
+
+    # 1 件ずつ検索した場合のレイテンシ
+    latencies = []
+    retrieved = []
+    for query in queries:
+        start_time = time.perf_counter()
+        retrieved.extend(search(feature_db, query[None, :], args.k))
+        latencies.append(time.perf_counter() - start_time)
+
+    # まとめて検索した場合のスループット
+    start_time = time.perf_counter()
+    for start in range(0, len(queries), args.batch_size):
+        search(feature_db, queries[start:start + args.batch_size], args.k)
+    batch_time = time.perf_counter() - start_time
+
+    return {
+        "feature_db_type": feature_db_type,
+        "n_rows": args.n_rows,
+        "dim": args.dim,
+        "import_time": get_import_time(IMPORT_MODULES[feature_db_type.split("-")[0]]),
+        "build_time": build_time,
+        "memory_bytes": memory,
+        "index_bytes": get_index_bytes(feature_db),
+        "latency_p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "latency_p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "batch_queries_per_sec": len(queries) / batch_time,
+        "recall_at_k": float(np.mean([len(set(docs) & truth) / args.k for docs, truth in zip(retrieved, ground_truth)])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_rows", type=int, default=10000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--n_queries", type=int, default=200)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--feature_db_types", type=str, default="faiss,chroma,numpy-float32,numpy-float16,numpy-int8")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default=None)
+    args = parser.parse_args()
+
+    feature_db_types = args.feature_db_types.split(",")
+    if len(feature_db_types) == 1:
+        results = [run_benchmark(args, feature_db_types[0])]
+    else:
+        # 先に計測したバックエンドが確保したメモリの影響を受けないように、バックエンドごとに別プロセスで計測する
+        results = []
+        for feature_db_type in feature_db_types:
+            with tempfile.NamedTemporaryFile(suffix=".json") as f:
+                cmd = [sys.executable, "-m", "benchmark.feature_db", *sys.argv[1:], "--feature_db_types", feature_db_type, "--output", f.name]
+                subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+                results.extend(json.load(f))
+            print(json.dumps(results[-1], ensure_ascii=False), file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False)
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
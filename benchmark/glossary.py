@@ -0,0 +1,47 @@
+import csv
+import random
+from typing import List
+
+# ベンチマーク用の合成用語集（用語・意味・メタデータ）を作成する
+
+KATAKANA = "アイウエオカキクケコサシスセソタチツテトナニヌネノハヒフヘホマミムメモヤユヨラリルレロワン"
+WORDS = [
+    "データ", "モデル", "学習", "推論", "処理", "システム", "サーバー", "リクエスト", "レスポンス", "キャッシュ",
+    "ベクトル", "検索", "文章", "用語", "設定", "ユーザー", "ネットワーク", "ストレージ", "分散", "並列",
+]
+
+
+def get_term(i: int, rng: random.Random) -> str:
+    # 用語の重複を避けるため、末尾に行番号を付与する
+    return "".join(rng.choice(KATAKANA) for _ in range(rng.randint(3, 8))) + str(i)
+
+
+def get_meaning(rng: random.Random) -> str:
+    return "".join(f"{rng.choice(WORDS)}の{rng.choice(WORDS)}を{rng.choice(['行う', '表す', '管理する', '高速化する'])}。" for _ in range(rng.randint(1, 4)))
+
+
+def generate_glossary(n_rows: int, header: List[str] = ("用語", "意味", "メタデータ"), seed: int = 0) -> List[List[str]]:
+    # ヘッダー行を含む n_rows + 1 行を返す（同じ seed の場合は常に同じ内容）
+    rng = random.Random(seed)
+    rows = [list(header)]
+    for i in range(n_rows):
+        rows.append([get_term(i, rng), get_meaning(rng), f"category{rng.randrange(10)}"])
+    return rows
+
+
+def write_glossary_csv(rows: List[List[str]], file_path: str):
+    with open(file_path, "w", newline="") as f:
+        csv.writer(f).writerows(rows)
+    return file_path
+
+
+def generate_questions(rows: List[List[str]], n_questions: int, exact_ratio: float = 0.5, seed: int = 0) -> List[str]:
+    # 用語をそのまま含む質問（完全一致検索でヒットする）と、用語を含まない質問（ベクトル検索を行う）を混ぜる
+    rng = random.Random(seed)
+    questions = []
+    for i in range(n_questions):
+        if rng.random() < exact_ratio:
+            questions.append(f"{rows[rng.randrange(1, len(rows))][0]}とは何ですか？")
+        else:
+            questions.append(f"{rng.choice(WORDS)}の{rng.choice(WORDS)}について教えてください（{i}）")
+    return questions
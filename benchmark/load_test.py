@@ -0,0 +1,488 @@
+import argparse
+import functools
+import gc
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# 外部 API をローカルのフェイクに置き換えて、用語集の取り込み時間・検索レイテンシ・/chat の負荷試験時のレイテンシ・メモリ使用量を計測する
+# 計測結果は JSON で標準出力（--output を指定した場合はファイルにも）に出力する
+# python -m benchmark.load_test --n_rows 1000,10000,100000 --concurrency 8 --n_requests 200 --output results.json
+# 用語集の行数を複数指定した場合は、メモリ使用量を正しく計測するため行数ごとに別プロセスで計測する
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_rows", type=str, default="1000,10000")
+    parser.add_argument("--feature_db_type", type=str, default="faiss")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--n_queries", type=int, default=200)
+    parser.add_argument("--exact_ratio", type=float, default=0.5)
+    parser.add_argument("--n_requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--n_slack_commands", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="")
+    # フェイクの処理時間 [sec] と失敗率
+    parser.add_argument("--llm_latency", type=float, default=0.2)
+    parser.add_argument("--llm_token_latency", type=float, default=0.005)
+    parser.add_argument("--llm_n_tokens", type=int, default=32)
+    parser.add_argument("--llm_failure_rate", type=float, default=0.0)
+    parser.add_argument("--emb_latency", type=float, default=0.05)
+    parser.add_argument("--emb_text_latency", type=float, default=0.00001)
+    parser.add_argument("--emb_failure_rate", type=float, default=0.0)
+    parser.add_argument("--serpapi_latency", type=float, default=0.5)
+    parser.add_argument("--serpapi_failure_rate", type=float, default=0.0)
+    parser.add_argument("--slack_latency", type=float, default=0.05)
+    parser.add_argument("--slack_failure_rate", type=float, default=0.0)
+    parser.add_argument("--spreadsheet_latency", type=float, default=0.1)
+    parser.add_argument("--spreadsheet_failure_rate", type=float, default=0.0)
+    return parser.parse_args()
+
+
+def setup_env(work_dir, args):
+    # app.py の import 前に、ファイルの保存先を一時ディレクトリに変更する
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("OPENAI_API_KEY", "dummy")
+    os.environ.setdefault("SERPAPI_API_KEY", "dummy")
+    os.environ["DATASET_PATH"] = os.path.join(work_dir, "glossary.csv")
+    os.environ["EMB_CACHE_PATH"] = os.path.join(work_dir, "emb_cache.pkl")
+    os.environ["SPREADSHEET_STATE_PATH"] = os.path.join(work_dir, "spreadsheet_state.json")
+    os.environ["SNAPSHOT_DIR"] = os.path.join(work_dir, "snapshots")
+    os.environ["DATASET_TEXT_COLUMNS"] = "用語,意味"
+    os.environ["DATASET_META_COLUMNS"] = "メタデータ"
+    os.environ["DATASET_TERM_COLUMN"] = "用語"
+    os.environ["FEATURE_DB_TYPE"] = args.feature_db_type
+    # フェイクの LLM は Function calling に対応しないので、Agent は使用しない
+    os.environ["USE_FUNCTION_CALLING"] = "False"
+    return
+
+
+def install_fakes(args):
+    # app.py が import する外部 API のクライアントを、import 前にフェイクに置き換える
+    import langchain.embeddings.openai
+    import langchain.llms
+    import langchain.utilities
+    import slack_bolt
+    import slack_sdk.web.async_client
+    import tiktoken
+
+    import spreadsheet.client
+    from benchmark.fakes import (
+        FakeAsyncSlackClient,
+        FakeBoltApp,
+        FakeEmbeddings,
+        FakeEncoding,
+        FakeLLM,
+        FakeSerpAPIWrapper,
+        FakeSlackClient,
+        FakeSpreadsheetClient
+    )
+
+    langchain.llms.OpenAI = functools.partial(
+        FakeLLM,
+        latency=args.llm_latency,
+        token_latency=args.llm_token_latency,
+        n_tokens=args.llm_n_tokens,
+        failure_rate=args.llm_failure_rate,
+        seed=args.seed,
+    )
+    langchain.embeddings.openai.OpenAIEmbeddings = functools.partial(
+        FakeEmbeddings,
+        dim=args.dim,
+        latency=args.emb_latency,
+        text_latency=args.emb_text_latency,
+        failure_rate=args.emb_failure_rate,
+        seed=args.seed,
+    )
+    langchain.utilities.SerpAPIWrapper = functools.partial(
+        FakeSerpAPIWrapper, latency=args.serpapi_latency, failure_rate=args.serpapi_failure_rate, seed=args.seed
+    )
+    slack_client = FakeSlackClient(latency=args.slack_latency, failure_rate=args.slack_failure_rate, seed=args.seed)
+    slack_bolt.App = functools.partial(FakeBoltApp, client=slack_client)
+    slack_sdk.web.async_client.AsyncWebClient = functools.partial(FakeAsyncSlackClient, slack_client)
+    spreadsheet_client = FakeSpreadsheetClient(latency=args.spreadsheet_latency, failure_rate=args.spreadsheet_failure_rate, seed=args.seed)
+    spreadsheet.client.SpreadsheetClient = lambda *_args, **_kwargs: spreadsheet_client
+
+    # tiktoken の BPE ファイルを取得できない場合は、トークン数を近似するエンコーディングを使用する
+    try:
+        tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        tiktoken.get_encoding = lambda *_args, **_kwargs: FakeEncoding()
+        tiktoken.encoding_for_model = lambda *_args, **_kwargs: FakeEncoding()
+
+    # 計測結果の JSON と混ざらないように、アプリケーションのログは標準エラー出力に出力する
+    from utils.logger import get_handlers
+
+    for handler in get_handlers():
+        if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+            handler.setStream(sys.stderr)
+
+    return {"slack_client": slack_client, "spreadsheet_client": spreadsheet_client}
+
+
+def get_rss():
+    # 現在の RSS [byte]（Linux のみ）
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return 0
+
+
+def get_peak_rss():
+    # プロセス開始からの最大 RSS [byte]（Linux では ru_maxrss は KB 単位）
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_latency_stats(latencies):
+    if len(latencies) == 0:
+        return {}
+    latencies_ms = np.asarray(latencies) * 1000
+    return {
+        "n": len(latencies),
+        "mean_ms": float(np.mean(latencies_ms)),
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p95_ms": float(np.percentile(latencies_ms, 95)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "max_ms": float(np.max(latencies_ms)),
+    }
+
+
+def get_stage_stats(start_values):
+    # /chat の負荷試験中に記録された、ステージごとの平均処理時間
+    from utils.metrics import stage_seconds
+
+    stats = {}
+    with stage_seconds.lock:
+        values = {key: (total, count) for key, (_, total, count) in stage_seconds.values.items()}
+    for key, (total, count) in values.items():
+        start_total, start_count = start_values.get(key, (0.0, 0))
+        if count > start_count:
+            stats[dict(key)["stage"]] = {"n": count - start_count, "mean_ms": 1000 * (total - start_total) / (count - start_count)}
+    return stats, values
+
+
+def measure_ingestion(app, fakes, rows):
+    from config import AppConfig, LLMConfig
+    from db.feature import update_db_from_csv
+
+    app.emb_model.cache = {}
+    fakes["spreadsheet_client"].set_rows(rows)
+
+    # スプレッドシートからの取り込み（/update_db と同じ処理。行範囲ごとの読み込み・差分検出・スナップショットの保存を含む）
+    spreadsheet_client = fakes["spreadsheet_client"]
+    revision = spreadsheet_client.get_revision(AppConfig.spreadsheet_key)
+    worksheet = spreadsheet_client.get_worksheet(AppConfig.spreadsheet_key, AppConfig.spreadsheet_name)
+    rss = get_rss()
+    start_time = time.perf_counter()
+    app.build_feature_db(None, spreadsheet_client, worksheet, revision)
+    spreadsheet_time = time.perf_counter() - start_time
+    spreadsheet_rss = get_rss() - rss
+
+    # 書き出された csv ファイルからの取り込み（埋め込みベクトルのキャッシュなし・あり）
+    app.emb_model.cache = {}
+    gc.collect()
+    rss = get_rss()
+    start_time = time.perf_counter()
+    feature_db = update_db_from_csv(
+        file_path=AppConfig.dataset_path,
+        emb_model=app.emb_model,
+        chunk_size=AppConfig.chunk_size,
+        feature_db_type=LLMConfig.feature_db_type,
+    )
+    csv_time = time.perf_counter() - start_time
+    csv_rss = get_rss() - rss
+
+    start_time = time.perf_counter()
+    update_db_from_csv(
+        file_path=AppConfig.dataset_path,
+        emb_model=app.emb_model,
+        chunk_size=AppConfig.chunk_size,
+        feature_db_type=LLMConfig.feature_db_type,
+    )
+    csv_cached_time = time.perf_counter() - start_time
+
+    # 用語の索引の作成と特徴量データベースの切り替え
+    start_time = time.perf_counter()
+    app.feature_db_holder.build(lambda current_feature_db: (feature_db, f"benchmark-{len(rows) - 1}", {}))
+    swap_time = time.perf_counter() - start_time
+
+    return {
+        "spreadsheet_seconds": spreadsheet_time,
+        "csv_seconds": csv_time,
+        "csv_cached_seconds": csv_cached_time,
+        "index_and_swap_seconds": swap_time,
+        "spreadsheet_rss_bytes": spreadsheet_rss,
+        "csv_rss_bytes": csv_rss,
+        # EMB_MODEL_NAME=local-ngram の場合は、フェイクではなくローカルの埋め込みモデルを使用する
+        "embedding_calls": app.emb_scheduler.emb_model.injector.stats() if app.emb_scheduler is not None else None,
+    }
+
+
+def measure_retrieval(app, questions):
+    from qa.cache import normalize_question
+
+    current_db = app.feature_db_holder.get()
+    latencies = {"exact": [], "vector": []}
+    n_errors = 0
+    for question in questions:
+        # 質問文の埋め込みのキャッシュを使用しない状態で計測する
+        app.emb_model.query_cache.clear()
+        normalized_question = normalize_question(question)
+        start_time = time.perf_counter()
+        try:
+            app.answer_pipeline.retrieve(current_db.feature_db, normalized_question, current_db.lexical_index)
+        except Exception:
+            n_errors += 1
+            continue
+        elapsed_time = time.perf_counter() - start_time
+        is_exact = current_db.lexical_index is not None and len(current_db.lexical_index.search_exact(normalized_question, k=1)) > 0
+        latencies["exact" if is_exact else "vector"].append(elapsed_time)
+    return {"n_errors": n_errors, **{name: get_latency_stats(values) for name, values in latencies.items()}}
+
+
+def measure_chat(app, questions, n_requests, concurrency, stream):
+    import requests
+    from werkzeug.serving import make_server
+
+    from config import AppConfig
+
+    # 実際の HTTP サーバー（werkzeug のスレッドモード）を起動して、複数クライアントから並列に /chat を呼び出す
+    server = make_server("127.0.0.1", 0, app.flask_app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    url = f"http://127.0.0.1:{server.server_port}/chat"
+    local = threading.local()
+
+    def request_chat(i):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        # 回答キャッシュにヒットしないように、リクエストごとに質問文を変える
+        data = {"text": f"{questions[i % len(questions)]} #{i}", "token": AppConfig.slack_verify_token, "stream": str(stream).lower()}
+        start_time = time.perf_counter()
+        first_token_time = None
+        try:
+            resp = local.session.post(url, data=data, stream=stream, timeout=300)
+            is_succeeded = resp.status_code == 200
+            if stream:
+                for line in resp.iter_lines(decode_unicode=True):
+                    if line.startswith("data:") and first_token_time is None:
+                        first_token_time = time.perf_counter() - start_time
+                    if line.startswith("event: error"):
+                        is_succeeded = False
+            else:
+                resp.content
+        except Exception:
+            is_succeeded = False
+        return time.perf_counter() - start_time, first_token_time, is_succeeded
+
+    # 計測前のリクエストでの import・初期化の影響を除くため、1 リクエストだけ事前に送る
+    request_chat(n_requests)
+    _, start_stage_values = get_stage_stats({})
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(request_chat, range(n_requests)))
+    total_time = time.perf_counter() - start_time
+    server.shutdown()
+
+    succeeded = [result for result in results if result[2]]
+    return {
+        "n_requests": n_requests,
+        "concurrency": concurrency,
+        "stream": stream,
+        "requests_per_sec": n_requests / total_time,
+        "error_rate": 1 - len(succeeded) / n_requests,
+        "latency": get_latency_stats([result[0] for result in succeeded]),
+        "first_token_latency": get_latency_stats([result[1] for result in succeeded if result[1] is not None]),
+        "stages": get_stage_stats(start_stage_values)[0],
+    }
+
+
+def measure_batch(app, questions, batch_size, stream):
+    import requests
+    from werkzeug.serving import make_server
+
+    from config import AppConfig, LLMConfig
+
+    # 同じ質問文を /chat/batch でまとめて回答した場合と、/chat を 1 件ずつ順に呼び出した場合の処理時間を比較する
+    server = make_server("127.0.0.1", 0, app.flask_app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    session = requests.Session()
+    embedding_calls = app.base_emb_model.injector.stats if hasattr(app.base_emb_model, "injector") else (lambda: {"n_calls": 0})
+
+    def request_batch(batch_questions):
+        data = {"text": batch_questions, "token": AppConfig.slack_verify_token, "stream": str(stream).lower()}
+        start_time = time.perf_counter()
+        first_answer_time = None
+        resp = session.post(f"{url}/chat/batch", data=data, stream=stream, timeout=300)
+        if stream:
+            results = []
+            for line in resp.iter_lines(decode_unicode=True):
+                if len(line) > 0:
+                    first_answer_time = first_answer_time or time.perf_counter() - start_time
+                    results.append(json.loads(line))
+        else:
+            results = resp.json()["results"] if resp.status_code == 200 else []
+        n_errors = len(batch_questions) - sum("answer" in result for result in results)
+        return time.perf_counter() - start_time, first_answer_time, n_errors
+
+    # 回答キャッシュにヒットしないように、計測ごとに質問文を変える（表記ゆれのみの重複も 1 件ずつ含める）
+    batch_questions = [f"{questions[i % len(questions)]} (batch #{i})" for i in range(batch_size)]
+    batch_questions += [f"{question}　" for question in batch_questions[:batch_size // 10]]
+    request_batch([f"{questions[0]} (warmup)"])
+
+    n_calls = embedding_calls()["n_calls"]
+    batch_time, first_answer_time, n_errors = request_batch(batch_questions)
+    batch_embedding_calls = embedding_calls()["n_calls"] - n_calls
+
+    n_calls = embedding_calls()["n_calls"]
+    start_time = time.perf_counter()
+    for question in batch_questions:
+        session.post(f"{url}/chat", data={"text": f"{question} (loop)", "token": AppConfig.slack_verify_token}, timeout=300)
+    loop_time = time.perf_counter() - start_time
+    loop_embedding_calls = embedding_calls()["n_calls"] - n_calls
+    server.shutdown()
+
+    return {
+        "n_questions": len(batch_questions),
+        "max_concurrency": LLMConfig.batch_max_concurrency,
+        "stream": stream,
+        "batch_seconds": batch_time,
+        "batch_first_answer_seconds": first_answer_time,
+        "batch_questions_per_sec": len(batch_questions) / batch_time,
+        "batch_n_errors": n_errors,
+        "batch_embedding_calls": batch_embedding_calls,
+        "loop_seconds": loop_time,
+        "loop_questions_per_sec": len(batch_questions) / loop_time,
+        "loop_embedding_calls": loop_embedding_calls,
+    }
+
+
+def measure_slack(app, fakes, questions, n_commands):
+    from config import AppConfig
+
+    # Slack コマンドの回答生成（ワーカーの処理）を、ワーカー数と同じ並列数で実行する
+    # ASYNC_IO=True の場合は、全てのコマンドをイベントループで同時に処理する
+    errors = []
+    command = {"user_name": "benchmark", "channel_id": "C0BENCHMARK", "command": "/glossary-chat-bot"}
+
+    def answer(i):
+        start_time = time.perf_counter()
+        app.answer_by_slack(errors.append, command, f"{questions[i % len(questions)]} (slack #{i})")
+        return time.perf_counter() - start_time
+
+    async def aanswer(i):
+        start_time = time.perf_counter()
+        await app.answer_by_slack_async(errors.append, command, f"{questions[i % len(questions)]} (slack #{i})")
+        return time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    if AppConfig.use_async_io:
+        concurrency = n_commands
+        futures = [app.async_runner.submit(aanswer(i), check_limit=False) for i in range(n_commands)]
+        latencies = [future.result() for future in futures]
+    else:
+        concurrency = AppConfig.slack_num_workers
+        with ThreadPoolExecutor(max_workers=AppConfig.slack_num_workers) as executor:
+            latencies = list(executor.map(answer, range(n_commands)))
+    total_time = time.perf_counter() - start_time
+
+    return {
+        "n_commands": n_commands,
+        "concurrency": concurrency,
+        "commands_per_sec": n_commands / total_time,
+        "n_errors": len(errors),
+        "latency": get_latency_stats(latencies),
+        "slack_api": fakes["slack_client"].stats(),
+    }
+
+
+def run_benchmark(args, n_rows):
+    work_dir = tempfile.mkdtemp(prefix="glossary-benchmark-")
+    setup_env(work_dir, args)
+    fakes = install_fakes(args)
+
+    try:
+        start_time = time.perf_counter()
+        import app
+        import_time = time.perf_counter() - start_time
+
+        from benchmark.glossary import generate_glossary, generate_questions
+
+        rows = generate_glossary(n_rows, seed=args.seed)
+        questions = generate_questions(rows, args.n_queries, exact_ratio=args.exact_ratio, seed=args.seed)
+        rss = get_rss()
+
+        result = {"n_rows": n_rows, "feature_db_type": args.feature_db_type, "dim": args.dim, "import_seconds": import_time}
+        result["ingestion"] = measure_ingestion(app, fakes, rows)
+        result["memory"] = {"feature_db_rss_bytes": get_rss() - rss, "rss_bytes": get_rss(), "peak_rss_bytes": get_peak_rss()}
+        result["retrieval"] = measure_retrieval(app, questions)
+        result["chat"] = measure_chat(app, questions, args.n_requests, args.concurrency, args.stream)
+        if args.batch_size > 0:
+            result["batch"] = measure_batch(app, questions, args.batch_size, args.stream)
+        if args.n_slack_commands > 0:
+            result["slack"] = measure_slack(app, fakes, questions, args.n_slack_commands)
+        result["memory"]["peak_rss_bytes"] = get_peak_rss()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return result
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, check=True, text=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    args = parse_args()
+    n_rows_list = [int(n_rows) for n_rows in args.n_rows.split(",")]
+
+    if len(n_rows_list) == 1:
+        results = [run_benchmark(args, n_rows_list[0])]
+    else:
+        results = []
+        for n_rows in n_rows_list:
+            # 引数は後に指定した値が優先されるので、行数と出力先のみを上書きする
+            with tempfile.NamedTemporaryFile(suffix=".json") as f:
+                cmd = [sys.executable, "-m", "benchmark.load_test", *sys.argv[1:], "--n_rows", str(n_rows), "--output", f.name]
+                subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+                results.extend(json.load(f)["results"])
+            print(json.dumps(results[-1], ensure_ascii=False), file=sys.stderr)
+
+    report = {
+        "meta": {
+            "git_commit": get_git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
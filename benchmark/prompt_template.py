@@ -0,0 +1,67 @@
+import argparse
+import json
+import platform
+import time
+
+from langchain import PromptTemplate
+
+from prompt.prompt_template_registry import PromptTemplateRegistry
+
+# プロンプトテンプレートの format の処理時間を、LangChain の PromptTemplate と
+# コンパイル済みのテンプレート（PromptTemplateRegistry）で比較する
+# python -m benchmark.prompt_template --n_iters 100000
+
+
+def measure(func, n_iters, n_repeats):
+    # 最も速かった回の 1 回あたりの処理時間 [usec] を返す（他のプロセスの影響を除くため）
+    best = float("inf")
+    for _ in range(n_repeats):
+        start_time = time.perf_counter()
+        for _ in range(n_iters):
+            func()
+        best = min(best, time.perf_counter() - start_time)
+    return 1e6 * best / n_iters
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompt_dir", type=str, default="prompt/prompt_files")
+    parser.add_argument("--prompt_name", type=str, default="prompt_2")
+    parser.add_argument("--n_iters", type=int, default=100000)
+    parser.add_argument("--n_repeats", type=int, default=5)
+    parser.add_argument("--context_length", type=int, default=2000)
+    args = parser.parse_args()
+
+    question = "RAG とは何ですか？"
+    context = "用語: RAG\n意味: 検索した文章を LLM に入力して回答を生成する手法。\n" * (args.context_length // 40 + 1)
+    context = context[:args.context_length]
+
+    registry = PromptTemplateRegistry(args.prompt_dir, default_name=args.prompt_name, reload_interval=5.0)
+    compiled = registry.get()
+    langchain_template = PromptTemplate(template=compiled.template, input_variables=compiled.input_variables)
+    assert langchain_template.format(question=question, context=context) == compiled.format(question=question, context=context)
+
+    langchain_us = measure(lambda: langchain_template.format(question=question, context=context), args.n_iters, args.n_repeats)
+    compiled_us = measure(lambda: compiled.format(question=question, context=context), args.n_iters, args.n_repeats)
+    # リクエストごとにテンプレートの選択（ファイルの更新確認を含む）も行う場合
+    registry_us = measure(lambda: registry.get(args.prompt_name).format(question=question, context=context), args.n_iters, args.n_repeats)
+
+    report = {
+        "meta": {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python_version": platform.python_version(),
+            "args": vars(args),
+        },
+        "results": {
+            "langchain_prompt_template_us": langchain_us,
+            "compiled_template_us": compiled_us,
+            "registry_get_and_format_us": registry_us,
+            "speedup": langchain_us / compiled_us,
+        },
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -5,27 +5,85 @@ from distutils.util import strtobool
 class AppConfig:
     host = os.environ.get('HOST', '0.0.0.0')
     port = int(os.environ.get('PORT', '3000'))
+    num_workers = int(os.environ.get('NUM_WORKERS', '2'))                   # gunicorn のワーカープロセス数
+    num_threads = int(os.environ.get('NUM_THREADS', '8'))                   # 1 ワーカープロセスあたりのリクエスト処理スレッド数
+    worker_timeout = int(os.environ.get('WORKER_TIMEOUT', '300'))           # 1 リクエストの処理時間の上限 [sec]
+    graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', '10'))        # 終了時に処理中の回答を待つ時間の上限 [sec]
+    use_async_io = strtobool(os.environ.get('ASYNC_IO', 'True'))           # LLM・埋め込み・Slack API の呼び出しをイベントループで非同期に行うかどうか
+    async_max_concurrency = int(os.environ.get('ASYNC_MAX_CONCURRENCY', '256'))  # 1 ワーカープロセスあたりの同時に処理する質問数の上限（ASYNC_IO=True の場合）
+    async_max_connections = int(os.environ.get('ASYNC_MAX_CONNECTIONS', '100'))  # 共有 HTTP セッションの接続プールの上限数（ASYNC_IO=True の場合）
+    batch_max_questions = int(os.environ.get('BATCH_MAX_QUESTIONS', '100'))          # /chat/batch の 1 リクエストあたりの質問数の上限
+    feature_db_sync_interval = float(os.environ.get('FEATURE_DB_SYNC_INTERVAL', '5.0'))  # 他のワーカーが更新した特徴量データベースを確認する間隔 [sec]
     gcp_sa_key = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS', '/app/credentials/glossary-llm-chat-bot-sa.json')
     spreadsheet_key = os.environ.get('SPREADSHEET_KEY', 'dummy')
     spreadsheet_name = os.environ.get('SPREADSHEET_NAME', 'dummy')
     dataset_path = os.environ.get('DATASET_PATH', '/app/dataset/glossary.csv')
+    emb_cache_path = os.environ.get('EMB_CACHE_PATH', '/app/dataset/emb_cache.pkl')
+    spreadsheet_state_path = os.environ.get('SPREADSHEET_STATE_PATH', '/app/dataset/spreadsheet_state.json')
+    snapshot_dir = os.environ.get('SNAPSHOT_DIR', '/app/dataset/snapshots')
     dataset_text_columns = str(os.environ.get('DATASET_TEXT_COLUMNS', "用語,意味")).split(',')
+    dataset_term_column = os.environ.get('DATASET_TERM_COLUMN', '用語')   # 完全一致・n-gram 検索を行う用語の列名（空文字の場合は使用しない）
     dataset_meta_columns = str(os.environ.get('DATASET_META_COLUMNS', "メタデータ")).split(',')
+    dataset_page_size = int(os.environ.get('DATASET_PAGE_SIZE', '1000'))     # スプレッドシートから一度に読み込む行数
     chunk_size = int(os.environ.get('CHUNK_SIZE', '2000'))
     slack_bot_token = os.environ.get('SLACK_BOT_TOKEN', 'dummy')
     slack_signing_token = os.environ.get('SLACK_SIGNING_SECRET', 'dummy')
     slack_verify_token = os.environ.get('SLACK_VERIFY_TOKEN', 'dummy')
+    slack_num_workers = int(os.environ.get('SLACK_NUM_WORKERS', '4'))       # Slack コマンドの回答を生成するワーカー数
+    slack_queue_size = int(os.environ.get('SLACK_QUEUE_SIZE', '100'))       # Slack コマンドの待ち行列の上限数
+    slack_streaming = strtobool(os.environ.get('SLACK_STREAMING', 'True'))  # 回答の生成途中で Slack メッセージを逐次更新するかどうか
+    slack_update_interval = float(os.environ.get('SLACK_UPDATE_INTERVAL', '1.0'))  # Slack メッセージの更新間隔 [sec]
+    slack_timeout = float(os.environ.get('SLACK_TIMEOUT', '10'))                   # Slack API の 1 呼び出しあたりのタイムアウト [sec]
 
 
 class PromptConfig:
-    prompt_file_path = os.environ.get('PROMPT_FILE_PATH', 'prompt/prompt_files/prompt_2.yml')
+    prompt_file_path = os.environ.get('PROMPT_FILE_PATH', 'prompt/prompt_files/prompt_2.yml')      # デフォルトのテンプレート
+    prompt_dir = os.environ.get('PROMPT_DIR', os.path.dirname(prompt_file_path))                    # テンプレートを読み込むディレクトリ
+    prompt_reload_interval = float(os.environ.get('PROMPT_RELOAD_INTERVAL', '5.0'))                 # テンプレートファイルの更新を確認する間隔 [sec]（0 の場合は確認しない）
+    prompt_channel_templates = dict(                                                                # Slack のチャンネルごとのテンプレート名（"チャンネルID:テンプレート名,..."）
+        item.strip().split(':', 1) for item in os.environ.get('PROMPT_CHANNEL_TEMPLATES', '').split(',') if ':' in item
+    )
 
 
 class LLMConfig:
-    emb_model_name = os.environ.get('EMB_MODEL_NAME', 'text-embedding-ada-002')
+    emb_model_name = os.environ.get('EMB_MODEL_NAME', 'text-embedding-ada-002')       # "text-embedding-ada-002" etc or "local-ngram"（CPU で埋め込む）
+    emb_local_dim = int(os.environ.get('EMB_LOCAL_DIM', '1024'))                        # ローカルの埋め込みモデルの次元数（EMB_MODEL_NAME=local-ngram の場合）
+    emb_local_num_workers = int(os.environ.get('EMB_LOCAL_NUM_WORKERS', str(os.cpu_count() or 1)))  # ローカルの埋め込みモデルで用語集を埋め込むプロセス数
     model_name = os.environ.get('MODEL_NAME', 'gpt-3.5-turbo-0613')         # "text-davinci-003", "gpt-3.5-turbo", "gpt-3.5-turbo-0613" etc
     temperature = float(os.environ.get('TEMPERATURE', '0.0'))
     retriever_top_k = int(os.environ.get('RETRIEVER_TOP_K', '4'))
-    retriever_score_threshold = float(os.environ.get('RETRIEVER_SCORE_THRESHOLD', '0.7'))
-    feature_db_type = os.environ.get('FEATURE_DB_TYPE', 'faiss')                        # "chroma" or "faiss"
+    # ローカルの埋め込みモデル（文字 n-gram）は OpenAI の埋め込みモデルより類似度が全体的に低くなるので、デフォルトの閾値を下げる
+    retriever_score_threshold = float(os.environ.get('RETRIEVER_SCORE_THRESHOLD', '0.3' if emb_model_name.startswith('local-') else '0.7'))
+    retriever_exact_match_min_length = int(os.environ.get('RETRIEVER_EXACT_MATCH_MIN_LENGTH', '2'))    # 質問文中の用語の完全一致とみなす最小文字数
+    retriever_lexical_min_coverage = float(os.environ.get('RETRIEVER_LEXICAL_MIN_COVERAGE', '0.5'))    # 用語の n-gram のうち質問文に含まれる割合の下限
+    context_max_tokens = int(os.environ.get('CONTEXT_MAX_TOKENS', '1500'))                            # プロンプトに入れる検索文章のトークン数の上限（0 の場合は上限なし）
+    feature_db_type = os.environ.get('FEATURE_DB_TYPE', 'faiss')                        # "chroma", "faiss" or "numpy"
+    # float16・int8 は埋め込みベクトルのメモリ使用量が 1/2・1/4 になる代わりに、検索の度に float32 に戻すので検索が遅くなる（float16 は float32 の数倍）
+    numpy_db_dtype = os.environ.get('NUMPY_DB_DTYPE', 'float32')                        # "float32", "float16" or "int8"（FEATURE_DB_TYPE=numpy の場合）
+    emb_max_workers = int(os.environ.get('EMB_MAX_WORKERS', '4'))                              # 埋め込み API の並列リクエスト数
+    emb_requests_per_minute = float(os.environ.get('EMB_REQUESTS_PER_MINUTE', '3000'))          # 埋め込み API のリクエスト数の上限 [/min]
+    emb_tokens_per_minute = float(os.environ.get('EMB_TOKENS_PER_MINUTE', '1000000'))           # 埋め込み API のトークン数の上限 [/min]
+    emb_batch_tokens = int(os.environ.get('EMB_BATCH_TOKENS', '100000'))                        # 埋め込み API の 1 リクエストあたりのトークン数の上限
+    emb_batch_size = int(os.environ.get('EMB_BATCH_SIZE', '1000'))                              # 埋め込み API の 1 リクエストあたりのテキスト数の上限
+    emb_max_retries = int(os.environ.get('EMB_MAX_RETRIES', '6'))                               # 埋め込み API がレート制限された場合の再試行回数
+    query_emb_cache_size = int(os.environ.get('QUERY_EMB_CACHE_SIZE', '1024'))                  # 質問文の埋め込みベクトルの LRU キャッシュサイズ
+    answer_cache_size = int(os.environ.get('ANSWER_CACHE_SIZE', '1024'))                        # 回答キャッシュサイズ（0 の場合はキャッシュしない）
+    answer_cache_ttl = float(os.environ.get('ANSWER_CACHE_TTL', '3600'))                        # 回答キャッシュの有効期限 [sec]
+    answer_cache_similarity_threshold = float(os.environ.get('ANSWER_CACHE_SIMILARITY_THRESHOLD', '0.0'))  # 言い回しが異なる質問文に回答キャッシュを使用する類似度（0 の場合は使用しない）
+    use_single_flight = strtobool(os.environ.get('SINGLE_FLIGHT', 'True'))                     # 処理中の同じ質問には、上流の API を呼び出さずに処理中の回答を共有するかどうか
     use_function_calling = strtobool(os.environ.get('USE_FUNCTION_CALLING', 'True'))    # Function calling を使用して RAG を使用しない一般的な質問応答をできるようにするかどうか
+    use_confidence_routing = strtobool(os.environ.get('CONFIDENCE_ROUTING', 'True'))    # 用語集の検索結果の類似度が高い質問は、Function calling を使用せずに RAG で回答するかどうか
+    # Function calling を使用せずに RAG で回答する類似度（用語の完全一致の場合は 1.0）。RETRIEVER_SCORE_THRESHOLD と同じく埋め込みモデルによってデフォルト値を変える
+    route_confidence_threshold = float(os.environ.get('ROUTE_CONFIDENCE_THRESHOLD', '0.45' if emb_model_name.startswith('local-') else '0.8'))
+    request_timeout = float(os.environ.get('REQUEST_TIMEOUT', '60'))                 # 1 質問あたりの回答生成の期限 [sec]（0 の場合は期限なし）
+    hedge_delay = float(os.environ.get('HEDGE_DELAY', '3.0'))                         # Agent が回答を返し始めない場合に、並行して RAG で回答し始めるまでの時間 [sec]（負の値の場合は並行しない）
+    call_max_workers = int(os.environ.get('CALL_MAX_WORKERS', '32'))                 # 期限までのみ待つ同期の呼び出し（埋め込み・Agent）を実行するスレッド数の上限（ASYNC_IO=False の場合）
+    hedge_max_workers = int(os.environ.get('HEDGE_MAX_WORKERS', '32'))               # Agent と RAG を並行して実行するスレッド数の上限（ASYNC_IO=False の場合）
+    batch_max_concurrency = int(os.environ.get('BATCH_MAX_CONCURRENCY', '8'))         # /chat/batch の 1 リクエストあたりの回答を並列に生成する質問数の上限
+    use_circuit_breaker = strtobool(os.environ.get('CIRCUIT_BREAKER', 'True'))       # Agent・Google 検索のエラー・遅延が続いている場合に、一定時間呼び出しを止めるかどうか
+    circuit_breaker_window_size = int(os.environ.get('CIRCUIT_BREAKER_WINDOW_SIZE', '20'))                  # エラー率・遅延率を計算する直近の呼び出し数
+    circuit_breaker_min_calls = int(os.environ.get('CIRCUIT_BREAKER_MIN_CALLS', '5'))
+    circuit_breaker_failure_rate = float(os.environ.get('CIRCUIT_BREAKER_FAILURE_RATE', '0.5'))
+    circuit_breaker_slow_call_duration = float(os.environ.get('CIRCUIT_BREAKER_SLOW_CALL_DURATION', '20'))  # 遅延とみなす処理時間 [sec]
+    circuit_breaker_slow_call_rate = float(os.environ.get('CIRCUIT_BREAKER_SLOW_CALL_RATE', '0.5'))
+    circuit_breaker_open_duration = float(os.environ.get('CIRCUIT_BREAKER_OPEN_DURATION', '30'))            # 呼び出しを止める時間 [sec]
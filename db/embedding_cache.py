@@ -0,0 +1,191 @@
+import hashlib
+import os
+import pickle
+import threading
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from langchain.embeddings.base import Embeddings
+
+from utils.cache import TTLCache
+from utils.logger import logger
+from utils.metrics import count_event, span
+
+# 非同期に埋め込んだ質問文のベクトル（同じコンテキスト内の embed_query で、再度埋め込まずに返す）
+pinned_query_embedding = ContextVar("pinned_query_embedding", default=None)
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(
+        self,
+        emb_model: Embeddings,
+        model_name: str,
+        cache_path: Optional[str] = None,
+        query_cache_size: int = 0,
+        scheduler=None,
+    ):
+        self.emb_model = emb_model
+        self.scheduler = scheduler
+        self.model_name = model_name
+        self.cache_path = cache_path
+        # 同じ質問文の埋め込みベクトルは LRU キャッシュから返す
+        self.query_cache = TTLCache(maxsize=query_cache_size)
+        self.cache: Dict[str, List[float]] = {}
+        self.lock = threading.Lock()
+        self.load()
+        return
+
+    def get_key(self, text: str) -> str:
+        # 埋め込みモデルが変わった場合に別の埋め込みベクトルとして扱うため、モデル名もハッシュ値に含める
+        return hashlib.sha256(f"{self.model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def iter_embed_documents(self, texts: List[str]):
+        keys = [self.get_key(text) for text in texts]
+
+        # キャッシュに存在しない（新規追加 or 修正された）テキストのみ埋め込みモデルで埋め込む
+        hit_indices = []
+        missing_indices = {}
+        with self.lock:
+            for i, key in enumerate(keys):
+                if key in self.cache:
+                    hit_indices.append(i)
+                else:
+                    missing_indices.setdefault(key, []).append(i)
+        logger.info(f"embedding cache | hit={len(hit_indices)} miss={len(missing_indices)}")
+
+        if len(hit_indices) > 0:
+            with self.lock:
+                yield hit_indices, [self.cache[keys[i]] for i in hit_indices]
+
+        if len(missing_indices) > 0:
+            missing_keys = list(missing_indices.keys())
+            missing_texts = [texts[indices[0]] for indices in missing_indices.values()]
+            if self.scheduler is not None:
+                batches = self.scheduler.iter_embed_documents(missing_texts)
+            else:
+                batches = [(list(range(len(missing_texts))), self.emb_model.embed_documents(missing_texts))]
+
+            # 埋め込みが完了したバッチから順に返す
+            for batch_indices, vectors in batches:
+                batch_keys = [missing_keys[i] for i in batch_indices]
+                with self.lock:
+                    self.cache.update(zip(batch_keys, vectors))
+                indices = [i for key in batch_keys for i in missing_indices[key]]
+                yield indices, [vector for key, vector in zip(batch_keys, vectors) for _ in missing_indices[key]]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [None] * len(texts)
+        for indices, batch_vectors in self.iter_embed_documents(texts):
+            for i, vector in zip(indices, batch_vectors):
+                vectors[i] = vector
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        pinned = pinned_query_embedding.get()
+        if pinned is not None and pinned[0] == text:
+            return pinned[1]
+
+        vector = self.query_cache.get(text)
+        if vector is None:
+            count_event("query_embedding_cache", result="miss")
+            with span("query_embedding"):
+                vector = self.emb_model.embed_query(text)
+            self.query_cache.set(text, vector)
+        else:
+            count_event("query_embedding_cache", result="hit")
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        vector = self.query_cache.get(text)
+        if vector is None:
+            count_event("query_embedding_cache", result="miss")
+            with span("query_embedding"):
+                vector = await self.emb_model.aembed_query(text)
+            self.query_cache.set(text, vector)
+        else:
+            count_event("query_embedding_cache", result="hit")
+        return vector
+
+    def get_missing_queries(self, texts: List[str]):
+        # 質問文の埋め込みのキャッシュに存在しない質問文のみを返す（重複した質問文は 1 つにまとめる）
+        vectors = {}
+        for text in dict.fromkeys(texts):
+            vector = self.query_cache.get(text)
+            count_event("query_embedding_cache", result="miss" if vector is None else "hit")
+            if vector is not None:
+                vectors[text] = vector
+        return vectors, [text for text in dict.fromkeys(texts) if text not in vectors]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        # 複数の質問文を、1 回の埋め込みモデルの呼び出し（バッチ）でまとめて埋め込む
+        vectors, missing_texts = self.get_missing_queries(texts)
+        if len(missing_texts) > 0:
+            with span("query_embedding"):
+                missing_vectors = self.emb_model.embed_documents(missing_texts)
+            for text, vector in zip(missing_texts, missing_vectors):
+                self.query_cache.set(text, vector)
+                vectors[text] = vector
+        return [vectors[text] for text in texts]
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        vectors, missing_texts = self.get_missing_queries(texts)
+        if len(missing_texts) > 0:
+            with span("query_embedding"):
+                missing_vectors = await self.emb_model.aembed_documents(missing_texts)
+            for text, vector in zip(missing_texts, missing_vectors):
+                self.query_cache.set(text, vector)
+                vectors[text] = vector
+        return [vectors[text] for text in texts]
+
+    @contextmanager
+    def pin_query_embedding(self, text: str, vector: List[float]):
+        # 特徴量データベースの検索（同期処理）の中で呼び出される embed_query に、非同期に埋め込んだベクトルを渡す
+        token = pinned_query_embedding.set((text, vector))
+        try:
+            yield
+        finally:
+            pinned_query_embedding.reset(token)
+
+    def prune(self, keep_keys) -> int:
+        # 用語集から削除されたテキストの埋め込みベクトルをキャッシュから削除
+        with self.lock:
+            delete_keys = [key for key in self.cache if key not in keep_keys]
+            for key in delete_keys:
+                del self.cache[key]
+        return len(delete_keys)
+
+    def load(self):
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return
+
+        try:
+            with open(self.cache_path, "rb") as f:
+                cache = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"failed to load embedding cache! | {e}")
+            return
+
+        with self.lock:
+            self.cache = cache
+        logger.info(f"loaded embedding cache | path={self.cache_path} size={len(cache)}")
+        return
+
+    def save(self):
+        if self.cache_path is None:
+            return
+
+        # 書き込み途中のファイルを読み込まないように、一時ファイルに書き込んだ後に置き換える
+        # 複数のワーカープロセスが同時に保存しても互いの一時ファイルを上書きしないように、一時ファイル名は保存ごとに変える
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp_path = f"{self.cache_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with self.lock:
+                with open(tmp_path, "wb") as f:
+                    pickle.dump(self.cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return
@@ -0,0 +1,126 @@
+import math
+import os
+import threading
+import unicodedata
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+from utils.logger import logger
+
+# 埋め込みモデルのバックエンド
+# EMB_MODEL_NAME が "local-" から始まる場合は外部 API を使用せずに CPU で埋め込みを行い、それ以外の場合は OpenAI の埋め込み API を使用する
+LOCAL_EMB_MODEL_PREFIX = "local-"
+
+
+def is_local_emb_model(model_name: str) -> bool:
+    return model_name.startswith(LOCAL_EMB_MODEL_PREFIX)
+
+
+def get_emb_model(model_name: str, **kwargs) -> Embeddings:
+    if model_name == "local-ngram":
+        return HashedNgramEmbeddings(**kwargs)
+    elif is_local_emb_model(model_name):
+        raise ValueError(f"unsupported local embedding model! | model_name={model_name}")
+
+    # OpenAI の埋め込みモデルを使用する場合のみ import する
+    from langchain.embeddings.openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(model=model_name, **kwargs)
+
+
+def get_ngram_features(text: str, dim: int, ngram_range: Tuple[int, int], feature_cache: dict) -> Tuple[List[int], List[float]]:
+    # 文字 n-gram をハッシュ値で dim 次元のいずれかに割り当てる（feature hashing）
+    # 符号もハッシュ値から決めることで、異なる n-gram が同じ次元に割り当てられた場合の偏りを打ち消す
+    # hash() はプロセスごとに値が変わるので、複数のワーカープロセス・スナップショット間で同じ値になる crc32 を使用する
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = " ".join(text.split())
+    counts = {}
+    for n in range(ngram_range[0], ngram_range[1] + 1):
+        for i in range(len(text) - n + 1):
+            ngram = text[i:i + n]
+            counts[ngram] = counts.get(ngram, 0) + 1
+
+    indices, weights = [], []
+    for ngram, count in counts.items():
+        feature = feature_cache.get(ngram)
+        if feature is None:
+            hash_value = zlib.crc32(ngram.encode("utf-8"))
+            feature = (hash_value % dim, 1.0 if hash_value & 0x80000000 else -1.0)
+            if len(feature_cache) < 1000000:
+                feature_cache[ngram] = feature
+        indices.append(feature[0])
+        # 長い文章で頻出する n-gram の影響が大きくなりすぎないように、出現回数は対数で重み付けする
+        weights.append(feature[1] * (1.0 + math.log(count)))
+    return indices, weights
+
+
+# n-gram ごとのハッシュ値のキャッシュ（プロセスごと）
+ngram_feature_cache = {}
+
+
+def encode_ngram_batch(texts: List[str], dim: int, ngram_range: Tuple[int, int]) -> np.ndarray:
+    # 複数プロセスで実行できるように、モジュールレベルの関数にする
+    # 全てのテキストの特徴量を 1 つの配列にまとめて、bincount でまとめてベクトルに加算する
+    flat_indices, flat_weights = [], []
+    for i, text in enumerate(texts):
+        indices, weights = get_ngram_features(text, dim, ngram_range, ngram_feature_cache)
+        flat_indices.extend(i * dim + index for index in indices)
+        flat_weights.extend(weights)
+    vectors = np.bincount(flat_indices, weights=flat_weights, minlength=len(texts) * dim).astype(np.float32).reshape(len(texts), dim)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class HashedNgramEmbeddings(Embeddings):
+    def __init__(
+        self,
+        dim: int = 1024,
+        ngram_range: Tuple[int, int] = (1, 3),
+        num_workers: int = 1,
+        batch_size: int = 1000,
+    ):
+        # 外部 API を使用しない、CPU のみで計算する埋め込みモデル（文字 n-gram の feature hashing）
+        # 日本語は単語の区切りがないので、形態素解析を行わずに文字 n-gram を特徴量とする
+        self.dim = dim
+        self.ngram_range = tuple(ngram_range)
+        self.num_workers = num_workers                  # 用語集の埋め込みを行うプロセス数（1 の場合は呼び出し元のスレッドで行う）
+        self.batch_size = batch_size                    # 1 プロセスに渡すテキスト数
+        self.model_name = f"local-ngram-{dim}-{self.ngram_range[0]}-{self.ngram_range[1]}"
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        return
+
+    def get_executor(self):
+        # プロセスプールは fork 後の子プロセスに引き継がれないので、最初の呼び出し時にプロセスごとに作成する
+        with self.lock:
+            if self.pid != os.getpid():
+                self.executor = ProcessPoolExecutor(max_workers=self.num_workers)
+                self.pid = os.getpid()
+            return self.executor
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if len(texts) == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        if self.num_workers <= 1 or len(texts) <= self.batch_size:
+            return encode_ngram_batch(texts, self.dim, self.ngram_range)
+
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        logger.debug(f"encode ngram embeddings | n_texts={len(texts)} n_batches={len(batches)} num_workers={self.num_workers}")
+        executor = self.get_executor()
+        results = executor.map(encode_ngram_batch, batches, [self.dim] * len(batches), [self.ngram_range] * len(batches))
+        return np.concatenate(list(results), axis=0)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return encode_ngram_batch([text], self.dim, self.ngram_range)[0].tolist()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        # 1 ミリ秒未満で終わるので、スレッドプールを介さずにイベントループ内で計算する
+        return self.embed_query(text)
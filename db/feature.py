@@ -1,36 +1,217 @@
+import hashlib
+import json
+import uuid
+
 from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import FAISS, Chroma
 
-from config import AppConfig
+from config import AppConfig, LLMConfig
+from db.embedding_cache import CachedEmbeddings
+from db.snapshot import get_dataset_hash, load_snapshot, save_snapshot
+from db.vectorstore import get_feature_db_type
 from utils.csv_loader import CSVLoader
-from utils.logger import logger
+from utils.logger import Payload, logger
 
+# 行の追加・削除でずれる位置のメタデータ（csv の行番号）
+POSITIONAL_METADATA_KEYS = ("row",)
 
-def update_db_from_csv(file_path, emb_model, chunk_size=1000, chunk_overlap=0, separator="\n", feature_db_type="chroma"):
-    # Document Loaders を使用して csv ファイル読み込み
-    document_loader = CSVLoader(
+
+def get_document_id(document):
+    # 分割文章の内容（テキスト＋位置以外のメタデータ）のハッシュ値を VectorDB 内の ID として使用する
+    # 行番号は ID に含めず、前の行が追加・削除されて位置がずれただけの分割文章は再度埋め込まない
+    metadata = {key: value for key, value in document.metadata.items() if key not in POSITIONAL_METADATA_KEYS}
+    content = json.dumps([document.page_content, metadata], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def get_feature_db_ids(feature_db):
+    feature_db_type = get_feature_db_type(feature_db)
+    if feature_db_type == "faiss":
+        return set(feature_db.index_to_docstore_id.values())
+    elif feature_db_type == "chroma":
+        return set(feature_db.get(include=[])["ids"])
+    else:
+        return set(feature_db.ids)
+
+
+def create_chroma(emb_model):
+    from langchain.vectorstores import Chroma
+
+    # インメモリの Chroma クライアントは同じ設定のクライアント間でコレクションを共有するので、特徴量データベースごとに別のコレクションを作成する
+    return Chroma(collection_name=f"glossary-{uuid.uuid4().hex}", embedding_function=emb_model)
+
+
+def copy_feature_db(feature_db, emb_model):
+    # 検索中の特徴量データベースを更新しないように、複製した特徴量データベースに差分を反映する
+    feature_db_type = get_feature_db_type(feature_db)
+    if feature_db_type == "faiss":
+        import faiss
+        from langchain.docstore.in_memory import InMemoryDocstore
+        from langchain.vectorstores import FAISS
+
+        return FAISS(
+            feature_db.embedding_function,
+            # clone_index はメモリマップしたスナップショットのベクトルを参照したままになる（追加すると異常終了する）ので、シリアライズして複製する
+            faiss.deserialize_index(faiss.serialize_index(feature_db.index)),
+            InMemoryDocstore(dict(feature_db.docstore._dict)),
+            dict(feature_db.index_to_docstore_id),
+            relevance_score_fn=feature_db.override_relevance_score_fn,
+            normalize_L2=feature_db._normalize_L2,
+            distance_strategy=feature_db.distance_strategy,
+        )
+    elif feature_db_type == "chroma":
+        data = feature_db.get(include=["embeddings", "documents", "metadatas"])
+        new_feature_db = create_chroma(emb_model)
+        if len(data["ids"]) > 0:
+            new_feature_db._collection.upsert(
+                ids=data["ids"], embeddings=data["embeddings"], documents=data["documents"], metadatas=data["metadatas"]
+            )
+        return new_feature_db
+    else:
+        return feature_db.copy()
+
+
+def iter_embed_documents(emb_model, texts):
+    if hasattr(emb_model, "iter_embed_documents"):
+        yield from emb_model.iter_embed_documents(texts)
+    else:
+        yield list(range(len(texts))), emb_model.embed_documents(texts)
+
+
+def add_documents_to_db(feature_db, documents, ids, emb_model, feature_db_type="chroma"):
+    # 埋め込みが完了したバッチから順に、特徴量データベースに追加する
+    for indices, embeddings in iter_embed_documents(emb_model, [document.page_content for document in documents]):
+        texts = [documents[i].page_content for i in indices]
+        metadatas = [documents[i].metadata for i in indices]
+        batch_ids = [ids[i] for i in indices]
+        if feature_db is None:
+            # 設定したバックエンドのみを、最初に特徴量データベースを作成する時に import する
+            if feature_db_type == "faiss":
+                from langchain.vectorstores import FAISS
+
+                feature_db = FAISS.from_embeddings(list(zip(texts, embeddings)), emb_model, metadatas=metadatas, ids=batch_ids)
+                continue
+            elif feature_db_type == "numpy":
+                from db.numpy_store import NumpyVectorStore
+
+                feature_db = NumpyVectorStore(emb_model, dtype=LLMConfig.numpy_db_dtype)
+            else:
+                feature_db = create_chroma(emb_model)
+
+        if get_feature_db_type(feature_db) in ("faiss", "numpy"):
+            feature_db.add_embeddings(list(zip(texts, embeddings)), metadatas=metadatas, ids=batch_ids)
+        else:
+            # 埋め込み済みのベクトルをそのまま追加する
+            feature_db._collection.upsert(ids=batch_ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+    return feature_db
+
+
+def get_feature_db_hash(file_path, emb_model, chunk_size=1000, chunk_overlap=0, separator="\n", feature_db_type="chroma"):
+    return get_dataset_hash(
         file_path,
+        emb_model_name=getattr(emb_model, "model_name", type(emb_model).__name__),
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separator=separator,
+        feature_db_type=feature_db_type,
         text_columns=AppConfig.dataset_text_columns,
         meta_columns=AppConfig.dataset_meta_columns,
     )
-    documents = document_loader.load()
-    logger.debug(f'documents={documents}')
 
+
+def update_db_from_documents(
+    documents, emb_model, chunk_size=1000, chunk_overlap=0, separator="\n", feature_db_type="chroma", feature_db=None, batch_size=1000
+):
     # LangChain Data connection の Text Splitters を使用して、テキストを分割
     text_splitter = CharacterTextSplitter(
         separator=separator,            # セパレータ
         chunk_size=chunk_size,          # チャンクの最大文字数
         chunk_overlap=chunk_overlap     #
     )
-    split_documents = text_splitter.split_documents(documents)
-    logger.debug(f'split_documents={split_documents}')
+
+    # 既存の特徴量データベースとの差分（追加 or 修正された分割文章・削除された分割文章）のみを反映する
+    existing_ids = get_feature_db_ids(feature_db) if feature_db is not None else set()
+    document_ids = set()
+    emb_keys = set()
+    add_documents = {}
+    n_added = 0
+
+    # documents はジェネレーターでもよく、読み込んだ文章から batch_size 個ずつ分割＆埋め込みを行う
+    for document in documents:
+        for split_document in text_splitter.split_documents([document]):
+            # 同一内容の分割文章は 1 つにまとめる
+            id = get_document_id(split_document)
+            if id in document_ids:
+                continue
+            document_ids.add(id)
+            if isinstance(emb_model, CachedEmbeddings):
+                emb_keys.add(emb_model.get_key(split_document.page_content))
+            if id not in existing_ids:
+                add_documents[id] = split_document
+
+        if len(add_documents) >= batch_size:
+            logger.debug('split_documents=%s', Payload(list(add_documents.values())))
+            feature_db = add_documents_to_db(feature_db, list(add_documents.values()), list(add_documents.keys()), emb_model, feature_db_type)
+            n_added += len(add_documents)
+            add_documents = {}
 
     # 埋め込みモデルで分割テキストを埋め込み埋め込みベクトルを作成。埋め込むベクトルを特徴量データベース（VectorDB）に保存
-    if feature_db_type == "chroma":
-        feature_db = Chroma.from_documents(split_documents, emb_model)
-    elif feature_db_type == "faiss":
-        feature_db = FAISS.from_documents(split_documents, emb_model)
-    else:
-        feature_db = Chroma.from_documents(split_documents, emb_model)
+    if len(add_documents) > 0:
+        logger.debug('split_documents=%s', Payload(list(add_documents.values())))
+        feature_db = add_documents_to_db(feature_db, list(add_documents.values()), list(add_documents.keys()), emb_model, feature_db_type)
+        n_added += len(add_documents)
+
+    # 用語集に文章が 1 つもない場合（シートの行を全て削除した・読み込みに失敗した場合など）は、特徴量データベースを作成せずに None を返す
+    # 既存の特徴量データベースの全ての文章の削除と、埋め込みベクトルのキャッシュの削除も行わない
+    if len(document_ids) == 0:
+        logger.warning(f"no documents to update feature db! | type={feature_db_type}")
+        return None
+
+    delete_ids = [id for id in existing_ids if id not in document_ids]
+    if len(delete_ids) > 0:
+        feature_db.delete(ids=delete_ids)
+    logger.info(f"updated feature db | type={feature_db_type} n_documents={len(document_ids)} n_added={n_added} n_deleted={len(delete_ids)}")
+
+    # 埋め込みベクトルのキャッシュを永続化
+    if isinstance(emb_model, CachedEmbeddings):
+        emb_model.prune(emb_keys)
+        emb_model.save()
+
+    return feature_db
+
+
+def update_db_from_csv(
+    file_path, emb_model, chunk_size=1000, chunk_overlap=0, separator="\n", feature_db_type="chroma", feature_db=None, snapshot_dir=None
+):
+    # 用語集と作成条件が同じ特徴量データベースのスナップショットが保存されている場合は、埋め込みを行わずにスナップショットを読み込む
+    if snapshot_dir is not None:
+        dataset_hash = get_feature_db_hash(file_path, emb_model, chunk_size, chunk_overlap, separator, feature_db_type)
+        try:
+            snapshot_feature_db = load_snapshot(snapshot_dir, dataset_hash, emb_model, feature_db_type=feature_db_type)
+            if snapshot_feature_db is not None:
+                return snapshot_feature_db
+        except Exception as e:
+            logger.warning(f"failed to load feature db snapshot! rebuild feature db | {e}")
+
+    # Document Loaders を使用して csv ファイル読み込み
+    document_loader = CSVLoader(
+        file_path,
+        text_columns=AppConfig.dataset_text_columns,
+        meta_columns=AppConfig.dataset_meta_columns,
+    )
+    feature_db = update_db_from_documents(
+        document_loader.lazy_load(),
+        emb_model,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        separator=separator,
+        feature_db_type=feature_db_type,
+        feature_db=feature_db,
+    )
+
+    if feature_db is not None and snapshot_dir is not None:
+        try:
+            save_snapshot(feature_db, snapshot_dir, dataset_hash)
+        except Exception as e:
+            logger.warning(f"failed to save feature db snapshot! | {e}")
 
     return feature_db
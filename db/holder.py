@@ -0,0 +1,180 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional
+
+from db.vectorstore import get_feature_db_type
+from utils.logger import logger
+
+
+class FeatureDBVersion:
+    def __init__(
+        self,
+        feature_db,
+        version: Optional[str],
+        build_time: float = 0.0,
+        info: Optional[dict] = None,
+        lexical_index=None,
+    ):
+        # 作成済みの特徴量データベースは更新せず、更新時は新しい FeatureDBVersion を作成する
+        self.feature_db = feature_db
+        self.lexical_index = lexical_index
+        self.version = version
+        self.built_at = time.time()
+        self.build_time = build_time
+        self.info = info or {}
+        return
+
+    def to_dict(self):
+        return {
+            'version': self.version,
+            'built_at': self.built_at,
+            'build_time': self.build_time,
+            **self.info,
+        }
+
+
+class FeatureDBHolder:
+    def __init__(
+        self,
+        lexical_index_builder: Optional[Callable] = None,
+        on_change: Optional[Callable] = None,
+    ):
+        # lexical_index_builder(特徴量データベース) で、特徴量データベースと同じ文章の用語索引を作成する
+        # on_change(保持しているバージョンのリスト) は、保持しているバージョンが変わる度に呼び出す（参照中のスナップショットのリースの更新など）
+        self.lexical_index_builder = lexical_index_builder
+        self.on_change = on_change
+        self.current: Optional[FeatureDBVersion] = None
+        self.previous: Optional[FeatureDBVersion] = None
+        # 処理中のリクエストが参照しているバージョンごとの参照数（参照数が 0 になるまで、切り替え後も解放しない）
+        self.ref_counts: Dict[int, int] = {}
+        self.retired: Dict[int, FeatureDBVersion] = {}
+        self.lock = threading.Lock()
+
+        # 特徴量データベースの作成はバックグラウンドの 1 スレッドで行い、チャット応答のスレッドはブロックしない
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feature-db-builder")
+        self.building = False
+        self.pending_build_func = None
+        self.last_error = None
+        self.last_failed_at = None
+        return
+
+    def get(self) -> Optional[FeatureDBVersion]:
+        # 現在のバージョンを参照のみする（検索に使用する場合は acquire を使用する）
+        return self.current
+
+    def acquire(self) -> Optional[FeatureDBVersion]:
+        # リクエストの開始時に一度だけ取得し、リクエスト中は同じバージョンを使用する（リクエストの終了時に release を呼び出す）
+        with self.lock:
+            current = self.current
+            if current is not None:
+                self.ref_counts[id(current)] = self.ref_counts.get(id(current), 0) + 1
+        return current
+
+    def release(self, feature_db_version: Optional[FeatureDBVersion]):
+        if feature_db_version is None:
+            return
+        with self.lock:
+            key = id(feature_db_version)
+            self.ref_counts[key] -= 1
+            if self.ref_counts[key] > 0:
+                return
+            del self.ref_counts[key]
+            freed = self.retired.pop(key, None)
+            holding = self.get_holding()
+        if freed is not None:
+            self.free(freed, holding)
+        return
+
+    def get_holding(self):
+        # 現在・1 つ前のバージョンと、処理中のリクエストが参照している古いバージョン
+        return [version for version in (self.current, self.previous) if version is not None] + list(self.retired.values())
+
+    def swap(self, feature_db_version: FeatureDBVersion):
+        # 参照の置き換えのみで切り替え、処理中のリクエストは古いバージョンの参照をそのまま使用する
+        # 1 つ前のバージョンは残し、2 つ前のバージョンは処理中のリクエストが参照していなければ解放する（参照している場合は参照数が 0 になった時点で解放する）
+        with self.lock:
+            retired, self.previous, self.current = self.previous, self.current, feature_db_version
+            if retired is not None and (retired is self.current or retired is self.previous):
+                retired = None
+            if retired is not None and self.ref_counts.get(id(retired), 0) > 0:
+                self.retired[id(retired)] = retired
+                retired = None
+            holding = self.get_holding()
+        self.free(retired, holding)
+        logger.info(f"swapped feature db | version={feature_db_version.version} build_time={feature_db_version.build_time:.2f}")
+        return
+
+    def free(self, retired: Optional[FeatureDBVersion], holding):
+        if self.on_change is not None:
+            try:
+                self.on_change(holding)
+            except Exception as e:
+                logger.warning(f"failed to run on_change callback! | {e}")
+
+        # インメモリの Chroma のコレクションのみ削除する（スナップショットから読み込んだ永続化されたコレクションは、スナップショットが作成済みのまま参照されるので削除しない）
+        if (
+            retired is not None and get_feature_db_type(retired.feature_db) == "chroma"
+            and all(retired.feature_db is not version.feature_db for version in holding)
+            and not retired.feature_db._client.get_settings().is_persistent
+        ):
+            try:
+                retired.feature_db.delete_collection()
+            except Exception as e:
+                logger.warning(f"failed to delete old feature db collection! | {e}")
+        if retired is not None:
+            logger.info(f"released old feature db | version={retired.version}")
+        return
+
+    def build(self, build_func: Callable):
+        # build_func(現在の特徴量データベース) は (新しい特徴量データベース, バージョン, 付加情報) を返す（None を返した場合は切り替えない）
+        # 作成に失敗した場合は、現在の特徴量データベースを使用し続ける
+        start_time = time.time()
+        current = self.current
+        try:
+            result = build_func(current.feature_db if current is not None else None)
+            if result is None:
+                return current
+            feature_db, version, info = result
+            lexical_index = self.lexical_index_builder(feature_db) if self.lexical_index_builder is not None else None
+        except Exception as e:
+            logger.error(f"failed to build feature db! keep serving current version | version={getattr(current, 'version', None)} {e}", exc_info=True)
+            with self.lock:
+                self.last_error = str(e)
+                self.last_failed_at = time.time()
+            return None
+
+        feature_db_version = FeatureDBVersion(feature_db, version, build_time=time.time() - start_time, info=info, lexical_index=lexical_index)
+        self.swap(feature_db_version)
+        with self.lock:
+            self.last_error = None
+        return feature_db_version
+
+    def submit(self, build_func: Callable) -> bool:
+        # 作成中に更新要求があった場合は、作成完了後にもう一度だけ作成する
+        with self.lock:
+            if self.building:
+                self.pending_build_func = build_func
+                return False
+            self.building = True
+        self.executor.submit(self.run_builds, build_func)
+        return True
+
+    def run_builds(self, build_func: Callable):
+        while build_func is not None:
+            self.build(build_func)
+            with self.lock:
+                build_func, self.pending_build_func = self.pending_build_func, None
+                if build_func is None:
+                    self.building = False
+        return
+
+    def status(self):
+        current = self.current
+        with self.lock:
+            return {
+                'active': current.to_dict() if current is not None else None,
+                'building': self.building,
+                'last_error': self.last_error,
+                'last_failed_at': self.last_failed_at,
+            }
@@ -0,0 +1,130 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import tiktoken
+
+from utils.logger import logger
+
+
+def is_rate_limit_error(e):
+    return type(e).__name__ == "RateLimitError" or getattr(e, "http_status", None) == 429 or getattr(e, "status_code", None) == 429
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+    ):
+        # リクエスト数とトークン数のトークンバケット
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+        return
+
+    def acquire(self, n_tokens: int):
+        # 1 リクエストで上限を超えるトークン数の場合でも、バケットが満杯になれば実行できるようにする
+        n_tokens = min(n_tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                elapsed_time = now - self.last_time
+                self.last_time = now
+                self.available_requests = min(self.requests_per_minute, self.available_requests + elapsed_time * self.requests_per_minute / 60)
+                self.available_tokens = min(self.tokens_per_minute, self.available_tokens + elapsed_time * self.tokens_per_minute / 60)
+                if self.available_requests >= 1 and self.available_tokens >= n_tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= n_tokens
+                    return
+
+                wait_time = max(
+                    (1 - self.available_requests) * 60 / self.requests_per_minute,
+                    (n_tokens - self.available_tokens) * 60 / self.tokens_per_minute,
+                )
+            time.sleep(wait_time)
+
+
+class EmbeddingScheduler:
+    def __init__(
+        self,
+        emb_model,
+        model_name: str,
+        max_workers: int = 4,
+        requests_per_minute: float = 3000,
+        tokens_per_minute: float = 1000000,
+        max_batch_tokens: int = 100000,
+        max_batch_size: int = 1000,
+        max_retries: int = 6,
+        max_backoff: float = 60.0,
+    ):
+        self.emb_model = emb_model
+        self.max_workers = max_workers
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.model_name = model_name
+        self.encoding = None
+        return
+
+    def get_encoding(self):
+        # tiktoken のエンコーディングは初回使用時に読み込む
+        if self.encoding is None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(self.model_name)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+        return self.encoding
+
+    def make_batches(self, texts):
+        # tiktoken で数えたトークン数が上限を超えないように、テキストをバッチにまとめる
+        batches = []
+        batch_indices, batch_tokens = [], 0
+        for i, n_tokens in enumerate(len(tokens) for tokens in self.get_encoding().encode_batch(texts, disallowed_special=())):
+            if len(batch_indices) > 0 and (batch_tokens + n_tokens > self.max_batch_tokens or len(batch_indices) >= self.max_batch_size):
+                batches.append((batch_indices, batch_tokens))
+                batch_indices, batch_tokens = [], 0
+            batch_indices.append(i)
+            batch_tokens += n_tokens
+        if len(batch_indices) > 0:
+            batches.append((batch_indices, batch_tokens))
+        return batches
+
+    def embed_batch(self, texts, n_tokens):
+        for n_retries in range(self.max_retries + 1):
+            self.rate_limiter.acquire(n_tokens)
+            try:
+                return self.emb_model.embed_documents(texts)
+            except Exception as e:
+                if not is_rate_limit_error(e) or n_retries >= self.max_retries:
+                    raise
+
+                # レート制限（429）の場合は、ジッター付きの指数バックオフで再試行する
+                wait_time = random.uniform(0, min(self.max_backoff, 2 ** n_retries))
+                logger.warning(f"embedding api rate limited! retry after {wait_time:.2f} sec | n_retries={n_retries + 1} {e}")
+                time.sleep(wait_time)
+
+    def iter_embed_documents(self, texts):
+        # バッチを並列に埋め込み、埋め込みが完了したバッチから順に返す
+        batches = self.make_batches(texts)
+        logger.info(f"embed documents | n_texts={len(texts)} n_batches={len(batches)} n_tokens={sum(n for _, n in batches)}")
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self.embed_batch, [texts[i] for i in batch_indices], n_tokens): batch_indices
+                for batch_indices, n_tokens in batches
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def embed_documents(self, texts):
+        vectors = [None] * len(texts)
+        for batch_indices, batch_vectors in self.iter_embed_documents(texts):
+            for i, vector in zip(batch_indices, batch_vectors):
+                vectors[i] = vector
+        return vectors
@@ -0,0 +1,142 @@
+import heapq
+import math
+from collections import Counter
+from typing import Dict, List, Optional
+
+from langchain.docstore.document import Document
+
+from db.feature import get_document_id
+from db.vectorstore import get_feature_db_type
+from qa.cache import normalize_question
+from utils.logger import logger
+
+
+def get_ngrams(text: str, n: int = 2) -> List[str]:
+    # 日本語は単語の区切りがないので、文字 n-gram を索引語として使用する
+    text = text.replace(" ", "")
+    if len(text) < n:
+        return [text] if len(text) > 0 else []
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+def get_feature_db_documents(feature_db) -> List[Document]:
+    feature_db_type = get_feature_db_type(feature_db)
+    if feature_db_type == "faiss":
+        return list(feature_db.docstore._dict.values())
+    elif feature_db_type == "chroma":
+        data = feature_db.get(include=["documents", "metadatas"])
+        return [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(data["documents"], data["metadatas"])]
+    else:
+        return feature_db.get_documents()
+
+
+def reciprocal_rank_fusion(doc_lists: List[List[Document]], k: int = 4, rrf_k: int = 60) -> List[Document]:
+    # スケールの異なる類似度スコアと BM25 スコアを、順位のみを使用して統合する
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    for doc_list in doc_lists:
+        for rank, doc in enumerate(doc_list):
+            id = get_document_id(doc)
+            scores[id] = scores.get(id, 0.0) + 1.0 / (rrf_k + rank + 1)
+            docs.setdefault(id, doc)
+    return [docs[id] for id in heapq.nlargest(k, scores, key=scores.get)]
+
+
+class LexicalIndex:
+    def __init__(
+        self,
+        documents: List[Document],
+        term_column: str = "用語",
+        n: int = 2,
+        min_coverage: float = 0.5,
+        exact_match_min_length: int = 2,
+        k1: float = 1.2,
+        b: float = 0.75,
+    ):
+        # 用語列の完全一致（正規化済み）索引と、文字 n-gram の BM25 索引をメモリ上に作成する
+        self.n = n
+        self.min_coverage = min_coverage
+        self.exact_match_min_length = exact_match_min_length
+        self.k1 = k1
+        self.b = b
+
+        self.documents: List[Document] = []
+        self.terms: Dict[str, List[int]] = {}
+        self.postings: Dict[str, List[tuple]] = {}
+        self.doc_lengths: List[int] = []
+        self.doc_n_ngrams: List[int] = []
+        prefix = f"{term_column}: "
+        for document in documents:
+            # 分割文章のうち、用語の行を含むものだけを索引に追加する
+            term = next((line[len(prefix):] for line in document.page_content.split("\n") if line.startswith(prefix)), None)
+            if term is None:
+                continue
+            term = normalize_question(term)
+            if len(term) == 0:
+                continue
+
+            i = len(self.documents)
+            self.documents.append(document)
+            self.terms.setdefault(term, []).append(i)
+            ngrams = Counter(get_ngrams(term, n))
+            for ngram, tf in ngrams.items():
+                self.postings.setdefault(ngram, []).append((i, tf))
+            self.doc_lengths.append(sum(ngrams.values()))
+            self.doc_n_ngrams.append(len(ngrams))
+
+        self.max_term_length = max((len(term) for term in self.terms), default=0)
+        self.avg_doc_length = sum(self.doc_lengths) / len(self.doc_lengths) if len(self.doc_lengths) > 0 else 0.0
+        self.idf = {
+            ngram: math.log(1 + (len(self.documents) - len(posting) + 0.5) / (len(posting) + 0.5))
+            for ngram, posting in self.postings.items()
+        }
+        logger.info(f"built lexical index | n_terms={len(self.terms)} n_ngrams={len(self.postings)}")
+        return
+
+    @classmethod
+    def from_feature_db(cls, feature_db, **kwargs):
+        return cls(get_feature_db_documents(feature_db), **kwargs)
+
+    def search_exact(self, question: str, k: int = 4) -> List[Document]:
+        # 質問文の部分文字列のうち用語と一致するものを探す（用語集の大きさによらず、質問文の長さのみに比例する）
+        question = normalize_question(question)
+        matches = []
+        for length in range(min(self.max_term_length, len(question)), self.exact_match_min_length - 1, -1):
+            for start in range(len(question) - length + 1):
+                if question[start:start + length] in self.terms:
+                    matches.append((start, start + length))
+
+        # 長い用語に含まれる短い用語（「機械学習」に対する「学習」など）は除外する
+        spans = []
+        for start, end in matches:
+            if all(end <= s or e <= start for s, e in spans):
+                spans.append((start, end))
+
+        documents = []
+        for start, end in spans:
+            for i in self.terms[question[start:end]]:
+                if len(documents) < k:
+                    documents.append(self.documents[i])
+        return documents
+
+    def search(self, question: str, k: int = 4) -> List[Document]:
+        # 質問文に用語の n-gram の大部分が含まれている分割文章を、BM25 スコアの高い順に返す
+        scores: Dict[int, float] = {}
+        n_matches: Dict[int, int] = {}
+        for ngram in set(get_ngrams(normalize_question(question), self.n)):
+            idf = self.idf.get(ngram)
+            if idf is None:
+                continue
+            for i, tf in self.postings[ngram]:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[i] / self.avg_doc_length)
+                scores[i] = scores.get(i, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+                n_matches[i] = n_matches.get(i, 0) + 1
+
+        candidates = [i for i in scores if n_matches[i] / self.doc_n_ngrams[i] >= self.min_coverage]
+        return [self.documents[i] for i in heapq.nlargest(k, candidates, key=scores.get)]
+
+
+def build_lexical_index(feature_db, term_column: Optional[str], **kwargs) -> Optional[LexicalIndex]:
+    if not term_column:
+        return None
+    return LexicalIndex.from_feature_db(feature_db, term_column=term_column, **kwargs)
@@ -0,0 +1,272 @@
+import math
+import os
+import pickle
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+# 量子化した場合は、CPU のキャッシュに収まるこの行数ごとに float32 に戻して類似度を計算する（一時的なメモリ使用量も抑える）
+# numpy は float16・int8 の行列積に BLAS を使用しないので、保持している型のまま計算するよりも float32 に戻した方が速い
+SEARCH_BLOCK_SIZE = 1024
+
+
+class NumpyVectorStore(VectorStore):
+    def __init__(
+        self,
+        embedding: Embeddings,
+        dtype: str = "float32",
+    ):
+        # 正規化した埋め込みベクトルを連続した 1 つの行列に保持し、行列積で全件の類似度を計算する
+        # dtype は "float32", "float16", "int8"（行ごとのスケールで量子化）のいずれか
+        # float16・int8 はメモリ使用量が 1/2・1/4 になる代わりに、検索の度に float32 に戻すので検索が遅くなる（特に float16）
+        if dtype not in ("float32", "float16", "int8"):
+            raise ValueError(f"unsupported dtype! | {dtype}")
+        self.embedding = embedding
+        self.dtype = dtype
+        self.vectors = None
+        self.scales = np.zeros(0, dtype=np.float32)
+        self.n = 0
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.metadatas: List[dict] = []
+        self.id_to_index: Dict[str, int] = {}
+        return
+
+    @property
+    def embeddings(self) -> Optional[Embeddings]:
+        return self.embedding
+
+    def __len__(self):
+        return self.n
+
+    def quantize(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if self.dtype == "int8":
+            scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127
+            return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return vectors.astype(self.dtype), np.ones(len(vectors), dtype=np.float32)
+
+    def reserve(self, n_rows: int, dim: int):
+        # 追加のたびに行列を作り直さないように、容量を倍々に確保する
+        if self.vectors is not None and self.vectors.flags.writeable and len(self.vectors) >= n_rows:
+            return
+        capacity = max(n_rows, 2 * len(self.vectors) if self.vectors is not None else 0, 16)
+        vectors = np.zeros((capacity, dim), dtype=self.dtype)
+        scales = np.zeros(capacity, dtype=np.float32)
+        if self.vectors is not None:
+            vectors[:self.n] = self.vectors[:self.n]
+            scales[:self.n] = self.scales[:self.n]
+        self.vectors, self.scales = vectors, scales
+        return
+
+    def add_embeddings(
+        self,
+        text_embeddings: Iterable[Tuple[str, List[float]]],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        text_embeddings = list(text_embeddings)
+        if len(text_embeddings) == 0:
+            return []
+        texts = [text for text, _ in text_embeddings]
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(self.n + i) for i in range(len(texts))]
+
+        vectors, scales = self.quantize(np.asarray([embedding for _, embedding in text_embeddings], dtype=np.float32))
+        for id, text, metadata, vector, scale in zip(ids, texts, metadatas, vectors, scales):
+            i = self.id_to_index.get(id)
+            if i is None:
+                self.reserve(self.n + 1, len(vector))
+                i = self.n
+                self.n += 1
+                self.ids.append(id)
+                self.texts.append(text)
+                self.metadatas.append(metadata)
+                self.id_to_index[id] = i
+            else:
+                self.reserve(self.n, len(vector))
+                self.texts[i] = text
+                self.metadatas[i] = metadata
+            self.vectors[i] = vector
+            self.scales[i] = scale
+        return ids
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        texts = list(texts)
+        return self.add_embeddings(zip(texts, self.embedding.embed_documents(texts)), metadatas=metadatas, ids=ids)
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        # 削除した行には末尾の行を移動して、行列を連続したまま保つ
+        for id in ids or []:
+            i = self.id_to_index.pop(id, None)
+            if i is None:
+                continue
+            self.reserve(self.n, self.vectors.shape[1])
+            last = self.n - 1
+            if i != last:
+                self.vectors[i] = self.vectors[last]
+                self.scales[i] = self.scales[last]
+                self.ids[i] = self.ids[last]
+                self.texts[i] = self.texts[last]
+                self.metadatas[i] = self.metadatas[last]
+                self.id_to_index[self.ids[i]] = i
+            self.ids.pop()
+            self.texts.pop()
+            self.metadatas.pop()
+            self.n -= 1
+        return True
+
+    def get_documents(self) -> List[Document]:
+        return [Document(page_content=text, metadata=metadata) for text, metadata in zip(self.texts, self.metadatas)]
+
+    def get_filter_mask(self, filter: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        # filter はメタデータの列名と値（または値のリスト）の辞書
+        if not filter:
+            return None
+        conditions = {key: set(value) if isinstance(value, (list, tuple, set)) else {value} for key, value in filter.items()}
+        return np.fromiter(
+            (all(metadata.get(key) in values for key, values in conditions.items()) for metadata in self.metadatas),
+            dtype=bool,
+            count=self.n,
+        )
+
+    def search_by_vectors(self, embeddings: List[List[float]], k: int = 4, filter: Optional[Dict[str, Any]] = None) -> List[List[Tuple[int, float]]]:
+        # 複数の質問文の埋め込みベクトルをまとめて 1 回の行列積で検索し、(行番号, コサイン類似度) のリストを返す
+        if self.n == 0 or len(embeddings) == 0:
+            return [[] for _ in embeddings]
+        queries = np.asarray(embeddings, dtype=np.float32)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        if self.vectors.dtype == np.float32:
+            scores = queries @ self.vectors[:self.n].T
+        else:
+            # 変換先のバッファを使い回し、ブロックごとに新しい配列を確保しない
+            scores = np.empty((len(queries), self.n), dtype=np.float32)
+            buffer = np.empty((min(SEARCH_BLOCK_SIZE, self.n), self.vectors.shape[1]), dtype=np.float32)
+            for start in range(0, self.n, SEARCH_BLOCK_SIZE):
+                end = min(start + SEARCH_BLOCK_SIZE, self.n)
+                block = buffer[:end - start]
+                block[...] = self.vectors[start:end]
+                scores[:, start:end] = queries @ block.T
+        if self.dtype == "int8":
+            scores *= self.scales[:self.n]
+
+        mask = self.get_filter_mask(filter)
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+        n_candidates = self.n if mask is None else int(mask.sum())
+
+        # 上位 k 件のみを argpartition で取り出してから並べ替える
+        k = min(k, n_candidates)
+        if k <= 0:
+            return [[] for _ in embeddings]
+        if k < self.n:
+            top_indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            top_indices = np.tile(np.arange(self.n), (len(queries), 1))
+        top_scores = np.take_along_axis(scores, top_indices, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top_indices = np.take_along_axis(top_indices, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        return [list(zip(indices.tolist(), row_scores.tolist())) for indices, row_scores in zip(top_indices, top_scores)]
+
+    def similarity_search_with_score_by_vectors(
+        self, embeddings: List[List[float]], k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> List[List[Tuple[Document, float]]]:
+        return [
+            [(Document(page_content=self.texts[i], metadata=self.metadatas[i]), score) for i, score in results]
+            for results in self.search_by_vectors(embeddings, k=k, filter=filter)
+        ]
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vectors([embedding], k=k, filter=filter)[0]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(self.embedding.embed_query(query), k=k, filter=filter)
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # FAISS・Chroma（二乗ユークリッド距離）と同じスレッショルド値を使用できるように、コサイン類似度を同じ尺度に変換する
+        return lambda score: min(1.0, max(0.0, 1.0 - (2.0 - 2.0 * score) / math.sqrt(2)))
+
+    def copy(self):
+        feature_db = NumpyVectorStore(self.embedding, dtype=self.dtype)
+        if self.vectors is not None:
+            feature_db.vectors = np.array(self.vectors[:self.n])
+            feature_db.scales = np.array(self.scales[:self.n])
+        feature_db.n = self.n
+        feature_db.ids = list(self.ids)
+        feature_db.texts = list(self.texts)
+        feature_db.metadatas = list(self.metadatas)
+        feature_db.id_to_index = dict(self.id_to_index)
+        return feature_db
+
+    def save_local(self, folder_path: str):
+        os.makedirs(folder_path, exist_ok=True)
+        if self.vectors is not None:
+            np.save(os.path.join(folder_path, "vectors.npy"), self.vectors[:self.n])
+            np.save(os.path.join(folder_path, "scales.npy"), self.scales[:self.n])
+        with open(os.path.join(folder_path, "docstore.pkl"), "wb") as f:
+            pickle.dump((self.dtype, self.ids, self.texts, self.metadatas), f, protocol=pickle.HIGHEST_PROTOCOL)
+        return
+
+    @classmethod
+    def load_local(cls, folder_path: str, embedding: Embeddings):
+        with open(os.path.join(folder_path, "docstore.pkl"), "rb") as f:
+            dtype, ids, texts, metadatas = pickle.load(f)
+        feature_db = cls(embedding, dtype=dtype)
+        if os.path.isfile(os.path.join(folder_path, "vectors.npy")):
+            # 埋め込みベクトルはメモリマップで読み込み、追加・削除時にメモリ上に複製する
+            feature_db.vectors = np.load(os.path.join(folder_path, "vectors.npy"), mmap_mode="r")
+            feature_db.scales = np.load(os.path.join(folder_path, "scales.npy"), mmap_mode="r")
+        feature_db.n = len(ids)
+        feature_db.ids = ids
+        feature_db.texts = texts
+        feature_db.metadatas = metadatas
+        feature_db.id_to_index = {id: i for i, id in enumerate(ids)}
+        return feature_db
+
+    @classmethod
+    def from_embeddings(
+        cls,
+        text_embeddings: List[Tuple[str, List[float]]],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        dtype: str = "float32",
+        **kwargs: Any,
+    ):
+        feature_db = cls(embedding, dtype=dtype)
+        feature_db.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+        return feature_db
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None,
+        dtype: str = "float32",
+        **kwargs: Any,
+    ):
+        return cls.from_embeddings(list(zip(texts, embedding.embed_documents(texts))), embedding, metadatas=metadatas, ids=ids, dtype=dtype)
@@ -0,0 +1,275 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import socket
+import threading
+import time
+import uuid
+
+from db.vectorstore import get_feature_db_type
+from utils.logger import logger
+
+# スナップショットのファイルフォーマットを変更した場合は、古いスナップショットを読み込まないようにバージョンを上げる
+SNAPSHOT_VERSION = 4
+
+
+def get_dataset_hash(file_path, **kwargs):
+    # 用語集 csv ファイルの内容と特徴量データベースの作成条件（埋め込みモデル名・チャンクサイズなど）からハッシュ値を計算する
+    sha256 = hashlib.sha256()
+    sha256.update(json.dumps({"snapshot_version": SNAPSHOT_VERSION, **kwargs}, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def is_complete_snapshot(snapshot_path, feature_db_type):
+    try:
+        with open(os.path.join(snapshot_path, "meta.json"), "r") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    return meta.get("snapshot_version") == SNAPSHOT_VERSION and meta.get("feature_db_type") == feature_db_type
+
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def update_snapshot_lease(snapshot_dir, dataset_hashes):
+    # このプロセスが参照しているスナップショット（処理中のリクエストが参照している古いバージョンを含む）をリースファイルに書き込み、他のワーカーに削除されないようにする
+    lease_dir = os.path.join(snapshot_dir, ".leases")
+    os.makedirs(lease_dir, exist_ok=True)
+    lease_path = os.path.join(lease_dir, f"{socket.gethostname()}.{os.getpid()}.json")
+    tmp_path = f"{lease_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(sorted(set(dataset_hashes)), f)
+    os.replace(tmp_path, lease_path)
+    return
+
+
+def get_leased_hashes(snapshot_dir):
+    # 参照中のスナップショットのハッシュ値を返す（同じホストの終了したプロセスのリースファイルは削除する。他のホストのリースは常に有効とする）
+    lease_dir = os.path.join(snapshot_dir, ".leases")
+    if not os.path.isdir(lease_dir):
+        return set()
+    hostname = socket.gethostname()
+    leased_hashes = set()
+    for name in os.listdir(lease_dir):
+        if not name.endswith(".json"):
+            continue
+        host, pid = name[:-len(".json")].rsplit(".", 1)
+        lease_path = os.path.join(lease_dir, name)
+        if host == hostname and not is_process_alive(int(pid)):
+            try:
+                os.remove(lease_path)
+            except FileNotFoundError:
+                pass
+            continue
+        try:
+            with open(lease_path, "r") as f:
+                leased_hashes.update(json.load(f))
+        except (FileNotFoundError, ValueError):
+            continue
+    return leased_hashes
+
+
+def write_snapshot(feature_db, snapshot_path, dataset_hash, feature_db_type):
+    collection_name = None
+    if feature_db_type == "faiss":
+        import faiss
+
+        faiss.write_index(feature_db.index, os.path.join(snapshot_path, "index.faiss"))
+        with open(os.path.join(snapshot_path, "docstore.pkl"), "wb") as f:
+            pickle.dump(
+                (
+                    feature_db.docstore, feature_db.index_to_docstore_id, feature_db.distance_strategy, feature_db._normalize_L2,
+                    feature_db.override_relevance_score_fn,
+                ),
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+    elif feature_db_type == "chroma":
+        import chromadb
+
+        collection_name = feature_db._collection.name
+        data = feature_db.get(include=["embeddings", "documents", "metadatas"])
+        client = chromadb.PersistentClient(path=snapshot_path)
+        collection = client.get_or_create_collection(name=collection_name, metadata=feature_db._collection.metadata)
+        if len(data["ids"]) > 0:
+            collection.add(ids=data["ids"], embeddings=data["embeddings"], documents=data["documents"], metadatas=data["metadatas"])
+    else:
+        feature_db.save_local(snapshot_path)
+
+    # meta.json のあるディレクトリを作成済みのスナップショットとする（書き込み途中のスナップショットは読み込まない）
+    meta = {
+        "snapshot_version": SNAPSHOT_VERSION,
+        "dataset_hash": dataset_hash,
+        "feature_db_type": feature_db_type,
+        "collection_name": collection_name,
+        "created_at": time.time(),
+    }
+    with open(os.path.join(snapshot_path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+    return
+
+
+def save_snapshot(feature_db, snapshot_dir, dataset_hash, max_snapshots=2):
+    # 同じハッシュ値のスナップショットは他のワーカーがメモリマップ・Chroma のクライアントで開いている可能性があるので、作成済みの場合は上書きしない
+    snapshot_path = os.path.join(snapshot_dir, dataset_hash)
+    feature_db_type = get_feature_db_type(feature_db)
+    if is_complete_snapshot(snapshot_path, feature_db_type):
+        os.utime(snapshot_path)
+        logger.info(f"feature db snapshot already exists | path={snapshot_path}")
+        return snapshot_path
+
+    # 一時ディレクトリに書き込んだ後に置き換え、書き込み途中のディレクトリを他のワーカーから参照されないようにする
+    os.makedirs(snapshot_dir, exist_ok=True)
+    # Chroma のクライアントはパスごとにキャッシュされるので、一時ディレクトリは毎回別の名前にする
+    tmp_path = os.path.join(snapshot_dir, f".{dataset_hash}.{uuid.uuid4().hex}.tmp")
+    os.makedirs(tmp_path)
+    write_snapshot(feature_db, tmp_path, dataset_hash, feature_db_type)
+
+    # 書き込み中に他のワーカーが同じスナップショットを作成した場合は、そちらを使用する
+    if is_complete_snapshot(snapshot_path, feature_db_type):
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        logger.info(f"feature db snapshot already exists | path={snapshot_path}")
+        return snapshot_path
+    # 書き込み途中で中断された（meta.json のない）・古い形式のディレクトリのみ削除してから置き換える
+    if os.path.isdir(snapshot_path):
+        shutil.rmtree(snapshot_path)
+    os.replace(tmp_path, snapshot_path)
+    logger.info(f"saved feature db snapshot | path={snapshot_path}")
+
+    # 古いスナップショットを削除（他のワーカーが書き込み中の一時ディレクトリ・いずれかのワーカーが参照中のスナップショットは除く）
+    leased_hashes = get_leased_hashes(snapshot_dir)
+    snapshot_paths = sorted(
+        [
+            os.path.join(snapshot_dir, name) for name in os.listdir(snapshot_dir)
+            if not name.startswith(".") and os.path.isdir(os.path.join(snapshot_dir, name))
+        ],
+        key=os.path.getmtime,
+        reverse=True,
+    )
+    for path in snapshot_paths[max_snapshots:]:
+        if os.path.basename(path) in leased_hashes:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        logger.info(f"deleted old feature db snapshot | path={path}")
+
+    return snapshot_path
+
+
+def load_snapshot(snapshot_dir, dataset_hash, emb_model, feature_db_type="faiss"):
+    snapshot_path = os.path.join(snapshot_dir, dataset_hash)
+    try:
+        with open(os.path.join(snapshot_path, "meta.json"), "r") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        logger.info(f"feature db snapshot not found | path={snapshot_path}")
+        return None
+
+    if meta["snapshot_version"] != SNAPSHOT_VERSION or meta["feature_db_type"] != feature_db_type:
+        logger.info(f"feature db snapshot is stale | path={snapshot_path} meta={meta}")
+        return None
+
+    if feature_db_type == "faiss":
+        import faiss
+        from langchain.vectorstores import FAISS
+
+        # 埋め込みベクトル（IndexFlat のコード）はメモリマップで読み込み、同一ホスト上の複数ワーカープロセス間で同じページを共有する
+        # IO_FLAG_MMAP は IndexFlat* をメモリマップしない（プロセスごとに全体を読み込む）ので、IO_FLAG_MMAP_IFC を使用する
+        # メモリマップしたインデックスには追加・削除できないので、更新する場合は copy_feature_db で複製してから行う
+        index = faiss.read_index(os.path.join(snapshot_path, "index.faiss"), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        with open(os.path.join(snapshot_path, "docstore.pkl"), "rb") as f:
+            docstore, index_to_docstore_id, distance_strategy, normalize_L2, relevance_score_fn = pickle.load(f)
+        feature_db = FAISS(
+            emb_model,
+            index,
+            docstore,
+            index_to_docstore_id,
+            relevance_score_fn=relevance_score_fn,
+            normalize_L2=normalize_L2,
+            distance_strategy=distance_strategy,
+        )
+    elif feature_db_type == "numpy":
+        from db.numpy_store import NumpyVectorStore
+
+        feature_db = NumpyVectorStore.load_local(snapshot_path, emb_model)
+    else:
+        import chromadb
+        from langchain.vectorstores import Chroma
+
+        feature_db = Chroma(
+            collection_name=meta["collection_name"],
+            client=chromadb.PersistentClient(path=snapshot_path),
+            embedding_function=emb_model,
+        )
+
+    logger.info(f"loaded feature db snapshot | path={snapshot_path}")
+    return feature_db
+
+
+def publish_snapshot(snapshot_dir, dataset_hash, version, info=None):
+    # 複数のワーカープロセスで起動している場合に、他のワーカーが読み込むスナップショットを current.json に書き込む
+    published = {
+        "dataset_hash": dataset_hash,
+        "version": version,
+        "info": info or {},
+        "published_at": time.time(),
+    }
+    os.makedirs(snapshot_dir, exist_ok=True)
+    # 複数のワーカーが同時に公開する場合に一時ファイルを共有しないように、一時ファイルは毎回別の名前にする
+    tmp_path = os.path.join(snapshot_dir, f".current.json.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(published, f, ensure_ascii=False)
+    os.replace(tmp_path, os.path.join(snapshot_dir, "current.json"))
+    logger.info(f"published feature db snapshot | dataset_hash={dataset_hash} version={version}")
+    return published
+
+
+class SnapshotWatcher:
+    def __init__(
+        self,
+        snapshot_dir: str,
+        interval: float = 5.0,
+    ):
+        # current.json の更新を一定間隔ごとに確認する（ファイルの更新時刻が変わった場合のみ読み込む）
+        self.snapshot_dir = snapshot_dir
+        self.interval = interval
+        self.last_checked_at = 0.0
+        self.last_mtime = None
+        self.lock = threading.Lock()
+        return
+
+    def poll(self):
+        # 前回の確認から更新されていれば、公開されたスナップショットの情報を返す
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_checked_at < self.interval:
+                return None
+            self.last_checked_at = now
+
+        path = os.path.join(self.snapshot_dir, "current.json")
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            if mtime == self.last_mtime:
+                return None
+            with open(path, "r") as f:
+                published = json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"failed to read published feature db snapshot! | {e}")
+            return None
+
+        self.last_mtime = mtime
+        return published
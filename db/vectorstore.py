@@ -0,0 +1,56 @@
+def get_feature_db_type(feature_db):
+    # 使用していないバックエンド（faiss・chromadb など）を import しないように、isinstance ではなくクラス名で判定する
+    for cls in type(feature_db).__mro__:
+        if cls.__name__ == "FAISS":
+            return "faiss"
+        elif cls.__name__ == "Chroma":
+            return "chroma"
+        elif cls.__name__ == "NumpyVectorStore":
+            return "numpy"
+    raise ValueError(f"unsupported feature db type! | {type(feature_db)}")
+
+
+def similarity_search_by_vectors(feature_db, embeddings, k: int = 4):
+    # 複数の質問文の埋め込みベクトルで、まとめて類似度検索を行う（質問文ごとの (文章, 類似度 or 距離) のリストを返す）
+    # 1 件ずつ検索するとインデックスの検索が質問文の数だけ呼び出されるので、行列のまま 1 回で検索する
+    if len(embeddings) == 0:
+        return []
+    feature_db_type = get_feature_db_type(feature_db)
+    if feature_db_type == "numpy":
+        return feature_db.similarity_search_with_score_by_vectors(embeddings, k=k)
+    elif feature_db_type == "faiss":
+        import faiss
+        import numpy as np
+
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if feature_db._normalize_L2:
+            faiss.normalize_L2(vectors)
+        scores, indices = feature_db.index.search(vectors, k)
+        return [
+            [
+                (feature_db.docstore.search(feature_db.index_to_docstore_id[i]), float(score))
+                for i, score in zip(row_indices, row_scores) if i != -1
+            ]
+            for row_indices, row_scores in zip(indices.tolist(), scores.tolist())
+        ]
+    elif feature_db_type == "chroma":
+        from langchain.schema import Document
+
+        results = feature_db._collection.query(query_embeddings=embeddings, n_results=k, include=["documents", "metadatas", "distances"])
+        return [
+            [(Document(page_content=text, metadata=metadata or {}), distance) for text, metadata, distance in zip(*row)]
+            for row in zip(results["documents"], results["metadatas"], results["distances"])
+        ]
+    raise ValueError(f"unsupported feature db type! | {feature_db_type}")
+
+
+def similarity_search_with_relevance_scores_by_vectors(feature_db, embeddings, k: int = 4, score_threshold=None):
+    # similarity_search_with_relevance_scores と同じく、類似度を [0, 1] に変換してスレッショルド値を下回る文章を除く
+    relevance_score_fn = feature_db._select_relevance_score_fn()
+    results = []
+    for docs_and_scores in similarity_search_by_vectors(feature_db, embeddings, k=k):
+        docs_and_scores = [(doc, relevance_score_fn(score)) for doc, score in docs_and_scores]
+        if score_threshold is not None:
+            docs_and_scores = [(doc, score) for doc, score in docs_and_scores if score >= score_threshold]
+        results.append(docs_and_scores)
+    return results
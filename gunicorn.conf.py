@@ -0,0 +1,45 @@
+import os
+import sys
+
+# gunicorn の設定ファイル
+# gunicorn -c gunicorn.conf.py wsgi:flask_app
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import AppConfig  # isort:skip
+
+bind = f"{AppConfig.host}:{AppConfig.port}"
+workers = AppConfig.num_workers
+threads = AppConfig.num_threads
+worker_class = "gthread"
+timeout = AppConfig.worker_timeout
+graceful_timeout = AppConfig.graceful_timeout
+
+# マスタープロセスでアプリケーションを読み込み＆特徴量データベースを作成してから fork し、ワーカー間でメモリをコピーオンライトで共有する
+preload_app = True
+
+
+# マスタープロセスが強制終了（SIGKILL）する前に終了処理を終えるように、graceful_timeout から差し引く時間 [sec]
+drain_margin = 1.0
+
+
+def post_worker_init(worker):
+    # ワーカーが SIGTERM を受けた時点で終了処理を開始する
+    # （worker_exit は処理中の HTTP リクエストを処理し終えた後に呼ばれるので、そこから待つと /ready が 503 を返さず、graceful_timeout を超えて強制終了される）
+    import signal
+
+    from app import start_drain
+
+    handle_exit = worker.handle_exit
+
+    def handle_sigterm(signum, frame):
+        start_drain(timeout=max(0.0, graceful_timeout - drain_margin))
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    signal.siginterrupt(signal.SIGTERM, False)
+
+
+def worker_exit(server, worker):
+    # SIGTERM で開始した終了処理（処理中・待機中の Slack コマンドの回答の生成）が終わるまで待つ
+    from app import start_drain
+
+    start_drain(timeout=max(0.0, graceful_timeout - drain_margin)).join()
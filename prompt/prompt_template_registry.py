@@ -0,0 +1,136 @@
+import hashlib
+import os
+import string
+import threading
+import time
+from typing import Dict, List, Optional
+
+import yaml
+
+from utils.logger import logger
+
+
+class CompiledPromptTemplate:
+    def __init__(self, name: str, template: str, input_variables: List[str]):
+        # テンプレートの変数を読み込み時に一度だけ検証し、format では str.format_map のみを行う
+        # （LangChain の PromptTemplate は、format の度に変数の検証と Python 実装の Formatter による置換を行う）
+        self.name = name
+        self.template = template
+        self.input_variables = list(input_variables)
+        self.template_hash = hashlib.sha256(template.encode("utf-8")).hexdigest()
+
+        field_names = set()
+        for _, field_name, format_spec, conversion in string.Formatter().parse(template):
+            if field_name is None:
+                continue
+            if field_name == "" or format_spec or conversion or not field_name.isidentifier():
+                raise ValueError(f"unsupported template field! | name={name} field={field_name!r}")
+            field_names.add(field_name)
+        if not field_names.issubset(self.input_variables):
+            raise ValueError(f"undefined template variables! | name={name} variables={sorted(field_names - set(self.input_variables))}")
+        return
+
+    def format(self, **kwargs):
+        return self.template.format_map(kwargs)
+
+
+class PromptTemplateRegistry:
+    def __init__(
+        self,
+        prompt_dir: str,
+        default_name: str,
+        reload_interval: float = 5.0,
+        channel_templates: Optional[Dict[str, str]] = None,
+    ):
+        # プロンプトファイルのディレクトリ内の全てのテンプレートを読み込み、ファイルが更新された場合は再起動せずに読み込み直す
+        self.prompt_dir = prompt_dir
+        self.default_name = default_name
+        self.reload_interval = reload_interval                  # ファイルの更新を確認する間隔 [sec]（0 以下の場合は確認しない）
+        self.channel_templates = channel_templates or {}        # Slack のチャンネル ID ごとのテンプレート名
+        self.templates: Dict[str, CompiledPromptTemplate] = {}
+        self.file_stats = {}
+        self.compiled_cache: Dict[str, CompiledPromptTemplate] = {}     # 内容のハッシュ値ごとのコンパイル済みテンプレート
+        self.last_check_time = 0.0
+        self.lock = threading.Lock()
+        self.load()
+        if self.default_name not in self.templates:
+            raise ValueError(f"default prompt template not found! | prompt_dir={prompt_dir} default_name={default_name}")
+        return
+
+    def compile(self, name, file_path):
+        with open(file_path, "r") as f:
+            prompt_yml = yaml.safe_load(f)
+        template, input_variables = prompt_yml["promptTemplate"], prompt_yml["inputVariables"]
+
+        # ファイルの更新時刻のみが変わり内容が同じ場合は、コンパイル済みのテンプレートを再利用する
+        content_hash = hashlib.sha256(f"{name}\n{input_variables}\n{template}".encode("utf-8")).hexdigest()
+        compiled = self.compiled_cache.get(content_hash)
+        if compiled is None:
+            compiled = CompiledPromptTemplate(name, template, input_variables)
+            self.compiled_cache[content_hash] = compiled
+        return compiled
+
+    def load(self):
+        # 追加・更新されたファイルのみを読み込み、削除されたファイルのテンプレートは破棄する
+        # 読み込みに失敗したファイルは、前回読み込んだテンプレートを使用し続ける
+        with self.lock:
+            file_names = sorted(file_name for file_name in os.listdir(self.prompt_dir) if file_name.endswith((".yml", ".yaml")))
+            names = set()
+            for file_name in file_names:
+                name = os.path.splitext(file_name)[0]
+                file_path = os.path.join(self.prompt_dir, file_name)
+                names.add(name)
+                try:
+                    stat = os.stat(file_path)
+                    file_stat = (stat.st_mtime_ns, stat.st_size)
+                    if self.file_stats.get(name) == file_stat:
+                        continue
+                    # 読み込みに失敗した場合も、ファイルが再度更新されるまでは読み込み直さない
+                    self.file_stats[name] = file_stat
+                    compiled = self.compile(name, file_path)
+                except Exception as e:
+                    logger.error(f"failed to load prompt file! | file_path={file_path} {e}")
+                    continue
+                if self.templates.get(name) is compiled:
+                    continue
+                if name in self.templates:
+                    logger.info(f"reload prompt template | name={name} template_hash={compiled.template_hash}")
+                self.templates[name] = compiled
+
+            for name in set(self.templates) - names:
+                if name == self.default_name:
+                    continue
+                logger.info(f"remove prompt template | name={name}")
+                del self.templates[name]
+            self.file_stats = {name: file_stat for name, file_stat in self.file_stats.items() if name in names}
+
+            self.compiled_cache = {key: compiled for key, compiled in self.compiled_cache.items() if compiled in self.templates.values()}
+            self.last_check_time = time.monotonic()
+        return
+
+    def maybe_reload(self):
+        if self.reload_interval <= 0 or time.monotonic() - self.last_check_time < self.reload_interval:
+            return
+        # 複数のリクエストスレッドが同時にファイルを確認しないように、確認時刻を先に更新する
+        self.last_check_time = time.monotonic()
+        try:
+            self.load()
+        except Exception as e:
+            logger.error(f"failed to reload prompt templates! | {e}")
+        return
+
+    def get(self, name: Optional[str] = None) -> CompiledPromptTemplate:
+        # 存在しないテンプレート名が指定された場合は、デフォルトのテンプレートを使用する
+        self.maybe_reload()
+        templates = self.templates
+        if name is not None and name not in templates:
+            logger.warning(f"prompt template not found! use default template | name={name} default_name={self.default_name}")
+        return templates.get(name or self.default_name) or templates[self.default_name]
+
+    def get_channel_template_name(self, channel_id: Optional[str]) -> Optional[str]:
+        # チャンネルごとのテンプレートが設定されていない場合は None（デフォルトのテンプレート）を返す
+        return self.channel_templates.get(channel_id)
+
+    def names(self):
+        self.maybe_reload()
+        return sorted(self.templates)
@@ -0,0 +1,54 @@
+import re
+import unicodedata
+
+import numpy as np
+
+from utils.cache import TTLCache
+from utils.logger import logger
+
+
+def normalize_question(question):
+    # 全角・半角や大文字・小文字、空白の違いのみの質問文を同一の質問として扱う
+    question = unicodedata.normalize("NFKC", question).lower()
+    return re.sub(r"\s+", " ", question).strip()
+
+
+class AnswerCache:
+    def __init__(
+        self,
+        maxsize: int = 1024,
+        ttl: float = 3600,
+        similarity_threshold: float = 0.0,
+    ):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.similarity_threshold = similarity_threshold
+        return
+
+    def get(self, question, context_key, question_embedding=None):
+        answer = self.cache.get((question, context_key))
+        if answer is not None:
+            return answer[0]
+
+        # 言い回しが異なるだけの質問文の場合も、検索された文章が同じで質問文の埋め込みベクトルが十分に近ければキャッシュを使用する
+        if self.similarity_threshold > 0 and question_embedding is not None:
+            candidates = [value for (_, key), value in self.cache.items() if key == context_key and value[1] is not None]
+            if len(candidates) > 0:
+                embeddings = np.array([embedding for _, embedding in candidates], dtype=np.float32)
+                query = np.array(question_embedding, dtype=np.float32)
+                similarities = embeddings @ query / (np.linalg.norm(embeddings, axis=1) * np.linalg.norm(query) + 1e-12)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    logger.info("answer cache near-duplicate hit | similarity=%.4f", similarities[best])
+                    with self.cache.lock:
+                        self.cache.misses -= 1
+                        self.cache.hits += 1
+                    return candidates[best][0]
+
+        return None
+
+    def set(self, question, context_key, answer, question_embedding=None):
+        self.cache.set((question, context_key), (answer, question_embedding))
+        return
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,106 @@
+import re
+from typing import List
+
+import tiktoken
+from langchain.docstore.document import Document
+
+from utils.cache import TTLCache
+from utils.logger import logger
+from utils.metrics import count_tokens, span
+
+
+class ContextBuilder:
+    def __init__(
+        self,
+        model_name: str,
+        max_tokens: int = 1500,
+        separator: str = "\n\n",
+        excluded_metadata_keys: List[str] = ("source", "row"),
+        min_overlap: int = 20,
+        token_cache_size: int = 4096,
+    ):
+        # 検索された文章を、プロンプトの {context} に入れる文字列にまとめる
+        # Document の repr をそのまま入れずに本文と必要なメタデータのみを出力し、関連度の高い順にトークン数の上限まで詰める
+        self.model_name = model_name
+        self.max_tokens = max_tokens                            # 0 以下の場合は上限なし
+        self.separator = separator
+        self.excluded_metadata_keys = set(excluded_metadata_keys)
+        self.min_overlap = min_overlap                          # 重複部分とみなすチャンク間の最小文字数
+        self.token_cache = TTLCache(maxsize=token_cache_size)   # 用語集の文章は同じものが繰り返し検索されるので、トークン数をキャッシュする
+        self.encoding = None
+        return
+
+    def get_encoding(self):
+        # tiktoken のエンコーディングは初回使用時に読み込む
+        if self.encoding is None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(self.model_name)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+        return self.encoding
+
+    def count_tokens(self, text: str) -> int:
+        n_tokens = self.token_cache.get(text)
+        if n_tokens is None:
+            n_tokens = len(self.get_encoding().encode(text, disallowed_special=()))
+            self.token_cache.set(text, n_tokens)
+        return n_tokens
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        encoding = self.get_encoding()
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+
+    def render(self, document: Document, text: str = None) -> str:
+        # 本文と、ファイルパス・行番号以外のメタデータのみを「キー: 値」の形式で出力する
+        lines = [(document.page_content if text is None else text).strip()]
+        for key, value in document.metadata.items():
+            if key in self.excluded_metadata_keys or value is None or value == "":
+                continue
+            lines.append(f"{key}: {value}")
+        return "\n".join(lines)
+
+    def get_overlap(self, prev_text: str, text: str) -> int:
+        # 同じ行から分割されたチャンクの場合は、前のチャンクの末尾と重複している先頭部分の文字数を返す
+        for n in range(min(len(prev_text), len(text)) - 1, self.min_overlap - 1, -1):
+            if prev_text.endswith(text[:n]):
+                return n
+        return 0
+
+    def deduplicate(self, documents: List[Document]) -> List[str]:
+        # 同じ内容の文章や、他の文章に含まれている文章は除外し、チャンク間で重複している部分は削除する
+        texts = []
+        selected = []
+        for document in documents:
+            text = re.sub(r"[ \t]+", " ", document.page_content).strip()
+            if len(text) == 0 or any(text in selected_text for selected_text, _ in selected):
+                continue
+            source = (document.metadata.get("source"), document.metadata.get("row"))
+            for selected_text, selected_source in selected:
+                if selected_source == source and source != (None, None):
+                    text = text[self.get_overlap(selected_text, text):]
+            selected.append((text, source))
+            texts.append(self.render(document, text))
+        return texts
+
+    def build(self, documents: List[Document]) -> str:
+        with span("context_build"):
+            texts = self.deduplicate(documents)
+
+            # 関連度の高い順（検索結果の順）に、トークン数の上限を超えない文章のみを詰める
+            separator_tokens = self.count_tokens(self.separator)
+            packed, n_tokens = [], 0
+            for text in texts:
+                text_tokens = self.count_tokens(text) + (separator_tokens if len(packed) > 0 else 0)
+                if self.max_tokens > 0 and n_tokens + text_tokens > self.max_tokens:
+                    # 最も関連度の高い文章が上限を超える場合のみ、上限までで切り詰める
+                    if len(packed) == 0:
+                        text = self.truncate(text, self.max_tokens)
+                        packed.append(text)
+                        n_tokens = self.count_tokens(text)
+                    continue
+                packed.append(text)
+                n_tokens += text_tokens
+
+        count_tokens("context", n_tokens)
+        logger.info("context packed | n_documents=%d/%d n_tokens=%d max_tokens=%s", len(packed), len(documents), n_tokens, self.max_tokens)
+        return self.separator.join(packed)
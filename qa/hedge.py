@@ -0,0 +1,226 @@
+import asyncio
+import queue
+import threading
+import time
+from typing import Optional
+
+from utils.deadline import CallExecutor, Deadline, DeadlineExceeded
+from utils.logger import logger
+from utils.metrics import count_event
+
+
+def once(func, *args, **kwargs):
+    # 回答をまとめて返す呼び出しを、要素が 1 つのストリームとして扱う
+    yield func(*args, **kwargs)
+
+
+async def aonce(coro_func, *args, **kwargs):
+    yield await coro_func(*args, **kwargs)
+
+
+# hedge_stream で primary・fallback を実行するスレッドプール（executor を指定しない場合）
+# primary・fallback の中で Deadline.call を使用するので、Deadline.call とは別のスレッドプールにする（同じスレッドプールの空きを待ち合わないようにする）
+default_hedge_executor = CallExecutor(name="hedge")
+
+
+def hedge_stream(
+    primary,
+    fallback,
+    delay: Optional[float] = None,
+    deadline: Optional[Deadline] = None,
+    name: str = "hedge",
+    executor: Optional[CallExecutor] = None,
+):
+    # primary・fallback はトークンのイテレーターを返す関数
+    # primary が delay 秒以内にトークンを返し始めない場合は fallback も並行して開始し、先にトークンを返し始めた方の回答を返す
+    # delay が None の場合は、primary がトークンを返す前に失敗した場合のみ fallback を開始する
+    deadline = deadline or Deadline()
+    executor = executor or default_hedge_executor
+    if delay is None:
+        yield from run_fallback_on_error(primary, fallback, deadline, name)
+        return
+
+    events = queue.Queue()
+    stop_events = [threading.Event(), threading.Event()]
+
+    def produce(index, factory):
+        tokens = None
+        try:
+            tokens = factory()
+            for token in tokens:
+                if stop_events[index].is_set():
+                    break
+                events.put((index, "token", token))
+            events.put((index, "done", None))
+        except Exception as e:
+            events.put((index, "error", e))
+        finally:
+            if hasattr(tokens, "close"):
+                tokens.close()
+
+    def start(index, factory, reason=None):
+        # 呼び出し元のコンテキスト（処理中のリクエストのトレースなど）を引き継いで、スレッドプールで実行する
+        # 採用されなかった方の上流の API の呼び出しも、リクエスト自体のタイムアウト（期限までの残り時間）で打ち切られる
+        if reason is not None:
+            logger.info(f"[{name}] start fallback | reason={reason}")
+            count_event(f"{name}_fallback", reason=reason)
+        futures[index] = executor.submit(deadline.run, produce, index, factory)
+        return True
+
+    futures = [None, None]
+    is_started = [start(0, primary), False]
+    is_failed = [False, False]
+    hedge_at = time.monotonic() + delay
+    winner = None
+    try:
+        while True:
+            timeout = deadline.get_timeout(None if is_started[1] else max(0.0, hedge_at - time.monotonic()))
+            try:
+                index, kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                if not is_started[1] and time.monotonic() >= hedge_at:
+                    is_started[1] = start(1, fallback, reason="delay")
+                    continue
+                deadline.check(name)
+                continue
+
+            if winner is None:
+                if kind == "error":
+                    is_failed[index] = True
+                    logger.warning(f"[{name}] {'primary' if index == 0 else 'fallback'} failed! | {value}")
+                    # primary が失敗した場合はすぐに fallback を開始し、両方とも失敗した場合はエラーとする
+                    if not is_started[1]:
+                        is_started[1] = start(1, fallback, reason="error")
+                    elif all(is_failed):
+                        raise value
+                    continue
+                # 先にトークンを返し始めた方を採用し、もう一方は停止する
+                winner = index
+                stop_events[1 - winner].set()
+                if is_started[1]:
+                    count_event(f"{name}_hedge", winner="primary" if winner == 0 else "fallback")
+
+            if index != winner:
+                continue
+            if kind == "token":
+                yield value
+            elif kind == "done":
+                return
+            else:
+                raise value
+    finally:
+        # 実行待ちのものは取り消し、実行中のものはトークンを受け取った時点で停止する
+        for stop_event, future in zip(stop_events, futures):
+            stop_event.set()
+            if future is not None:
+                future.cancel()
+
+
+def run_fallback_on_error(primary, fallback, deadline: Deadline, name: str):
+    # 並行して開始しない場合は、呼び出し元のスレッドでそのまま実行する
+    n_tokens = 0
+    try:
+        for token in deadline.iter(primary(), name):
+            n_tokens += 1
+            yield token
+        return
+    except Exception as e:
+        # 期限切れで API のリクエストがタイムアウトした場合は、やり直さずに期限切れとする
+        if deadline.is_expired() and not isinstance(e, DeadlineExceeded):
+            raise deadline.exceeded(name) from e
+        # 既にトークンを返している場合は、途中から回答をやり直せないのでそのままエラーとする
+        if n_tokens > 0 or deadline.is_expired():
+            raise
+        logger.warning(f"[{name}] primary failed! start fallback | {e}")
+        count_event(f"{name}_fallback", reason="error")
+    yield from deadline.iter(fallback(), name)
+
+
+async def ahedge_stream(primary, fallback, delay: Optional[float] = None, deadline: Optional[Deadline] = None, name: str = "hedge"):
+    # hedge_stream の非同期ジェネレーター版（採用されなかった方のタスクはキャンセルする）
+    deadline = deadline or Deadline()
+    if delay is None:
+        async for token in arun_fallback_on_error(primary, fallback, deadline, name):
+            yield token
+        return
+
+    events = asyncio.Queue()
+
+    async def produce(index, factory):
+        tokens = factory()
+        try:
+            async for token in tokens:
+                events.put_nowait((index, "token", token))
+            events.put_nowait((index, "done", None))
+        except Exception as e:
+            events.put_nowait((index, "error", e))
+        finally:
+            await tokens.aclose()
+
+    def start(index, factory, reason=None):
+        if reason is not None:
+            logger.info(f"[{name}] start fallback | reason={reason}")
+            count_event(f"{name}_fallback", reason=reason)
+        return asyncio.ensure_future(produce(index, factory))
+
+    tasks = [start(0, primary), None]
+    is_failed = [False, False]
+    hedge_at = time.monotonic() + delay
+    winner = None
+    try:
+        while True:
+            timeout = deadline.get_timeout(None if tasks[1] is not None else max(0.0, hedge_at - time.monotonic()))
+            try:
+                index, kind, value = await asyncio.wait_for(events.get(), timeout)
+            except TimeoutError:
+                if tasks[1] is None and time.monotonic() >= hedge_at:
+                    tasks[1] = start(1, fallback, reason="delay")
+                    continue
+                deadline.check(name)
+                continue
+
+            if winner is None:
+                if kind == "error":
+                    is_failed[index] = True
+                    logger.warning(f"[{name}] {'primary' if index == 0 else 'fallback'} failed! | {value}")
+                    if tasks[1] is None:
+                        tasks[1] = start(1, fallback, reason="error")
+                    elif all(is_failed):
+                        raise value
+                    continue
+                winner = index
+                if tasks[1 - winner] is not None:
+                    tasks[1 - winner].cancel()
+                if tasks[1] is not None:
+                    count_event(f"{name}_hedge", winner="primary" if winner == 0 else "fallback")
+
+            if index != winner:
+                continue
+            if kind == "token":
+                yield value
+            elif kind == "done":
+                return
+            else:
+                raise value
+    finally:
+        for task in tasks:
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def arun_fallback_on_error(primary, fallback, deadline: Deadline, name: str):
+    n_tokens = 0
+    try:
+        async for token in deadline.aiter(primary(), name):
+            n_tokens += 1
+            yield token
+        return
+    except Exception as e:
+        if deadline.is_expired() and not isinstance(e, DeadlineExceeded):
+            raise deadline.exceeded(name) from e
+        if n_tokens > 0 or deadline.is_expired():
+            raise
+        logger.warning(f"[{name}] primary failed! start fallback | {e}")
+        count_event(f"{name}_fallback", reason="error")
+    async for token in deadline.aiter(fallback(), name):
+        yield token
@@ -0,0 +1,753 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import aclosing
+
+from db.feature import get_document_id
+from db.lexical_index import reciprocal_rank_fusion
+from db.vectorstore import similarity_search_with_relevance_scores_by_vectors
+from qa.cache import normalize_question
+from qa.hedge import ahedge_stream, aonce, hedge_stream, once
+from qa.single_flight import FlightCancelled
+from qa.streaming import AsyncQueueCallbackHandler, QueueCallbackHandler
+from utils.deadline import Deadline, current_deadline, get_current_deadline
+from utils.logger import Payload, logger
+from utils.metrics import aiter_span, count_event, iter_span, span
+
+# リクエストごとに検索した文章（RAGBot ツールから参照する）
+# スレッドローカルではなくコンテキスト変数で保持し、非同期に処理する場合もリクエストごとに分ける
+retrieved_context = contextvars.ContextVar("retrieved_context", default=[])
+selected_prompt_template = contextvars.ContextVar("selected_prompt_template", default=None)
+
+
+@contextlib.contextmanager
+def tool_context(context, prompt_template, deadline):
+    # Agent から呼び出されたツールが、検索済みの文章・テンプレート・リクエストの期限を参照できるようにする
+    tokens = [
+        (retrieved_context, retrieved_context.set(context)),
+        (selected_prompt_template, selected_prompt_template.set(prompt_template)),
+        (current_deadline, current_deadline.set(deadline)),
+    ]
+    try:
+        yield
+    finally:
+        for context_var, token in reversed(tokens):
+            context_var.reset(token)
+
+
+class AnswerPipeline:
+    def __init__(
+        self,
+        llm,
+        emb_model,
+        prompt_registry,
+        model_name: str,
+        retriever_top_k: int = 4,
+        retriever_score_threshold: float = 0.7,
+        use_function_calling: bool = False,
+        answer_cache=None,
+        single_flight=None,
+        context_builder=None,
+        route_confidence_threshold=None,
+        request_timeout=None,
+        hedge_delay=None,
+        agent_breaker=None,
+        search_breaker=None,
+        call_executor=None,
+        hedge_executor=None,
+    ):
+        self.llm = llm
+        self.emb_model = emb_model
+        self.prompt_registry = prompt_registry
+        self.model_name = model_name
+        self.answer_cache = answer_cache
+        self.single_flight = single_flight
+        self.context_builder = context_builder
+        self.retriever_top_k = retriever_top_k
+        self.retriever_score_threshold = retriever_score_threshold
+        self.route_confidence_threshold = route_confidence_threshold    # Agent を経由せずに RAG で回答する検索結果の類似度（None の場合は常に Agent を使用する）
+        self.request_timeout = request_timeout                          # 1 質問あたりの回答生成の期限 [sec]（None の場合は期限なし）
+        self.hedge_delay = hedge_delay                                  # Agent と並行して RAG で回答し始めるまでの時間 [sec]（None の場合は Agent が失敗した場合のみ）
+        self.agent_breaker = agent_breaker
+        self.search_breaker = search_breaker
+        self.call_executor = call_executor                              # 期限までのみ待つ同期の呼び出し（埋め込み・Agent）を実行するスレッドプール
+        self.hedge_executor = hedge_executor                            # Agent と RAG を並行して実行するスレッドプール
+
+        # define Agent
+        # Chain・Agent・Tool はリクエストごとに作成せずに、起動時に一度だけ作成する
+        self.agent = None
+        if use_function_calling:
+            # Agent・Tool のモジュールは import に時間がかかるので、Function calling を使用する場合のみ import する
+            from langchain.agents import AgentType, Tool, initialize_agent
+            from langchain.utilities import SerpAPIWrapper
+
+            self.search = SerpAPIWrapper()
+            tools = [
+                Tool(
+                    name="RAGBot",
+                    func=self.traced_tool("tool_rag", self.run_rag_tool),
+                    coroutine=self.atraced_tool("tool_rag", self.arun_rag_tool),
+                    description="RAG を使用して LLM が学習に使用していない特定ドメインの質問応答を行うbot"
+                ),
+                Tool(
+                    name="GoogleSearch",
+                    func=self.traced_tool("tool_google_search", self.run_search),
+                    coroutine=self.atraced_tool("tool_google_search", self.arun_search),
+                    description="useful for when you need to answer questions about current events. You should ask targeted questions"
+                ),
+            ]
+            self.agent = initialize_agent(
+                tools,
+                llm,
+                agent=AgentType.OPENAI_FUNCTIONS,
+                verbose=True,
+            )
+        return
+
+    def new_deadline(self):
+        return Deadline(self.request_timeout, executor=self.call_executor)
+
+    def traced_tool(self, stage, func):
+        # Agent から呼び出されたツールの処理時間を記録する
+        def run(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return run
+
+    def atraced_tool(self, stage, coroutine_func):
+        async def arun(*args, **kwargs):
+            with span(stage):
+                return await coroutine_func(*args, **kwargs)
+        return arun
+
+    def run_search(self, query):
+        # Google 検索のエラー・遅延が続いている場合は検索せずにエラーとし、Agent が失敗したものとして RAG で回答する
+        if self.search_breaker is None:
+            return self.search.run(query)
+        return self.search_breaker.call(self.search.run, query)
+
+    async def arun_search(self, query):
+        # Google 検索も、共有の HTTP セッション（AsyncRunner の aiohttp セッション）で行う
+        import openai
+
+        self.search.aiosession = openai.aiosession.get()
+
+        async def search():
+            return await get_current_deadline().wait_for(self.search.arun(query), "tool_google_search")
+
+        if self.search_breaker is None:
+            return await search()
+        return await self.search_breaker.acall(search)
+
+    def retrieve_exact(self, question, lexical_index=None):
+        # 質問文に用語集の用語がそのまま含まれている場合は、入力文の埋め込みを行わずに該当する文章を返す
+        if lexical_index is None:
+            return []
+        with span("exact_term_search"):
+            docs = lexical_index.search_exact(question, k=self.retriever_top_k)
+        if len(docs) > 0:
+            count_event("exact_term_search", result="hit")
+            logger.info("exact term hit | n_docs=%d", len(docs))
+            logger.debug("docs=%s", Payload(docs))
+        else:
+            count_event("exact_term_search", result="miss")
+        return docs
+
+    def retrieve(self, feature_db, question, lexical_index=None):
+        return self.retrieve_with_confidence(feature_db, question, lexical_index)[0]
+
+    async def aretrieve(self, feature_db, question, lexical_index=None, deadline=None):
+        return (await self.aretrieve_with_confidence(feature_db, question, lexical_index, deadline))[0]
+
+    def retrieve_with_confidence(self, feature_db, question, lexical_index=None, deadline=None):
+        # 検索した文章と、用語集に該当する文章がある確からしさ（用語の完全一致の場合は 1.0、それ以外は最も高い類似度）を返す
+        deadline = deadline or Deadline()
+        docs = self.retrieve_exact(question, lexical_index)
+        if len(docs) > 0:
+            return docs, 1.0
+        if deadline.remaining() is None or not hasattr(self.emb_model, "pin_query_embedding"):
+            return self.retrieve_similar(feature_db, question, lexical_index)
+
+        # 入力文の埋め込み（API の呼び出し）は途中でキャンセルできないので、期限までのみ待ってから類似度検索を行う
+        embedding = deadline.call(self.emb_model.embed_query, "query_embedding", question)
+        with self.emb_model.pin_query_embedding(question, embedding):
+            return self.retrieve_similar(feature_db, question, lexical_index)
+
+    async def aretrieve_with_confidence(self, feature_db, question, lexical_index=None, deadline=None):
+        deadline = deadline or Deadline()
+        docs = self.retrieve_exact(question, lexical_index)
+        if len(docs) > 0:
+            return docs, 1.0
+
+        # 入力文の埋め込みのみを非同期に行い、類似度検索（CPU 処理）はイベントループを止めないようにスレッドで行う
+        if not hasattr(self.emb_model, "pin_query_embedding"):
+            return await deadline.wait_for(asyncio.to_thread(self.retrieve_similar, feature_db, question, lexical_index), "vector_search")
+        embedding = await deadline.wait_for(self.emb_model.aembed_query(question), "query_embedding")
+        with self.emb_model.pin_query_embedding(question, embedding):
+            return await deadline.wait_for(asyncio.to_thread(self.retrieve_similar, feature_db, question, lexical_index), "vector_search")
+
+    def retrieve_similar(self, feature_db, question, lexical_index=None):
+        # 特徴量データベース（VectorDB）から、ユーザーからの入力文に対して類似度の高い分割文章を検索＆取得
+        # 入力文の埋め込みと類似度検索は 1 リクエストにつき 1 回のみ行う（vector_search には query_embedding の時間も含む）
+        with span("vector_search"):
+            docs_and_scores = feature_db.similarity_search_with_relevance_scores(
+                question,
+                k=self.retriever_top_k,                                 # 上位 k 個の分割文章を検索＆取得
+                score_threshold=self.retriever_score_threshold,         # スレッショルド値
+            )
+        return self.fuse_lexical(question, docs_and_scores, lexical_index)
+
+    def fuse_lexical(self, question, docs_and_scores, lexical_index=None):
+        logger.debug("docs_and_scores=%s", Payload(docs_and_scores))
+        docs = [doc for doc, score in docs_and_scores]
+        # n-gram 検索のみでみつかった文章は類似度が低いので、確からしさには含めない
+        confidence = max((score for doc, score in docs_and_scores), default=0.0)
+        if lexical_index is None:
+            return docs, confidence
+
+        # 類似度がスレッショルド値を下回る短い用語も拾えるように、用語の n-gram 検索の結果と統合する
+        with span("lexical_search"):
+            lexical_docs = lexical_index.search(question, k=self.retriever_top_k)
+        return reciprocal_rank_fusion([docs, lexical_docs], k=self.retriever_top_k), confidence
+
+    def embed_queries(self, texts):
+        if len(texts) == 0:
+            return []
+        if hasattr(self.emb_model, "embed_queries"):
+            return self.emb_model.embed_queries(texts)
+        with span("query_embedding"):
+            return self.emb_model.embed_documents(texts)
+
+    async def aembed_queries(self, texts):
+        if len(texts) == 0:
+            return []
+        if hasattr(self.emb_model, "aembed_queries"):
+            return await self.emb_model.aembed_queries(texts)
+        with span("query_embedding"):
+            return await self.emb_model.aembed_documents(texts)
+
+    def retrieve_exact_batch(self, questions, lexical_index=None):
+        # 用語が完全一致しなかった質問文（と、回答キャッシュの類似度の計算に使用する場合は全ての質問文）を、まとめて埋め込む質問文とする
+        results = [self.retrieve_exact(question, lexical_index) for question in questions]
+        results = [(docs, 1.0) if len(docs) > 0 else None for docs in results]
+        embed_all = self.answer_cache is not None and self.answer_cache.similarity_threshold > 0
+        return results, [question for question, result in zip(questions, results) if result is None or embed_all]
+
+    def retrieve_similar_batch(self, feature_db, questions, results, embeddings, lexical_index=None):
+        # 用語が完全一致しなかった質問文は、埋め込みベクトルの行列で 1 回のみ類似度検索を行う
+        missing_questions = [question for question, result in zip(questions, results) if result is None]
+        with span("vector_search"):
+            docs_and_scores_list = similarity_search_with_relevance_scores_by_vectors(
+                feature_db,
+                [embeddings[question] for question in missing_questions],
+                k=self.retriever_top_k,
+                score_threshold=self.retriever_score_threshold,
+            )
+        searched = {
+            question: self.fuse_lexical(question, docs_and_scores, lexical_index)
+            for question, docs_and_scores in zip(missing_questions, docs_and_scores_list)
+        }
+        return [result if result is not None else searched[question] for question, result in zip(questions, results)]
+
+    def select_route(self, confidence):
+        # 用語集に該当する文章がある可能性が高い質問は、Agent（ツールを選択するための LLM の呼び出し）を経由せずに直接 RAG で回答する
+        # 確からしさが低い質問のみ Agent を使用し、必要に応じて Google 検索を行う
+        if self.agent is None:
+            return "rag"
+        # Agent のエラー・遅延が続いている場合も、Agent を使用せずに RAG で回答する
+        if self.route_confidence_threshold is not None and confidence >= self.route_confidence_threshold:
+            route, reason = "rag", "high_confidence"
+        elif self.agent_breaker is not None and not self.agent_breaker.allow():
+            route, reason = "rag", "circuit_open"
+        else:
+            route, reason = "agent", "low_confidence"
+        count_event("answer_route", route=route, reason=reason)
+        logger.info("answer route | route=%s reason=%s confidence=%.3f threshold=%s", route, reason, confidence, self.route_confidence_threshold)
+        return route
+
+    def format_prompt(self, question, context, prompt_template=None):
+        # 検索された文章は、トークン数の上限までコンパクトな文字列にまとめてからプロンプトに入れる
+        if self.context_builder is not None:
+            context = self.context_builder.build(context)
+        with span("prompt_format"):
+            prompt = (prompt_template or self.prompt_registry.get()).format(question=question, context=context)
+        logger.debug("prompt=%s", Payload(prompt))
+        return prompt
+
+    def get_llm_kwargs(self, deadline):
+        # 同期の呼び出しは途中でキャンセルできないので、API のリクエスト自体のタイムアウトを期限までの残り時間にする
+        timeout = deadline.get_timeout()
+        return {} if timeout is None else {"request_timeout": timeout}
+
+    def run_rag(self, question, context, prompt_template=None, deadline=None):
+        # 検索済みの文章からプロンプトを作成して、LLM に直接入力する
+        deadline = deadline or Deadline()
+        prompt = self.format_prompt(question, context, prompt_template)
+        deadline.check("llm")
+        with span("llm"):
+            return self.llm.predict(prompt, **self.get_llm_kwargs(deadline))
+
+    async def arun_rag(self, question, context, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        prompt = self.format_prompt(question, context, prompt_template)
+        with span("llm"):
+            return await deadline.wait_for(self.llm.apredict(prompt), "llm")
+
+    def run_rag_tool(self, query):
+        # Agent から RAGBot ツールが呼び出された場合も、再度検索を行わずに検索済みの文章を使用する
+        return self.run_rag(query, retrieved_context.get(), selected_prompt_template.get(), get_current_deadline())
+
+    async def arun_rag_tool(self, query):
+        return await self.arun_rag(query, retrieved_context.get(), selected_prompt_template.get(), get_current_deadline())
+
+    def stream_rag(self, question, context, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        prompt = self.format_prompt(question, context, prompt_template)
+        deadline.check("llm")
+        for token in iter_span("llm", deadline.iter(self.llm.stream(prompt, **self.get_llm_kwargs(deadline)), "llm")):
+            yield token
+
+    async def astream_rag(self, question, context, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        prompt = self.format_prompt(question, context, prompt_template)
+        async for token in aiter_span("llm", deadline.aiter(self.llm.astream(prompt), "llm")):
+            yield token
+
+    def run_agent(self, question, context, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        prompt = self.format_prompt(question, context, prompt_template)
+
+        def run_agent():
+            with tool_context(context, prompt_template, deadline), span("agent"):
+                return self.agent.run(prompt)
+
+        # 同期の Agent は途中でキャンセルできないので、スレッドプールで実行して期限までのみ待つ
+        return deadline.call(run_agent, "agent")
+
+    async def arun_agent(self, question, context, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        prompt = self.format_prompt(question, context, prompt_template)
+        with tool_context(context, prompt_template, deadline), span("agent"):
+            return await deadline.wait_for(self.agent.arun(prompt), "agent")
+
+    def stream_agent(self, question, context, prompt_template=None, deadline=None):
+        # Agent は別スレッドで実行し、LLM が生成したトークンをコールバック経由でキューから受け取る
+        deadline = deadline or Deadline()
+        token_queue = queue.Queue()
+        result = {}
+
+        def run_agent():
+            try:
+                prompt = self.format_prompt(question, context, prompt_template)
+                with tool_context(context, prompt_template, deadline), span("agent"):
+                    result["answer"] = self.agent.run(prompt, callbacks=[QueueCallbackHandler(token_queue)])
+            except Exception as e:
+                result["error"] = e
+            finally:
+                token_queue.put(None)
+
+        # 処理中のリクエストのトレースに Agent の処理時間も記録されるように、コンテキストを引き継いでスレッドプールで実行する
+        future = deadline.executor.submit(run_agent)
+
+        # 期限を過ぎた場合は、Agent の完了を待たずにエラーとする（実行待ちの場合は取り消す）
+        n_tokens = 0
+        while True:
+            try:
+                token = token_queue.get(timeout=deadline.remaining())
+            except queue.Empty:
+                future.cancel()
+                raise deadline.exceeded("agent") from None
+            if token is None:
+                break
+            n_tokens += 1
+            yield token
+        future.result()
+
+        if "error" in result:
+            raise result["error"]
+
+        # LLM がトークン単位で出力しなかった場合は、最終的な回答をまとめて返す
+        if n_tokens == 0:
+            yield result["answer"]
+
+    async def astream_agent(self, question, context, prompt_template=None, deadline=None):
+        # Agent は別タスクで実行し、LLM が生成したトークンをコールバック経由でキューから受け取る
+        deadline = deadline or Deadline()
+        token_queue = asyncio.Queue()
+
+        async def run_agent():
+            try:
+                prompt = self.format_prompt(question, context, prompt_template)
+                with tool_context(context, prompt_template, deadline), span("agent"):
+                    return await self.agent.arun(prompt, callbacks=[AsyncQueueCallbackHandler(token_queue)])
+            finally:
+                token_queue.put_nowait(None)
+
+        task = asyncio.ensure_future(run_agent())
+        try:
+            n_tokens = 0
+            while True:
+                token = await deadline.wait_for(token_queue.get(), "agent")
+                if token is None:
+                    break
+                n_tokens += 1
+                yield token
+            answer = await task
+        finally:
+            if not task.done():
+                task.cancel()
+
+        # LLM がトークン単位で出力しなかった場合は、最終的な回答をまとめて返す
+        if n_tokens == 0:
+            yield answer
+
+    def prepare(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        normalized_question = normalize_question(question)
+        deadline.check("retrieve")
+        context, confidence = self.retrieve_with_confidence(feature_db, normalized_question, lexical_index, deadline)
+        question_embedding = None
+        if self.answer_cache is not None and self.answer_cache.similarity_threshold > 0:
+            question_embedding = deadline.call(self.emb_model.embed_query, "query_embedding", normalized_question)
+        context, cache_args, cached_answer = self.lookup_answer_cache(
+            normalized_question, context, feature_db_version, question_embedding, prompt_template
+        )
+        return context, confidence, cache_args, cached_answer
+
+    async def aprepare(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        normalized_question = normalize_question(question)
+        context, confidence = await self.aretrieve_with_confidence(feature_db, normalized_question, lexical_index, deadline)
+        question_embedding = None
+        if self.answer_cache is not None and self.answer_cache.similarity_threshold > 0:
+            question_embedding = await deadline.wait_for(self.emb_model.aembed_query(normalized_question), "query_embedding")
+        context, cache_args, cached_answer = self.lookup_answer_cache(
+            normalized_question, context, feature_db_version, question_embedding, prompt_template
+        )
+        return context, confidence, cache_args, cached_answer
+
+    def prepare_batch(self, feature_db, questions, feature_db_version=None, lexical_index=None, prompt_template=None, deadline=None):
+        # 正規化済みの質問文ごとに prepare と同じ結果を返す（入力文の埋め込みと類似度検索は、全ての質問文でまとめて 1 回のみ行う）
+        deadline = deadline or Deadline()
+        deadline.check("retrieve")
+        results, texts = self.retrieve_exact_batch(questions, lexical_index)
+        embeddings = dict(zip(texts, deadline.call(self.embed_queries, "query_embedding", texts)))
+        deadline.check("vector_search")
+        results = self.retrieve_similar_batch(feature_db, questions, results, embeddings, lexical_index)
+        return self.lookup_answer_cache_batch(questions, results, embeddings, feature_db_version, prompt_template)
+
+    async def aprepare_batch(self, feature_db, questions, feature_db_version=None, lexical_index=None, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        results, texts = self.retrieve_exact_batch(questions, lexical_index)
+        embeddings = dict(zip(texts, await deadline.wait_for(self.aembed_queries(texts), "query_embedding")))
+        results = await deadline.wait_for(
+            asyncio.to_thread(self.retrieve_similar_batch, feature_db, questions, results, embeddings, lexical_index), "vector_search"
+        )
+        return self.lookup_answer_cache_batch(questions, results, embeddings, feature_db_version, prompt_template)
+
+    def lookup_answer_cache_batch(self, questions, results, embeddings, feature_db_version=None, prompt_template=None):
+        prepared = []
+        for question, (context, confidence) in zip(questions, results):
+            question_embedding = None
+            if self.answer_cache is not None and self.answer_cache.similarity_threshold > 0:
+                question_embedding = embeddings[question]
+            context, cache_args, cached_answer = self.lookup_answer_cache(question, context, feature_db_version, question_embedding, prompt_template)
+            prepared.append((context, confidence, cache_args, cached_answer))
+        return prepared
+
+    def lookup_answer_cache(self, normalized_question, context, feature_db_version=None, question_embedding=None, prompt_template=None):
+        # 質問文・検索された文章・プロンプトテンプレート・LLM が同じ場合は、キャッシュされた回答を返す
+        # （回答の経路は検索された文章から決まるので、キャッシュのキーには含めない）
+        cache_args = None
+        cached_answer = None
+        if self.answer_cache is not None:
+            # 特徴量データベースのバージョンもキーに含める（切り替え中に新旧のバージョンのリクエストが混在してもキャッシュを破棄しない。古いバージョンの回答は LRU・TTL で破棄される）
+            prompt_template = prompt_template or self.prompt_registry.get()
+            context_key = (tuple(get_document_id(doc) for doc in context), prompt_template.template_hash, self.model_name, feature_db_version)
+            cache_args = (normalized_question, context_key, question_embedding)
+            cached_answer = self.answer_cache.get(*cache_args)
+            if cached_answer is not None:
+                count_event("answer_cache", result="hit")
+                logger.info("answer cache hit | stats=%s", self.answer_cache.stats())
+            else:
+                count_event("answer_cache", result="miss")
+
+        return context, cache_args, cached_answer
+
+    def get_flight_key(self, question, feature_db_version=None, prompt_template=None):
+        # 回答キャッシュと同じく、表記ゆれのみの質問文は同一の質問として扱う（テンプレートが異なる場合は別の質問とする）
+        return (normalize_question(question), feature_db_version, prompt_template.template_hash)
+
+    def answer(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_name=None):
+        # リクエストごとに指定されたテンプレート（指定がない場合はデフォルトのテンプレート）を使用する
+        # 回答の生成（埋め込み・LLM・Google 検索の呼び出し）は、リクエストごとに request_timeout 秒以内に打ち切る
+        prompt_template = self.prompt_registry.get(prompt_name)
+        deadline = self.new_deadline()
+        if self.single_flight is None:
+            return self.generate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+
+        # 同じ質問を処理中の場合は、埋め込み・LLM を呼び出さずに処理中の回答を待つ
+        flight, is_leader = self.single_flight.join(self.get_flight_key(question, feature_db_version, prompt_template))
+        if is_leader:
+            return self.single_flight.run(flight, self.generate, feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+        try:
+            return flight.wait()
+        except FlightCancelled:
+            return self.generate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+
+    async def aanswer(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_name=None):
+        prompt_template = self.prompt_registry.get(prompt_name)
+        deadline = self.new_deadline()
+        if self.single_flight is None:
+            return await self.agenerate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+
+        flight, is_leader = self.single_flight.join(self.get_flight_key(question, feature_db_version, prompt_template))
+        if is_leader:
+            coro = self.agenerate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+            return await self.single_flight.arun(flight, coro)
+        try:
+            return await flight.await_result()
+        except FlightCancelled:
+            return await self.agenerate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+
+    def stream_answer(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_name=None):
+        # 回答をトークン単位で逐次返す
+        prompt_template = self.prompt_registry.get(prompt_name)
+        deadline = self.new_deadline()
+        if self.single_flight is None:
+            yield from self.stream_generate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+            return
+
+        # 後続リクエストは、先行リクエストが生成済みのトークンから順に返す
+        flight, is_leader = self.single_flight.join(self.get_flight_key(question, feature_db_version, prompt_template))
+        if is_leader:
+            tokens = self.stream_generate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+            yield from self.single_flight.stream(flight, tokens)
+            return
+        n_tokens = 0
+        try:
+            for token in flight.iter_tokens():
+                n_tokens += 1
+                yield token
+        except FlightCancelled:
+            # 先行リクエストがトークンを返す前に中断した場合は、自身で回答を生成する
+            if n_tokens > 0:
+                raise
+            yield from self.stream_generate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+        return
+
+    async def astream_answer(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_name=None):
+        # stream_answer の非同期ジェネレーター版
+        prompt_template = self.prompt_registry.get(prompt_name)
+        deadline = self.new_deadline()
+        if self.single_flight is None:
+            async with aclosing(self.astream_generate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)) as tokens:
+                async for token in tokens:
+                    yield token
+            return
+
+        flight, is_leader = self.single_flight.join(self.get_flight_key(question, feature_db_version, prompt_template))
+        if is_leader:
+            tokens = self.astream_generate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+            tokens = self.single_flight.astream(flight, tokens)
+            async with aclosing(tokens):
+                async for token in tokens:
+                    yield token
+            return
+        n_tokens = 0
+        try:
+            async for token in flight.aiter_tokens():
+                n_tokens += 1
+                yield token
+        except FlightCancelled:
+            if n_tokens > 0:
+                raise
+            async with aclosing(self.astream_generate(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)) as tokens:
+                async for token in tokens:
+                    yield token
+        return
+
+    def group_questions(self, questions):
+        # 表記ゆれのみの重複した質問文は 1 回のみ回答する（正規化した質問文 → 入力された質問文の位置のリスト）
+        groups = {}
+        for i, question in enumerate(questions):
+            groups.setdefault(normalize_question(question), []).append(i)
+        logger.info("answer batch | n_questions=%d n_unique_questions=%d", len(questions), len(groups))
+        return groups
+
+    def iter_answer_batch(self, feature_db, questions, feature_db_version=None, lexical_index=None, prompt_name=None, max_concurrency=1):
+        # 複数の質問文に回答し、回答が完了した質問文から順に (入力された質問文の位置のリスト, 回答, 例外) を返す
+        # 埋め込み・類似度検索は全ての質問文でまとめて行い、LLM の呼び出しは最大 max_concurrency 件まで並列に行う
+        # 回答の生成の期限（request_timeout）は、質問文ごとに回答の生成を開始した時点から数える
+        prompt_template = self.prompt_registry.get(prompt_name)
+        groups = self.group_questions(questions)
+        prepared = self.prepare_batch(feature_db, list(groups), feature_db_version, lexical_index, prompt_template, self.new_deadline())
+
+        def complete(indices, context, confidence, cache_args):
+            return self.complete(questions[indices[0]], context, confidence, cache_args, prompt_template, self.new_deadline())
+
+        executor = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(groups))), thread_name_prefix="answer-batch")
+        futures = {}
+        try:
+            for indices, (context, confidence, cache_args, answer) in zip(groups.values(), prepared):
+                if answer is not None:
+                    yield indices, answer, None
+                    continue
+                # 処理中のリクエストのトレースに回答の生成の処理時間も記録されるように、コンテキストを引き継ぐ
+                future = executor.submit(contextvars.copy_context().run, complete, indices, context, confidence, cache_args)
+                futures[future] = indices
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    logger.warning("failed to answer batch question! | question=%s %s", Payload(questions[futures[future][0]]), e)
+                    yield futures[future], None, e
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    async def aiter_answer_batch(self, feature_db, questions, feature_db_version=None, lexical_index=None, prompt_name=None, max_concurrency=1):
+        # iter_answer_batch の非同期ジェネレーター版（途中で中断された場合は、回答の生成中のタスクをキャンセルする）
+        prompt_template = self.prompt_registry.get(prompt_name)
+        groups = self.group_questions(questions)
+        prepared = await self.aprepare_batch(
+            feature_db, list(groups), feature_db_version, lexical_index, prompt_template, self.new_deadline()
+        )
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def complete(indices, context, confidence, cache_args):
+            async with semaphore:
+                return await self.acomplete(questions[indices[0]], context, confidence, cache_args, prompt_template, self.new_deadline())
+
+        tasks = {}
+        try:
+            for indices, (context, confidence, cache_args, answer) in zip(groups.values(), prepared):
+                if answer is not None:
+                    yield indices, answer, None
+                    continue
+                tasks[asyncio.ensure_future(complete(indices, context, confidence, cache_args))] = indices
+            pending = set(tasks)
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        logger.warning("failed to answer batch question! | question=%s %s", Payload(questions[tasks[task][0]]), task.exception())
+                        yield tasks[task], None, task.exception()
+                    else:
+                        yield tasks[task], task.result(), None
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def generate(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        context, confidence, cache_args, answer = self.prepare(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+        if answer is not None:
+            return answer
+
+        return self.complete(question, context, confidence, cache_args, prompt_template, deadline)
+
+    def complete(self, question, context, confidence, cache_args=None, prompt_template=None, deadline=None):
+        # 検索済みの文章から回答を生成して、回答キャッシュに保存する
+        # run LLLM prediction for QA task
+        answer = "".join(self.generate_tokens(question, context, confidence, prompt_template, deadline or Deadline(), stream=False))
+
+        if cache_args is not None:
+            self.answer_cache.set(*cache_args[:2], answer, cache_args[2])
+
+        return answer
+
+    async def agenerate(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        context, confidence, cache_args, answer = await self.aprepare(
+            feature_db, question, feature_db_version, lexical_index, prompt_template, deadline
+        )
+        if answer is not None:
+            return answer
+        return await self.acomplete(question, context, confidence, cache_args, prompt_template, deadline)
+
+    async def acomplete(self, question, context, confidence, cache_args=None, prompt_template=None, deadline=None):
+        tokens = self.agenerate_tokens(question, context, confidence, prompt_template, deadline or Deadline(), stream=False)
+        async with aclosing(tokens):
+            answer = "".join([token async for token in tokens])
+
+        if cache_args is not None:
+            self.answer_cache.set(*cache_args[:2], answer, cache_args[2])
+
+        return answer
+
+    def stream_generate(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        context, confidence, cache_args, answer = self.prepare(feature_db, question, feature_db_version, lexical_index, prompt_template, deadline)
+        if answer is not None:
+            yield answer
+            return
+
+        # run LLLM prediction for QA task
+        tokens = []
+        for token in self.generate_tokens(question, context, confidence, prompt_template, deadline, stream=True):
+            tokens.append(token)
+            yield token
+
+        if cache_args is not None:
+            self.answer_cache.set(*cache_args[:2], "".join(tokens), cache_args[2])
+        return
+
+    async def astream_generate(self, feature_db, question, feature_db_version=None, lexical_index=None, prompt_template=None, deadline=None):
+        deadline = deadline or Deadline()
+        context, confidence, cache_args, answer = await self.aprepare(
+            feature_db, question, feature_db_version, lexical_index, prompt_template, deadline
+        )
+        if answer is not None:
+            yield answer
+            return
+
+        # 途中で中断された場合も Agent のタスクを止めるように、内側の非同期ジェネレーターは明示的に閉じる
+        tokens = []
+        async with aclosing(self.agenerate_tokens(question, context, confidence, prompt_template, deadline, stream=True)) as stream:
+            async for token in stream:
+                tokens.append(token)
+                yield token
+
+        if cache_args is not None:
+            self.answer_cache.set(*cache_args[:2], "".join(tokens), cache_args[2])
+        return
+
+    def generate_tokens(self, question, context, confidence, prompt_template, deadline, stream=False):
+        # Agent を使用する場合は、Agent が hedge_delay 秒以内に回答を返し始めなければ RAG でも並行して回答を生成し、先に返し始めた方を使用する
+        # Agent が失敗した場合（用語集に該当情報がみつからない かつ Google 検索でも該当情報がみつからない場合など）は、すぐに RAG で回答する
+        # RAG のみで回答する場合も、回答を返し始める前に失敗した場合は一度だけやり直す
+        if stream:
+            rag = functools.partial(self.stream_rag, question, context, prompt_template, deadline)
+        else:
+            rag = functools.partial(once, self.run_rag, question, context, prompt_template, deadline)
+        if self.select_route(confidence) != "agent":
+            return hedge_stream(rag, rag, delay=None, deadline=deadline, name="rag")
+
+        if stream:
+            agent = functools.partial(self.stream_agent, question, context, prompt_template, deadline)
+        else:
+            agent = functools.partial(once, self.run_agent, question, context, prompt_template, deadline)
+        if self.agent_breaker is not None:
+            agent = functools.partial(self.agent_breaker.iter, agent())
+        return hedge_stream(agent, rag, delay=self.hedge_delay, deadline=deadline, name="agent", executor=self.hedge_executor)
+
+    def agenerate_tokens(self, question, context, confidence, prompt_template, deadline, stream=False):
+        # generate_tokens の非同期ジェネレーター版（採用されなかった方のタスクはキャンセルする）
+        if stream:
+            rag = functools.partial(self.astream_rag, question, context, prompt_template, deadline)
+        else:
+            rag = functools.partial(aonce, self.arun_rag, question, context, prompt_template, deadline)
+        if self.select_route(confidence) != "agent":
+            return ahedge_stream(rag, rag, delay=None, deadline=deadline, name="rag")
+
+        if stream:
+            agent = functools.partial(self.astream_agent, question, context, prompt_template, deadline)
+        else:
+            agent = functools.partial(aonce, self.arun_agent, question, context, prompt_template, deadline)
+        if self.agent_breaker is not None:
+            agent = functools.partial(self.agent_breaker.aiter, agent())
+        return ahedge_stream(agent, rag, delay=self.hedge_delay, deadline=deadline, name="agent")
@@ -0,0 +1,215 @@
+import asyncio
+import threading
+
+from utils.logger import logger
+from utils.metrics import count_event
+
+
+class FlightCancelled(Exception):
+    # 先行リクエストが回答の生成を途中でやめた場合（ストリーミング中のクライアントの切断など）
+    pass
+
+
+class Flight:
+    def __init__(self, key):
+        # 処理中の 1 つの質問の回答（生成済みのトークン）を、後から来た同じ質問のリクエストと共有する
+        self.key = key
+        self.tokens = []
+        self.is_done = False
+        self.error = None
+        self.n_followers = 0
+        self.condition = threading.Condition()
+        self.async_waiters = []
+        return
+
+    def publish(self, token):
+        with self.condition:
+            self.tokens.append(token)
+            self.notify()
+        return
+
+    def finish(self, error=None):
+        with self.condition:
+            self.is_done = True
+            self.error = error
+            self.notify()
+        return
+
+    def notify(self):
+        # スレッドで待っているリクエストと、イベントループで待っているリクエストの両方に通知する
+        self.condition.notify_all()
+        for loop, event in self.async_waiters:
+            loop.call_soon_threadsafe(event.set)
+        self.async_waiters = []
+        return
+
+    def iter_tokens(self):
+        # 生成済みのトークンを返した後、先行リクエストが生成したトークンを逐次返す
+        n_tokens = 0
+        while True:
+            with self.condition:
+                while n_tokens >= len(self.tokens) and not self.is_done:
+                    self.condition.wait()
+                tokens = self.tokens[n_tokens:]
+                is_done = self.is_done
+            for token in tokens:
+                yield token
+            n_tokens += len(tokens)
+            if is_done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+    async def aiter_tokens(self):
+        n_tokens = 0
+        loop = asyncio.get_running_loop()
+        while True:
+            event = None
+            with self.condition:
+                tokens = self.tokens[n_tokens:]
+                is_done = self.is_done
+                if len(tokens) == 0 and not is_done:
+                    event = asyncio.Event()
+                    self.async_waiters.append((loop, event))
+            if event is not None:
+                await event.wait()
+                continue
+            for token in tokens:
+                yield token
+            n_tokens += len(tokens)
+            if is_done:
+                if self.error is not None:
+                    raise self.error
+                return
+
+    def wait(self):
+        return "".join(self.iter_tokens())
+
+    async def await_result(self):
+        return "".join([token async for token in self.aiter_tokens()])
+
+
+class SingleFlight:
+    def __init__(self, name: str = "single-flight"):
+        # 同じ質問を処理中の場合は、上流の API（埋め込み・LLM）を再度呼び出さずに処理中の回答を待つ
+        self.name = name
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.n_leaders = 0
+        self.n_followers = 0
+        return
+
+    def join(self, key):
+        # 処理中の同じ質問がない場合は先行リクエスト（leader）として、ある場合は後続リクエスト（follower）として登録する
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = Flight(key)
+                self.flights[key] = flight
+                self.n_leaders += 1
+                is_leader = True
+            else:
+                flight.n_followers += 1
+                self.n_followers += 1
+                is_leader = False
+
+        count_event("single_flight", result="leader" if is_leader else "follower")
+        if not is_leader:
+            logger.info("[%s] join in-flight request | n_followers=%d", self.name, flight.n_followers)
+        return flight, is_leader
+
+    def finish(self, flight, error=None):
+        # 完了した質問は登録を解除し、以降の同じ質問は回答キャッシュから返す
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        flight.finish(error)
+        return
+
+    def get_error(self, e):
+        # KeyboardInterrupt・GeneratorExit・asyncio.CancelledError など、先行リクエストの中断は後続リクエストでは FlightCancelled とする
+        if isinstance(e, Exception):
+            return e
+        return FlightCancelled(f"in-flight request was cancelled | {type(e).__name__}")
+
+    def run(self, flight, func, *args, **kwargs):
+        error = None
+        try:
+            result = func(*args, **kwargs)
+            flight.publish(result)
+            return result
+        except BaseException as e:
+            error = self.get_error(e)
+            raise
+        finally:
+            self.finish(flight, error)
+
+    async def arun(self, flight, coro):
+        error = None
+        try:
+            result = await coro
+            flight.publish(result)
+            return result
+        except BaseException as e:
+            error = self.get_error(e)
+            raise
+        finally:
+            self.finish(flight, error)
+
+    def has_followers(self, flight):
+        # 後続リクエストがない場合は、以降の同じ質問が中断したリクエストに合流しないように登録を解除する
+        with self.lock:
+            if flight.n_followers == 0 and self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            return flight.n_followers > 0
+
+    def stream(self, flight, tokens):
+        error = None
+        try:
+            for token in tokens:
+                flight.publish(token)
+                yield token
+        except GeneratorExit as e:
+            # 先行リクエストのクライアントが切断した場合も、後続リクエストがあれば最後まで回答を生成して共有する
+            error = self.get_error(e)
+            if self.has_followers(flight):
+                try:
+                    for token in tokens:
+                        flight.publish(token)
+                    error = None
+                except Exception as drain_error:
+                    error = drain_error
+            raise
+        except BaseException as e:
+            error = self.get_error(e)
+            raise
+        finally:
+            tokens.close()
+            self.finish(flight, error)
+
+    async def astream(self, flight, tokens):
+        error = None
+        try:
+            async for token in tokens:
+                flight.publish(token)
+                yield token
+        except GeneratorExit as e:
+            error = self.get_error(e)
+            if self.has_followers(flight):
+                try:
+                    async for token in tokens:
+                        flight.publish(token)
+                    error = None
+                except Exception as drain_error:
+                    error = drain_error
+            raise
+        except BaseException as e:
+            error = self.get_error(e)
+            raise
+        finally:
+            await tokens.aclose()
+            self.finish(flight, error)
+
+    def stats(self):
+        with self.lock:
+            return {"n_in_flight": len(self.flights), "n_leaders": self.n_leaders, "n_followers": self.n_followers}
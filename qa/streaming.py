@@ -0,0 +1,147 @@
+import json
+import time
+
+import tiktoken
+from langchain.callbacks.base import AsyncCallbackHandler, BaseCallbackHandler
+
+from utils.async_runner import AsyncRunnerOverloaded
+from utils.deadline import DeadlineExceeded
+from utils.metrics import count_tokens
+
+
+class QueueCallbackHandler(BaseCallbackHandler):
+    def __init__(self, queue):
+        self.queue = queue
+        return
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if token:
+            self.queue.put(token)
+        return
+
+
+class AsyncQueueCallbackHandler(AsyncCallbackHandler):
+    def __init__(self, queue):
+        # asyncio.Queue に LLM が生成したトークンを入れる
+        self.queue = queue
+        return
+
+    async def on_llm_new_token(self, token: str, **kwargs) -> None:
+        if token:
+            self.queue.put_nowait(token)
+        return
+
+
+class TokenCountCallbackHandler(BaseCallbackHandler):
+    # 非同期に LLM を呼び出した場合も、スレッドプールを介さずにイベントループ内で集計する
+    run_inline = True
+
+    def __init__(self, model_name: str):
+        # Agent 内部での LLM の呼び出しも含めて、LLM に入力・出力したトークン数を集計する
+        self.model_name = model_name
+        self.encoding = None
+        return
+
+    def get_encoding(self):
+        if self.encoding is None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(self.model_name)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+        return self.encoding
+
+    def on_llm_start(self, serialized, prompts, **kwargs) -> None:
+        try:
+            count_tokens("prompt", sum(len(self.get_encoding().encode(prompt, disallowed_special=())) for prompt in prompts))
+        except Exception:
+            pass
+        return
+
+    def on_llm_new_token(self, token: str, **kwargs) -> None:
+        count_tokens("completion", 1)
+        return
+
+    def on_llm_end(self, response, **kwargs) -> None:
+        # ストリーミングしない場合は、API のレスポンスのトークン数を使用する
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if "completion_tokens" in token_usage:
+            count_tokens("completion", token_usage["completion_tokens"])
+        return
+
+
+def get_error(e):
+    if isinstance(e, DeadlineExceeded):
+        error = 'gateway_timeout'
+    elif isinstance(e, AsyncRunnerOverloaded):
+        error = 'service_unavailable'
+    else:
+        error = 'internal_server_error'
+    return {
+        'error': error,
+        'error_description': f'failed to generate answer! | {e}',
+    }
+
+
+def to_server_sent_events(tokens, question):
+    # Server-Sent-Events 形式で、LLM が生成したトークンを逐次返す
+    try:
+        for token in tokens:
+            yield f"data: {json.dumps({'token': token}, ensure_ascii=False)}\n\n"
+    except Exception as e:
+        yield f"event: error\ndata: {json.dumps(get_error(e), ensure_ascii=False)}\n\n"
+        return
+    yield f"event: end\ndata: {json.dumps({'question': question}, ensure_ascii=False)}\n\n"
+
+
+def to_batch_results(results, questions):
+    # (入力された質問文の位置のリスト, 回答, 例外) を、質問文ごとの回答・エラーに変換する
+    for indices, answer, error in results:
+        for i in indices:
+            result = {'index': i, 'question': questions[i]}
+            result.update({'answer': answer} if error is None else get_error(error))
+            yield result
+
+
+def to_json_lines(results, questions):
+    # JSON Lines 形式で、回答が完了した質問文から順に回答を返す（index は入力された質問文の位置）
+    try:
+        for result in to_batch_results(results, questions):
+            yield f"{json.dumps(result, ensure_ascii=False)}\n"
+    except Exception as e:
+        # 検索など、全ての質問文に共通の処理で失敗した場合は index なしのエラーを返す
+        yield f"{json.dumps(get_error(e), ensure_ascii=False)}\n"
+    return
+
+
+class ThrottledUpdater:
+    def __init__(self, update_func, interval: float = 1.0):
+        self.update_func = update_func
+        self.interval = interval
+        self.last_update_time = 0.0
+        self.last_text = None
+        return
+
+    def should_update(self, text, force=False):
+        # Slack API のレート制限にかからないように、一定間隔以上あけてメッセージを更新する
+        if text == self.last_text:
+            return False
+        return force or time.monotonic() - self.last_update_time >= self.interval
+
+    def update(self, text, force=False):
+        if not self.should_update(text, force):
+            return
+        now = time.monotonic()
+        self.update_func(text)
+        self.last_update_time = now
+        self.last_text = text
+        return
+
+    async def aupdate(self, text, force=False):
+        # update_func がコルーチン関数の場合
+        if not self.should_update(text, force):
+            return
+        now = time.monotonic()
+        await self.update_func(text)
+        self.last_update_time = now
+        self.last_text = text
+        return
@@ -0,0 +1,91 @@
+import csv
+import hashlib
+import json
+import os
+import threading
+import uuid
+from typing import Dict, List, Optional
+
+from utils.logger import logger
+
+
+def get_row_hash(row: List[str]) -> str:
+    return hashlib.sha256(json.dumps(row, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def get_csv_row_hashes(file_path: str) -> List[str]:
+    # ヘッダー行を除いた各行のハッシュ値
+    with open(file_path, newline="") as f:
+        rows = list(csv.reader(f))
+    return [get_row_hash(row) for row in rows[1:]]
+
+
+class SpreadsheetChangeDetector:
+    def __init__(
+        self,
+        state_path: Optional[str] = None,
+    ):
+        # 最後に取り込んだスプレッドシートのリビジョンと各行のハッシュ値を保持する
+        self.state_path = state_path
+        self.revision: Optional[Dict] = None
+        self.row_hashes: List[str] = []
+        self.lock = threading.Lock()
+        self.load()
+        return
+
+    def is_unchanged(self, revision: Dict) -> bool:
+        # Drive のファイルの更新日時・バージョンが前回取り込んだ時から変わっていなければ、シートの値は取得しない
+        with self.lock:
+            return self.revision is not None and revision.get("version") is not None and self.revision == revision
+
+    def diff(self, row_hashes: List[str]) -> Dict[str, List[int]]:
+        # 行の挿入・削除で行番号がずれても差分にならないように、行の内容のハッシュ値で比較する
+        with self.lock:
+            old_row_hashes = self.row_hashes
+        old_row_hash_set = set(old_row_hashes)
+        new_row_hash_set = set(row_hashes)
+        return {
+            "changed_rows": [i for i, row_hash in enumerate(row_hashes) if row_hash not in old_row_hash_set],
+            "deleted_rows": [i for i, row_hash in enumerate(old_row_hashes) if row_hash not in new_row_hash_set],
+        }
+
+    def update(self, revision: Dict, row_hashes: List[str]):
+        with self.lock:
+            self.revision = revision
+            self.row_hashes = row_hashes
+        self.save()
+        return
+
+    def load(self):
+        if self.state_path is None or not os.path.isfile(self.state_path):
+            return
+
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+        except Exception as e:
+            logger.warning(f"failed to load spreadsheet state! | {e}")
+            return
+
+        with self.lock:
+            self.revision = state["revision"]
+            self.row_hashes = state["row_hashes"]
+        logger.info(f"loaded spreadsheet state | path={self.state_path} revision={self.revision} n_rows={len(self.row_hashes)}")
+        return
+
+    def save(self):
+        if self.state_path is None:
+            return
+
+        # 複数のワーカープロセスが同時に保存しても互いの一時ファイルを上書きしないように、一時ファイル名は保存ごとに変える
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = f"{self.state_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with self.lock:
+                with open(tmp_path, "w") as f:
+                    json.dump({"revision": self.revision, "row_hashes": self.row_hashes}, f)
+            os.replace(tmp_path, self.state_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return
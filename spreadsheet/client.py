@@ -1,6 +1,8 @@
 import csv
+from concurrent.futures import ThreadPoolExecutor
 
 import gspread
+from gspread.urls import DRIVE_FILES_API_V3_URL
 from oauth2client.service_account import ServiceAccountCredentials
 
 
@@ -21,6 +23,22 @@ class SpreadsheetClient:
         workbook = self.client.open_by_key(spreadsheet_key)
         return workbook
 
+    def get_revision(self, spreadsheet_key):
+        # シートの値を取得せずに、Drive API からファイルの更新日時とバージョン（編集のたびに増加する）のみを取得する
+        resp = self.client.request(
+            "get",
+            f"{DRIVE_FILES_API_V3_URL}/{spreadsheet_key}",
+            params={
+                "supportsAllDrives": True,
+                "fields": "id,modifiedTime,version",
+            },
+        )
+        metadata = resp.json()
+        return {
+            "modified_time": metadata.get("modifiedTime"),
+            "version": metadata.get("version"),
+        }
+
     def get_worksheet(self, spreadsheet_key, spreadsheet_name):
         workbook = self.get_workbook(spreadsheet_key)
         worksheet = workbook.worksheet(spreadsheet_name)
@@ -31,3 +49,28 @@ class SpreadsheetClient:
             writer = csv.writer(csvFile)
             writer.writerows(worksheet.get_all_values())
         return True
+
+    def iter_worksheet_rows(self, worksheet, page_size=1000):
+        # シート全体を一度に取得せずに、行範囲ごとに取得して 1 行ずつ返す
+        # 次の行範囲は、呼び出し元が現在の行範囲を処理している間に先読みしておく
+        ranges = [
+            (start, min(start + page_size - 1, worksheet.row_count))
+            for start in range(1, worksheet.row_count + 1, page_size)
+        ]
+        n_blank_rows = 0
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(worksheet.get_values, f"{ranges[0][0]}:{ranges[0][1]}") if len(ranges) > 0 else None
+            for i, (start, end) in enumerate(ranges):
+                rows = future.result()
+                if i + 1 < len(ranges):
+                    future = executor.submit(worksheet.get_values, f"{ranges[i + 1][0]}:{ranges[i + 1][1]}")
+
+                # 行範囲の末尾の空行は API のレスポンスで省略されるので、後続の行がある場合のみ空行を補う
+                if len(rows) > 0:
+                    for _ in range(n_blank_rows):
+                        yield []
+                    n_blank_rows = 0
+                    for row in rows:
+                        yield row
+                n_blank_rows += (end - start + 1) - len(rows)
+        return
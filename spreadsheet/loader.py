@@ -0,0 +1,73 @@
+import csv
+import os
+import uuid
+from typing import Iterator, Optional
+
+from langchain.docstore.document import Document
+
+from spreadsheet.change_detector import get_row_hash
+from utils.csv_loader import CSVLoader
+
+
+class SpreadsheetLoader(CSVLoader):
+    def __init__(
+        self,
+        spreadsheet_client,
+        worksheet,
+        text_columns: [str],
+        source_column: Optional[str] = None,
+        meta_columns: Optional[list] = None,
+        page_size: int = 1000,
+        file_path: Optional[str] = None,
+    ):
+        # file_path を指定した場合は、読み込んだ行を csv ファイルにも書き込む
+        super().__init__(
+            file_path,
+            text_columns=text_columns,
+            source_column=source_column,
+            meta_columns=meta_columns,
+        )
+        self.spreadsheet_client = spreadsheet_client
+        self.worksheet = worksheet
+        self.page_size = page_size
+        # 読み込んだ各行のハッシュ値（前回取り込んだ内容からの差分検出に使用する）
+        self.row_hashes = []
+
+    def lazy_load(self) -> Iterator[Document]:
+        csv_file = None
+        if self.file_path is not None:
+            # 複数のワーカープロセスが同時に読み込んでも互いの一時ファイルを上書きしないように、一時ファイル名は読み込みごとに変える
+            os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+            tmp_path = f"{self.file_path}.{uuid.uuid4().hex}.tmp"
+            csv_file = open(tmp_path, "w", newline="")
+            csv_writer = csv.writer(csv_file)
+
+        self.row_hashes = []
+        try:
+            header = None
+            i = 0
+            for row in self.spreadsheet_client.iter_worksheet_rows(self.worksheet, page_size=self.page_size):
+                if header is None:
+                    header = row
+                    if csv_file is not None:
+                        csv_writer.writerow(row)
+                    continue
+
+                # worksheet.get_all_values() で取得した場合と同じになるように、列数をヘッダーに揃える
+                row = row + [""] * (len(header) - len(row))
+                self.row_hashes.append(get_row_hash(row))
+                if csv_file is not None:
+                    csv_writer.writerow(row)
+                yield self.get_document(dict(zip(header, row)), i)
+                i += 1
+        except BaseException:
+            # 途中で失敗した（読み込みを中断した）場合は、csv ファイルを置き換えずに一時ファイルを削除する
+            if csv_file is not None:
+                csv_file.close()
+                os.remove(tmp_path)
+            raise
+
+        # 全ての行を読み込んだ場合のみ csv ファイルを置き換える
+        if csv_file is not None:
+            csv_file.close()
+            os.replace(tmp_path, self.file_path)
@@ -0,0 +1,132 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
+import aiohttp
+
+from utils.logger import logger
+
+
+class AsyncRunnerOverloaded(RuntimeError):
+    pass
+
+
+class AsyncRunner:
+    def __init__(
+        self,
+        max_concurrency: int = 256,
+        max_connections: int = 100,
+        keepalive_timeout: float = 60.0,
+        name: str = "async-runner",
+    ):
+        # 1 つのイベントループ（専用スレッド）で外部 API の呼び出しを非同期に行い、スレッドを占有せずに多数の質問を同時に処理する
+        # HTTP 接続は共有の aiohttp セッションでプールし、呼び出しごとの TCP・TLS のハンドシェイクを省く
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.name = name
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.thread = None
+        self.pid = None
+        self.n_running = 0
+        self.is_shutdown = False
+        self.lock = threading.Lock()
+        return
+
+    def start(self):
+        # イベントループのスレッドは fork 後の子プロセスに引き継がれないので、最初の呼び出し時にプロセスごとに起動する
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name=self.name, daemon=True)
+            self.thread.start()
+            self.session = asyncio.run_coroutine_threadsafe(self.create_session(), self.loop).result()
+            self.n_running = 0
+            self.pid = os.getpid()
+        return
+
+    async def create_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout)
+        return aiohttp.ClientSession(connector=connector)
+
+    async def run_task(self, coro):
+        # OpenAI の非同期 API（openai<1.0）は、コンテキスト変数 openai.aiosession のセッションを使用する
+        try:
+            import openai
+
+            openai.aiosession.set(self.session)
+        except (ImportError, AttributeError):
+            pass
+
+        try:
+            return await coro
+        finally:
+            with self.lock:
+                self.n_running -= 1
+
+    def submit(self, coro, check_limit: bool = True):
+        # 同時に処理中のコルーチン数が上限に達している場合は None を返す（バックプレッシャー）
+        # 呼び出し元スレッドのコンテキスト（処理中のリクエストのトレースなど）はタスクに引き継がれる
+        if self.is_shutdown:
+            logger.warning(f"[{self.name}] runner is shutting down!")
+            coro.close()
+            return None
+
+        self.start()
+        with self.lock:
+            if check_limit and self.n_running >= self.max_concurrency:
+                logger.warning(f"[{self.name}] too many running tasks! | n_running={self.n_running}")
+                coro.close()
+                return None
+            self.n_running += 1
+        return asyncio.run_coroutine_threadsafe(self.run_task(coro), self.loop)
+
+    def is_full(self) -> bool:
+        # ストリーミングのレスポンスを返し始める前に、受付できるかどうかを確認する
+        with self.lock:
+            return self.is_shutdown or (self.pid == os.getpid() and self.n_running >= self.max_concurrency)
+
+    def run(self, coro, timeout: Optional[float] = None, check_limit: bool = True):
+        # 呼び出し元スレッドでコルーチンの完了を待つ（Flask のリクエストスレッドから使用する）
+        # 受付できなかった場合は AsyncRunnerOverloaded を送出する（呼び出し元で 503 を返す）
+        future = self.submit(coro, check_limit)
+        if future is None:
+            raise AsyncRunnerOverloaded(f"[{self.name}] too many running tasks!")
+        return future.result(timeout)
+
+    def iterate(self, async_iterator):
+        # 非同期ジェネレーターを、要素ごとにイベントループで実行する同期ジェネレーターに変換する
+        # 同時実行数の上限は最初の要素の取得時のみ確認し、返し始めた回答は途中で打ち切らない
+        try:
+            check_limit = True
+            while True:
+                try:
+                    yield self.run(async_iterator.__anext__(), check_limit=check_limit)
+                except StopAsyncIteration:
+                    return
+                check_limit = False
+        finally:
+            if self.pid == os.getpid() and not self.is_shutdown:
+                asyncio.run_coroutine_threadsafe(async_iterator.aclose(), self.loop)
+
+    def shutdown(self, timeout: Optional[float] = None):
+        # 新しいコルーチンを受け付けず、処理中のコルーチンが完了するまで待ってからイベントループを停止する
+        self.is_shutdown = True
+        with self.lock:
+            if self.pid != os.getpid():
+                return True
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self.n_running > 0 and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.05)
+        if self.n_running > 0:
+            logger.warning(f"[{self.name}] shutdown timed out! | n_running={self.n_running}")
+            return False
+
+        asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        return True
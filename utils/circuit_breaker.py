@@ -0,0 +1,154 @@
+import collections
+import threading
+import time
+from typing import Optional
+
+from utils.logger import logger
+from utils.metrics import count_event
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        window_size: int = 20,
+        min_calls: int = 5,
+        failure_rate_threshold: float = 0.5,
+        slow_call_duration: float = 20.0,
+        slow_call_rate_threshold: float = 0.5,
+        open_duration: float = 30.0,
+    ):
+        # 直近の呼び出しのエラー率・遅延した呼び出しの割合が閾値を超えた場合は、一定時間その呼び出しを行わない（open）
+        # open_duration 経過後は 1 件ずつ試行し（half_open）、成功した場合は元に戻す（closed）
+        self.name = name
+        self.window_size = window_size
+        self.min_calls = min_calls                                  # 割合を判定する最小の呼び出し数
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration = slow_call_duration                # 遅延とみなす処理時間 [sec]
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.open_duration = open_duration                          # open にしてから試行を再開するまでの時間 [sec]
+        self.results = collections.deque(maxlen=window_size)        # (is_failure, is_slow)
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.is_trial_running = False
+        self.lock = threading.Lock()
+        return
+
+    def set_state(self, state: str):
+        if self.state == state:
+            return
+        log = logger.warning if state == "open" else logger.info
+        log(f"[{self.name}] circuit breaker state changed | {self.state} -> {state}")
+        count_event("circuit_breaker", breaker=self.name, state=state)
+        self.state = state
+        if state == "open":
+            self.opened_at = time.monotonic()
+        elif state == "closed":
+            self.results.clear()
+        return
+
+    def allow(self) -> bool:
+        # 呼び出してよい場合は True を返す（True を返した場合は、呼び出し後に必ず record を呼ぶ）
+        with self.lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.open_duration:
+                    return False
+                self.set_state("half_open")
+            if self.state == "half_open":
+                if self.is_trial_running:
+                    return False
+                self.is_trial_running = True
+            return True
+
+    def record(self, elapsed_time: float, success: Optional[bool] = True):
+        # success=None は結果が分からない場合（他の処理が先に完了してキャンセルされた場合など）で、遅延した場合のみ記録する
+        is_slow = elapsed_time >= self.slow_call_duration
+        with self.lock:
+            if self.state == "half_open":
+                self.is_trial_running = False
+                if success is None and not is_slow:
+                    return
+                self.set_state("closed" if success and not is_slow else "open")
+                return
+            if success is None and not is_slow:
+                return
+
+            self.results.append((success is False, is_slow))
+            if self.state == "closed" and len(self.results) >= self.min_calls:
+                failure_rate = sum(is_failure for is_failure, _ in self.results) / len(self.results)
+                slow_call_rate = sum(is_slow for _, is_slow in self.results) / len(self.results)
+                if failure_rate >= self.failure_rate_threshold or slow_call_rate >= self.slow_call_rate_threshold:
+                    logger.warning(
+                        f"[{self.name}] too many failed or slow calls! | failure_rate={failure_rate:.2f} slow_call_rate={slow_call_rate:.2f}"
+                    )
+                    self.set_state("open")
+        return
+
+    def call(self, func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f"[{self.name}] circuit breaker is open!")
+        start_time = time.perf_counter()
+        success = None
+        try:
+            result = func(*args, **kwargs)
+            success = True
+            return result
+        except Exception:
+            success = False
+            raise
+        finally:
+            self.record(time.perf_counter() - start_time, success)
+
+    async def acall(self, coro_func, *args, **kwargs):
+        if not self.allow():
+            raise CircuitOpenError(f"[{self.name}] circuit breaker is open!")
+        start_time = time.perf_counter()
+        success = None
+        try:
+            result = await coro_func(*args, **kwargs)
+            success = True
+            return result
+        except Exception:
+            success = False
+            raise
+        finally:
+            self.record(time.perf_counter() - start_time, success)
+
+    def iter(self, iterable):
+        # allow() を確認済みのストリーミングの呼び出しの結果を、最後まで受け取った時点で記録する
+        start_time = time.perf_counter()
+        success = None
+        try:
+            for item in iterable:
+                yield item
+            success = True
+        except Exception:
+            success = False
+            raise
+        finally:
+            if hasattr(iterable, "close"):
+                iterable.close()
+            self.record(time.perf_counter() - start_time, success)
+
+    async def aiter(self, async_iterable):
+        start_time = time.perf_counter()
+        success = None
+        try:
+            async for item in async_iterable:
+                yield item
+            success = True
+        except Exception:
+            success = False
+            raise
+        finally:
+            if hasattr(async_iterable, "aclose"):
+                await async_iterable.aclose()
+            self.record(time.perf_counter() - start_time, success)
+
+    def stats(self):
+        with self.lock:
+            return {"name": self.name, "state": self.state, "n_calls": len(self.results)}
@@ -1,5 +1,5 @@
 import csv
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 
 from langchain.docstore.document import Document
 
@@ -21,29 +21,31 @@ class CSVLoader:
         self.encoding = encoding
         self.csv_args = csv_args or {}
 
-    def load(self) -> List[Document]:
-        docs = []
+    def get_document(self, row: Dict, i: int) -> Document:
+        content = "\n".join(f"{k.strip()}: {v.strip()}" for k, v in row.items() if k in self.text_columns)
+        metadata = {}
+        try:
+            source = (
+                row[self.source_column]
+                if self.source_column is not None
+                else self.file_path
+            )
+            if self.meta_columns is not None:
+                metadata = {col: row[col] for col in self.meta_columns}
+        except KeyError:
+            raise ValueError(
+                f"Some columns are not found in CSV file."
+            )
+
+        metadata["source"] = source
+        metadata["row"] = i
+        return Document(page_content=content, metadata=metadata)
+
+    def lazy_load(self) -> Iterator[Document]:
         with open(self.file_path, newline="", encoding=self.encoding) as csvfile:
             csv_reader = csv.DictReader(csvfile, **self.csv_args)  # type: ignore
             for i, row in enumerate(csv_reader):
-                content = "\n".join(f"{k.strip()}: {v.strip()}" for k, v in row.items() if k in self.text_columns)
-                metadata = {}
-                try:
-                    source = (
-                        row[self.source_column]
-                        if self.source_column is not None
-                        else self.file_path
-                    )
-                    if self.meta_columns is not None:
-                        metadata = {col: row[col] for col in self.meta_columns}
-                except KeyError:
-                    raise ValueError(
-                        f"Some columns are not found in CSV file."
-                    )
+                yield self.get_document(row, i)
 
-                metadata["source"] = source
-                metadata["row"] = i
-                doc = Document(page_content=content, metadata=metadata)
-                docs.append(doc)
-
-        return docs
+    def load(self) -> List[Document]:
+        return list(self.lazy_load())
@@ -0,0 +1,170 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from utils.metrics import count_event
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CallExecutor:
+    def __init__(
+        self,
+        max_workers: int = 32,
+        name: str = "deadline-call",
+    ):
+        # 同期の呼び出しを期限までのみ待つためのスレッドプール（呼び出しごとにスレッドを作成せずに、プロセス全体でスレッド数の上限を設ける）
+        self.max_workers = max_workers
+        self.name = name
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        return
+
+    def get_executor(self):
+        # スレッドは fork 後の子プロセスに引き継がれないので、最初の呼び出し時にプロセスごとに作成する
+        with self.lock:
+            if self.pid != os.getpid():
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+                self.pid = os.getpid()
+            return self.executor
+
+    def submit(self, func, *args, **kwargs):
+        # 処理中のリクエストのトレースなどを参照できるように、呼び出し元のコンテキストを引き継ぐ
+        return self.get_executor().submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+# Deadline.call で使用するスレッドプール（executor を指定しない場合）
+default_call_executor = CallExecutor()
+
+
+class Deadline:
+    def __init__(self, timeout: Optional[float] = None, executor: Optional[CallExecutor] = None):
+        # リクエストごとの回答生成の期限（埋め込み・LLM・Google 検索の呼び出しは、全て残り時間内に打ち切る）
+        self.timeout = timeout if timeout is not None and timeout > 0 else None     # None の場合は期限なし
+        self.expires_at = time.monotonic() + self.timeout if self.timeout is not None else None
+        self.executor = executor or default_call_executor
+        return
+
+    def remaining(self) -> Optional[float]:
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def is_expired(self) -> bool:
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    def get_timeout(self, timeout: Optional[float] = None) -> Optional[float]:
+        # 上流の API の呼び出しごとのタイムアウトを、期限までの残り時間以下にする
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def exceeded(self, stage: str) -> DeadlineExceeded:
+        count_event("deadline_exceeded", stage=stage)
+        return DeadlineExceeded(f"deadline exceeded! | stage={stage} timeout={self.timeout}")
+
+    def check(self, stage: str):
+        if self.is_expired():
+            raise self.exceeded(stage)
+        return
+
+    async def wait_for(self, awaitable, stage: str):
+        # 期限を過ぎた場合は、処理中の呼び出しをキャンセルして DeadlineExceeded を送出する
+        self.check(stage)
+        try:
+            return await asyncio.wait_for(awaitable, self.remaining())
+        except DeadlineExceeded:
+            raise
+        except TimeoutError:
+            # 上流の API 自体のタイムアウトは、期限を過ぎていなければそのまま送出する
+            if not self.is_expired():
+                raise
+            raise self.exceeded(stage) from None
+
+    def call(self, func, stage: str, *args, **kwargs):
+        # 同期の呼び出し（埋め込み・Agent など）は途中でキャンセルできないので、期限がある場合はスレッドプールで実行して期限までのみ待つ
+        # 期限を過ぎた場合は、実行待ちの呼び出しは取り消し、実行中の呼び出しは完了を待たずに DeadlineExceeded を送出する
+        # （実行中の呼び出しも、上流の API のリクエスト自体のタイムアウトを期限までの残り時間にして打ち切る（DeadlineClient））
+        self.check(stage)
+        if self.remaining() is None:
+            return func(*args, **kwargs)
+
+        future = self.executor.submit(self.run, func, *args, **kwargs)
+        try:
+            return future.result(self.remaining())
+        except TimeoutError:
+            # 上流の API 自体のタイムアウトは、そのまま送出する
+            if future.done():
+                return future.result()
+            future.cancel()
+            raise self.exceeded(stage) from None
+
+    def run(self, func, *args, **kwargs):
+        # 呼び出し先の上流の API のクライアント（DeadlineClient）が、この期限を参照できるようにする
+        token = current_deadline.set(self)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            current_deadline.reset(token)
+
+    def iter(self, iterable, stage: str):
+        # 同期のイテレーターは途中で中断できないので、要素を受け取るごとに期限を確認する
+        for item in iterable:
+            self.check(stage)
+            yield item
+
+    async def aiter(self, async_iterable, stage: str):
+        iterator = async_iterable.__aiter__()
+        try:
+            while True:
+                try:
+                    item = await self.wait_for(iterator.__anext__(), stage)
+                except StopAsyncIteration:
+                    return
+                yield item
+        finally:
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+
+# 処理中のリクエストの期限（Agent から呼び出されたツールで参照する）
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+def get_current_deadline() -> Deadline:
+    return current_deadline.get() or Deadline()
+
+
+class DeadlineClient:
+    def __init__(self, client, stage: str):
+        # 上流の API のクライアント（openai.ChatCompletion・openai.Embedding など）の呼び出しごとに、
+        # リクエスト自体のタイムアウト（request_timeout）を処理中のリクエストの期限までの残り時間にする
+        # 同期の呼び出しは途中でキャンセルできないので、期限を過ぎた呼び出し（hedge で採用されなかった方も含む）はこのタイムアウトで打ち切る
+        self.client = client
+        self.stage = stage
+        return
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def get_kwargs(self, kwargs):
+        deadline = get_current_deadline()
+        deadline.check(self.stage)
+        timeout = deadline.get_timeout(kwargs.get("request_timeout"))
+        if timeout is None:
+            return kwargs
+        return {**kwargs, "request_timeout": timeout}
+
+    def create(self, *args, **kwargs):
+        return self.client.create(*args, **self.get_kwargs(kwargs))
+
+    async def acreate(self, *args, **kwargs):
+        return await self.client.acreate(*args, **self.get_kwargs(kwargs))
@@ -0,0 +1,62 @@
+import builtins
+import os
+import threading
+import time
+
+
+class ImportTimer:
+    def __init__(
+        self,
+        root_dir: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ):
+        # アプリケーション内のモジュールから import した外部モジュールごとに、import にかかった時間を集計する
+        self.local_modules = {"__main__"} | {os.path.splitext(name)[0] for name in os.listdir(root_dir)}
+        self.import_times = {}
+        self.original_import = None
+        self.start_time = None
+        self.lock = threading.Lock()
+        return
+
+    def start(self):
+        if self.original_import is not None:
+            return
+        self.start_time = time.perf_counter()
+        self.original_import = builtins.__import__
+        builtins.__import__ = self.timed_import
+        return
+
+    def stop(self):
+        if self.original_import is None:
+            return
+        builtins.__import__ = self.original_import
+        self.original_import = None
+        return
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        importer = (globals or {}).get("__name__") or ""
+        if level != 0 or name.split(".")[0] in self.local_modules or importer.split(".")[0] not in self.local_modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        # from langchain.vectorstores import FAISS のように属性の参照時に読み込まれるモジュールも含めて計測する
+        start_time = time.perf_counter()
+        try:
+            module = self.original_import(name, globals, locals, fromlist, level)
+            for attr in fromlist or ():
+                getattr(module, attr, None)
+            return module
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            with self.lock:
+                self.import_times[name] = self.import_times.get(name, 0.0) + elapsed_time
+
+    def report(self, top_k: int = 20):
+        with self.lock:
+            import_times = sorted(self.import_times.items(), key=lambda item: item[1], reverse=True)
+        return {
+            "total_time": time.perf_counter() - self.start_time if self.start_time is not None else 0.0,
+            "import_time": sum(elapsed_time for _, elapsed_time in import_times),
+            "modules": {name: round(elapsed_time, 4) for name, elapsed_time in import_times[:top_k]},
+        }
+
+
+import_timer = ImportTimer()
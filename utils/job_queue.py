@@ -0,0 +1,89 @@
+import os
+import queue
+import threading
+import time
+from typing import Optional
+
+from utils.logger import logger
+
+
+class JobQueue:
+    def __init__(
+        self,
+        num_workers: int = 4,
+        maxsize: int = 100,
+        name: str = "job-queue",
+    ):
+        self.name = name
+        self.num_workers = num_workers
+        self.maxsize = maxsize
+        # キューの上限を設けて、処理しきれないジョブは投入時に拒否する（バックプレッシャー）
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.workers = []
+        self.pid = None
+        self.is_shutdown = False
+        self.lock = threading.Lock()
+        return
+
+    def start(self):
+        # ワーカースレッドは fork 後の子プロセスに引き継がれないので、最初のジョブの投入時にプロセスごとに起動する
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.maxsize)
+            self.workers = []
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self.run_worker, args=(self.queue,), name=f"{self.name}-{i}", daemon=True)
+                worker.start()
+                self.workers.append(worker)
+            self.pid = os.getpid()
+        return
+
+    def submit(self, func, *args, **kwargs) -> bool:
+        if self.is_shutdown:
+            logger.warning(f"[{self.name}] queue is shutting down!")
+            return False
+
+        self.start()
+        try:
+            self.queue.put_nowait((func, args, kwargs))
+        except queue.Full:
+            logger.warning(f"[{self.name}] queue is full! | qsize={self.queue.qsize()}")
+            return False
+        return True
+
+    def run_worker(self, job_queue):
+        while True:
+            job = job_queue.get()
+            if job is None:
+                job_queue.task_done()
+                break
+
+            func, args, kwargs = job
+            try:
+                func(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"[{self.name}] failed to run job! | {e}", exc_info=True)
+            finally:
+                job_queue.task_done()
+        return
+
+    def shutdown(self, wait=True, timeout: Optional[float] = None):
+        # 新しいジョブの投入を拒否し、キューに残っているジョブを処理し終えてからワーカーを停止する
+        # timeout [sec] を指定した場合は、それ以上は待たずに返す（残りのジョブはプロセスの終了とともに破棄される）
+        self.is_shutdown = True
+        with self.lock:
+            if self.pid != os.getpid():
+                return True
+            workers = self.workers
+        for _ in workers:
+            self.queue.put(None)
+        if wait:
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            for worker in workers:
+                worker.join(timeout=max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+            n_alive = sum(worker.is_alive() for worker in workers)
+            if n_alive > 0:
+                logger.warning(f"[{self.name}] shutdown timed out! | n_running_workers={n_alive} qsize={self.queue.qsize()}")
+                return False
+        return True
@@ -1,14 +1,29 @@
+import atexit
+import inspect
 import logging
 import os
+import queue
+import random
 import sys
+import threading
 import time
 from collections import OrderedDict
+from contextvars import ContextVar
 from datetime import datetime
+from functools import wraps
 from logging import LogRecord, StreamHandler
+from logging.handlers import QueueHandler, QueueListener
 from typing import List
 
 from pythonjsonlogger import jsonlogger
 
+# 処理中のリクエストのトレース（utils/metrics.py の Trace）
+current_trace = ContextVar("current_trace", default=None)
+
+log_queue_size = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))                       # 書き込み待ちのログの上限数（超えた場合は破棄する。0 の場合は同期的に書き込む）
+log_payload_max_chars = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", "1000"))          # プロンプト・検索した文章などを出力する文字数の上限（0 の場合は上限なし）
+log_payload_sample_rate = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "1.0"))     # プロンプト・検索した文章などを含むログを出力する割合
+
 
 class JsonFormatter(jsonlogger.JsonFormatter):
     def parse(self) -> List[str]:
@@ -20,43 +35,219 @@ class JsonFormatter(jsonlogger.JsonFormatter):
     ) -> None:
         self.json_ensure_ascii = False
         super().add_fields(log_record, record, message_dict)
+        # ログはリスナーのスレッドで JSON に変換するので、書き込んだ時刻ではなくログを出力した時刻を使用する
         if not log_record.get("timestamp"):
-            log_record["timestamp"] = datetime.utcnow().isoformat()
+            log_record["timestamp"] = datetime.utcfromtimestamp(record.created).isoformat()
 
         if log_record.get("level"):
             log_record["level"] = log_record["level"].upper()
         else:
             log_record["level"] = record.levelname
 
+        # 同じリクエストのログを紐付けられるように、トレース ID を出力する
+        trace = current_trace.get()
+        if trace is not None and not log_record.get("trace_id"):
+            log_record["trace_id"] = trace.trace_id
+
+
+class Payload:
+    # プロンプト・検索した文章などの大きな値は、ログを書き込む時点で（リスナーのスレッドで）文字列に変換し、上限の文字数で切り詰める
+    # logger.debug("prompt=%s", Payload(prompt)) のように、f-string ではなくログの引数として渡す
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+        return
+
+    def __str__(self):
+        text = str(self.value)
+        if log_payload_max_chars > 0 and len(text) > log_payload_max_chars:
+            return f"{text[:log_payload_max_chars]}...(truncated {len(text) - log_payload_max_chars} chars)"
+        return text
+
+
+class LogListener(QueueListener):
+    def __init__(self, log_queue, handlers, queue_handler):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+        self.n_reported_dropped = 0
+        self.reported_at = 0.0
+        return
+
+    def enqueue_sentinel(self):
+        # キューが溢れている場合も、書き込みが進んで空きができるまで待ってから停止する
+        self.queue.put(self._sentinel)
+        return
+
+    def handle(self, record):
+        super().handle(record)
+        self.queue_handler.n_written += 1
+        # キューが溢れてログを破棄した場合は、破棄した件数を書き込む（1 分に 1 回まで）
+        n_dropped = self.queue_handler.n_dropped
+        if n_dropped > self.n_reported_dropped and time.monotonic() - self.reported_at >= 60:
+            super().handle(logging.makeLogRecord({
+                "name": __name__,
+                "levelno": logging.WARNING,
+                "levelname": "WARNING",
+                "msg": f"log queue is full! dropped log records | n_dropped={n_dropped - self.n_reported_dropped}",
+            }))
+            self.n_reported_dropped = n_dropped
+            self.reported_at = time.monotonic()
+        return
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    def __init__(self, handlers, maxsize: int = 10000, payload_sample_rate: float = 1.0):
+        # リクエストのスレッドではログをキューに追加するのみとし、メッセージの組み立て・JSON への変換・書き込みはリスナーのスレッドで行う
+        # キューが溢れた場合は、リクエストのスレッドを止めないようにログを破棄する
+        super().__init__(queue.Queue(maxsize))
+        self.handlers = handlers
+        self.maxsize = maxsize
+        self.payload_sample_rate = payload_sample_rate
+        self.listener = None
+        self.pid = None
+        self.stopped_pid = None
+        self.start_lock = threading.Lock()
+        # 件数はロックを取らずに数える（スレッド間で競合した場合は多少ずれる）
+        self.n_enqueued = 0
+        self.n_dropped = 0
+        self.n_sampled_out = 0
+        self.n_written = 0
+        return
+
+    def start(self):
+        # gunicorn の preload で fork した子プロセスにはリスナーのスレッドが引き継がれないので、最初のログの出力時にプロセスごとに開始する
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.maxsize)
+            self.listener = LogListener(self.queue, self.handlers, self)
+            self.listener.start()
+            self.pid = os.getpid()
+        return
+
+    def stop(self):
+        # 終了時に、キューに残っているログを全て書き込む
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self.pid = None
+            self.stopped_pid = os.getpid()
+        return
+
+    def filter(self, record):
+        # プロンプト・検索した文章などを含むログは、payload_sample_rate の割合のみ出力する
+        if self.payload_sample_rate < 1.0 and isinstance(record.args, tuple) and any(isinstance(arg, Payload) for arg in record.args):
+            if random.random() >= self.payload_sample_rate:
+                self.n_sampled_out += 1
+                return False
+        return super().filter(record)
+
+    def prepare(self, record):
+        # QueueHandler.prepare はメッセージを組み立てるので、ここではリスナーのスレッドで参照できないトレース ID のみ記録する
+        trace = current_trace.get()
+        if trace is not None:
+            record.trace_id = trace.trace_id
+        return record
+
+    def enqueue(self, record):
+        if self.stopped_pid == os.getpid():
+            # 終了処理でリスナーを停止した後のログ（他の atexit・__del__ など）は、リスナーのスレッドを再開せずに書き込む
+            # （インタープリターの終了中はスレッドを開始できず、start が返らなくなる）
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+            self.n_enqueued += 1
+        except queue.Full:
+            self.n_dropped += 1
+        return
+
+    def stats(self):
+        return {
+            "n_enqueued": self.n_enqueued,
+            "n_dropped": self.n_dropped,
+            "n_sampled_out": self.n_sampled_out,
+            "n_written": self.n_written,
+            "queue_size": self.queue.qsize(),
+        }
+
 
 def setup():
-    if StreamHandler not in map(type, logging.getLogger().handlers):
-        stream_handler = StreamHandler(sys.stdout)
-        stream_handler.setFormatter(JsonFormatter())
-        logging.getLogger().addHandler(stream_handler)
+    if any(isinstance(handler, (StreamHandler, NonBlockingQueueHandler)) for handler in logging.getLogger().handlers):
+        return
+    stream_handler = StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    handlers = [stream_handler]
+    if os.environ.get("LOG_LEVEL") == "DEBUG":
+        if not os.path.isdir(".logs"):
+            os.mkdir(".logs")
+        file_handler = logging.FileHandler(os.path.join(".logs", 'app.log'))
+        file_handler.addFilter(logging.Filter("glossary-lim-chat-bot"))
+        handlers.append(file_handler)
+
+    if log_queue_size <= 0:
+        for handler in handlers:
+            logging.getLogger().addHandler(handler)
+        return
+    queue_handler = NonBlockingQueueHandler(handlers, maxsize=log_queue_size, payload_sample_rate=log_payload_sample_rate)
+    logging.getLogger().addHandler(queue_handler)
+    atexit.register(queue_handler.stop)
+    return
+
+
+def get_handlers():
+    # 実際に書き込みを行うハンドラー（キューを使用する場合はリスナーのハンドラー）
+    handlers = []
+    for handler in logging.getLogger().handlers:
+        handlers.extend(handler.handlers if isinstance(handler, NonBlockingQueueHandler) else [handler])
+    return handlers
+
+
+def log_stats():
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, NonBlockingQueueHandler):
+            return handler.stats()
+    return {}
 
 
 def log_decorator(logger):
+    # メッセージはログを書き込む時点で組み立てるので、引数・戻り値は DEBUG レベルのログを出力しない場合は文字列に変換しない
+    def _log_start(func, args, kwds):
+        logger.info("[%s] START", func.__qualname__)
+        logger.debug("[%s] START args=%s kwds=%s", func.__qualname__, Payload(args), Payload(kwds))
+        return time.time()
+
+    def _log_end(func, start_time, rtn):
+        elapsed_time = 1000 * (time.time() - start_time)
+        logger.info(
+            "[%s] END elapsed_time [ms]=%.5f", func.__qualname__, elapsed_time,
+            extra={"function": func.__qualname__, "elapsed_time_ms": elapsed_time},
+        )
+        logger.debug("[%s] END elapsed_time [ms]=%.5f return %s", func.__qualname__, elapsed_time, Payload(rtn))
+        return
+
     def _logging(func):
-        def _wrapper(*args, **kwds):
-            start_time = time.time()
-            logger.info("[{}] {}".format(func.__qualname__, "START"))
-            logger.debug(
-                "[{}] {} args={} kwds={}".format(func.__qualname__, "START", args, kwds)
-            )
+        # コルーチン関数の場合は、await が完了するまでの時間を出力する
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def _async_wrapper(*args, **kwds):
+                start_time = _log_start(func, args, kwds)
+                rtn = await func(*args, **kwds)
+                _log_end(func, start_time, rtn)
+                return rtn
 
+            return _async_wrapper
+
+        @wraps(func)
+        def _wrapper(*args, **kwds):
+            start_time = _log_start(func, args, kwds)
             rtn = func(*args, **kwds)
-            elapsed_time = 1000 * (time.time() - start_time)
-            logger.info(
-                "[{}] {} elapsed_time [ms]={:.5f}".format(
-                    func.__qualname__, "END", elapsed_time
-                )
-            )
-            logger.debug(
-                "[{}] {} elapsed_time [ms]={:.5f} return {}".format(
-                    func.__qualname__, "END", elapsed_time, rtn
-                )
-            )
+            _log_end(func, start_time, rtn)
             return rtn
 
         return _wrapper
@@ -67,9 +258,3 @@ def log_decorator(logger):
 setup()
 logger = logging.getLogger("glossary-lim-chat-bot")
 logging.getLogger().setLevel(level=os.environ.get("LOG_LEVEL", "INFO"))
-
-if os.environ['LOG_LEVEL'] == "DEBUG":
-    if not os.path.isdir(".logs"):
-        os.mkdir(".logs")
-    logger_fh = logging.FileHandler(os.path.join(".logs", 'app.log'))
-    logger.addHandler(logger_fh)
@@ -0,0 +1,303 @@
+import bisect
+import inspect
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Optional, Tuple
+
+from utils.logger import current_trace, log_stats, logger
+
+# レイテンシのヒストグラムのバケット [sec]
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra is not None else [])
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in items) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+        return
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+        return
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # ラベルごとに (バケットごとの件数, 合計値, 件数) を保持する
+        self.values: Dict[tuple, list] = {}
+        self.lock = threading.Lock()
+        return
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            values = self.values.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0, 0])
+            values[0][i] += 1
+            values[1] += value
+            values[2] += 1
+        return
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (bucket_counts, total, count) in sorted(self.values.items()):
+                cumulative_count = 0
+                for bucket, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative_count += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(key, ('le', bucket))} {cumulative_count}")
+                lines.append(f"{self.name}_bucket{format_labels(key, ('le', '+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+
+class CallbackMetric:
+    def __init__(self, name: str, description: str, func, metric_type: str = "gauge", label: str = "kind"):
+        # 値を保持せずに、出力時に func() が返す {ラベルの値: 値} を出力する（ログのキューの件数など、他のモジュールで数えている値）
+        self.name = name
+        self.description = description
+        self.func = func
+        self.metric_type = metric_type
+        self.label = label
+        return
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.metric_type}"]
+        for key, value in sorted(self.func().items()):
+            lines.append(f"{self.name}{format_labels(((self.label, key),))} {value}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        return
+
+    def counter(self, name: str, description: str) -> Counter:
+        with self.lock:
+            return self.metrics.setdefault(name, Counter(name, description))
+
+    def histogram(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        with self.lock:
+            return self.metrics.setdefault(name, Histogram(name, description, buckets))
+
+    def callback(self, name: str, description: str, func, metric_type: str = "gauge", label: str = "kind") -> CallbackMetric:
+        with self.lock:
+            return self.metrics.setdefault(name, CallbackMetric(name, description, func, metric_type, label))
+
+    def render(self) -> str:
+        # Prometheus のテキスト形式で出力する
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+metrics = MetricsRegistry()
+request_seconds = metrics.histogram("glossary_request_seconds", "Latency of each request or slack command.")
+stage_seconds = metrics.histogram("glossary_stage_seconds", "Latency of each stage of answering a question.")
+events_total = metrics.counter("glossary_events_total", "Number of events such as cache hits and misses.")
+tokens_total = metrics.counter("glossary_tokens_total", "Number of LLM tokens.")
+log_records_total = metrics.callback(
+    "glossary_log_records_total", "Number of log records enqueued, dropped, sampled out and written.",
+    lambda: {key[2:]: value for key, value in log_stats().items() if key.startswith("n_")}, metric_type="counter", label="result",
+)
+log_queue_size = metrics.callback(
+    "glossary_log_queue_size", "Number of log records waiting to be written.",
+    lambda: {"pending": log_stats()["queue_size"]} if "queue_size" in log_stats() else {},
+)
+
+
+class Trace:
+    def __init__(self, name: str):
+        # 1 リクエスト（Slack コマンド）内の各ステージの処理時間と件数を集計する
+        self.name = name
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.start_time = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        return
+
+    def add_stage(self, stage: str, elapsed_time: float):
+        with self.lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + elapsed_time
+        return
+
+    def add_count(self, name: str, n: float = 1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+        return
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "trace_name": self.name,
+                "elapsed_time_ms": round(1000 * (time.perf_counter() - self.start_time), 3),
+                "stages_ms": {stage: round(1000 * elapsed_time, 3) for stage, elapsed_time in self.stages.items()},
+                "counts": dict(self.counts),
+            }
+
+
+def start_trace(name: str) -> Trace:
+    trace = Trace(name)
+    current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace: Optional[Trace]):
+    # リクエスト全体の処理時間をヒストグラムに記録し、各ステージの処理時間を JSON ログのフィールドとして出力する
+    if trace is None:
+        return
+    if current_trace.get() is trace:
+        current_trace.set(None)
+    trace_dict = trace.to_dict()
+    request_seconds.observe(trace_dict["elapsed_time_ms"] / 1000, name=trace.name)
+    logger.info(f"[{trace.name}] trace", extra=trace_dict)
+    return
+
+
+@contextmanager
+def trace_span(name: str):
+    trace = start_trace(name)
+    try:
+        yield trace
+    finally:
+        finish_trace(trace)
+
+
+def record_stage(stage: str, elapsed_time: float):
+    # 処理中のリクエストのトレースと、ステージごとのヒストグラムに処理時間を記録する
+    stage_seconds.observe(elapsed_time, stage=stage)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_stage(stage, elapsed_time)
+    return
+
+
+def traced(name: str):
+    # 関数の呼び出しを 1 つのトレースとして記録する（Slack コマンドのワーカーなど、Flask のリクエスト外の処理に使用する）
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with trace_span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def span(stage: str):
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start_time)
+
+
+def iter_span(stage: str, iterable):
+    # ジェネレーターの要素の生成にかかった時間のみを記録する（呼び出し元で要素を処理している時間は含めない）
+    # 最初の要素が生成されるまでの時間は {stage}_first_token として記録する
+    iterator = iter(iterable)
+    elapsed_time = 0.0
+    is_first = True
+    try:
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                elapsed_time += time.perf_counter() - start_time
+                break
+            elapsed_time += time.perf_counter() - start_time
+            if is_first:
+                record_stage(f"{stage}_first_token", elapsed_time)
+                is_first = False
+            yield item
+    finally:
+        record_stage(stage, elapsed_time)
+
+
+async def aiter_span(stage: str, async_iterable):
+    # iter_span の非同期ジェネレーター版
+    iterator = async_iterable.__aiter__()
+    elapsed_time = 0.0
+    is_first = True
+    try:
+        while True:
+            start_time = time.perf_counter()
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                elapsed_time += time.perf_counter() - start_time
+                break
+            elapsed_time += time.perf_counter() - start_time
+            if is_first:
+                record_stage(f"{stage}_first_token", elapsed_time)
+                is_first = False
+            yield item
+    finally:
+        record_stage(stage, elapsed_time)
+
+
+def iter_with_trace(trace: Optional[Trace], iterable):
+    # ストリーミングのレスポンスは、リクエストの処理とは別のコンテキストで生成されるため、トレースを引き継ぎ、生成し終えた時点でトレースを終了する
+    iterator = iter(iterable)
+    try:
+        while True:
+            current_trace.set(trace)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+    finally:
+        finish_trace(trace)
+
+
+def count_event(name: str, n: float = 1, **labels):
+    events_total.inc(n, event=name, **labels)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_count(name, n)
+    return
+
+
+def count_tokens(kind: str, n: int):
+    tokens_total.inc(n, kind=kind)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_count(f"{kind}_tokens", n)
+    return
@@ -0,0 +1,5 @@
+# gunicorn から起動する場合のエントリーポイント
+# gunicorn -c gunicorn.conf.py wsgi:flask_app
+from app import flask_app, init_feature_db
+
+init_feature_db()